@@ -0,0 +1,272 @@
+'''Measure gmf convert-filters on large synthetic filter sets.
+
+For each size, a YAML filter list and the equivalent Atom export (one
+entry per label, as Gmail writes it) are generated, and each scenario
+converts one of them in a fresh interpreter.  The wall time and peak
+resident set size of each conversion are reported, so that the cost of
+the in-memory conversions (which parse the whole document and, from
+XML, merge the labels of filters with the same conditions) can be
+compared with --stream as filter sets grow.
+
+Examples:
+
+    python bench/bench_convert.py
+    python bench/bench_convert.py --filters 100 10000 1000000 --labels 5
+    python bench/bench_convert.py --output before.json
+    python bench/bench_convert.py --compare before.json
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from xml.sax.saxutils import quoteattr
+
+# Run gmf without depending on the console script being installed.
+runner = ('import sys; from gmailfilters.main import main; '
+          'sys.exit(main(sys.argv[1:]))')
+
+scenarios = {
+    'toxml': ['convert-filters', '--toxml', '-o', '{output}', '{yaml}'],
+    'toxml-stream': ['convert-filters', '--toxml', '--stream',
+                     '-o', '{output}', '{yaml}'],
+    'fromxml': ['convert-filters', '--fromxml', '-o', '{output}',
+                '{xml}'],
+    'fromxml-stream': ['convert-filters', '--fromxml', '--stream',
+                       '-o', '{output}', '{xml}'],
+}
+
+actions = ['shouldArchive', 'shouldMarkAsRead', 'shouldNeverSpam',
+           'shouldStar', 'shouldTrash']
+
+
+def make_filters(count, labels, distinct, rng):
+    '''Yield count filters, each with a from, to, subject or
+    hasTheWord condition, up to labels labels (chosen from distinct
+    labels) and sometimes an action.'''
+
+    for i in range(count):
+        f = {}
+        kind = i % 4
+        if kind == 0:
+            f['from'] = 'sender%d@example%d.com' % (i, i % 97)
+        elif kind == 1:
+            f['to'] = 'list%d@lists.example.org' % i
+        elif kind == 2:
+            f['subject'] = 'report %d' % i
+        else:
+            f['hasTheWord'] = '"project %d" OR ticket-%d' % (i, i)
+
+        if labels:
+            f['label'] = ' '.join(
+                'label%d' % x for x in
+                rng.sample(range(distinct), rng.randint(1, labels)))
+        if i % 3 == 0:
+            f[actions[i % len(actions)]] = True
+
+        yield f
+
+
+def write_yaml(fd, filters):
+    # Written by hand, rather than with yaml.dump, so that generating
+    # a million filters does not take longer than converting them.
+    for f in filters:
+        first = True
+        for key in sorted(f):
+            value = f[key]
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            else:
+                value = json.dumps(value)
+            fd.write('%s %s: %s\n' % ('-' if first else ' ', key, value))
+            first = False
+
+
+def write_xml(fd, filters):
+    fd.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<feed xmlns="http://www.w3.org/2005/Atom" '
+             'xmlns:apps="http://schemas.google.com/apps/2006">\n'
+             '  <title>Mail Filters</title>\n')
+
+    for f in filters:
+        props = []
+        for key in sorted(f):
+            if key == 'label':
+                continue
+            value = f[key]
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            props.append('    <apps:property name="%s" value=%s/>\n' %
+                         (key, quoteattr(value)))
+
+        for label in f.get('label', '').split() or [None]:
+            fd.write('  <entry>\n'
+                     '    <category term="filter"></category>\n'
+                     '    <title>Mail Filter</title>\n'
+                     '    <updated>2020-01-01T00:00:00Z</updated>\n'
+                     '    <content></content>\n')
+            fd.writelines(props)
+            if label is not None:
+                fd.write('    <apps:property name="label" value="%s"/>\n' %
+                         label)
+            fd.write('  </entry>\n')
+
+    fd.write('</feed>\n')
+
+
+def generate(workdir, count, args):
+    '''Write the YAML and Atom filter sets with count filters, and
+    return their paths.'''
+
+    paths = {
+        'yaml': os.path.join(workdir, 'filters-%d.yml' % count),
+        'xml': os.path.join(workdir, 'filters-%d.xml' % count),
+    }
+    for name, write in [('yaml', write_yaml), ('xml', write_xml)]:
+        with open(paths[name], 'w') as fd:
+            write(fd, make_filters(count, args.labels, args.distinct_labels,
+                                   random.Random(args.seed)))
+
+    return paths
+
+
+def run_once(argv):
+    '''Run gmf with argv in a fresh interpreter.  Return its exit
+    status, wall time and peak RSS (in megabytes).'''
+
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, '-c', runner] + argv,
+                                stdout=devnull, stderr=devnull)
+        # wait4 reports the resource usage of this child alone, whereas
+        # getrusage(RUSAGE_CHILDREN) gives the largest of all of them.
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+    elapsed = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return os.WEXITSTATUS(status), elapsed, usage.ru_maxrss / float(scale)
+
+
+def run_scenario(name, count, paths, args, workdir):
+    output = os.path.join(workdir, 'output')
+    argv = [x.format(output=output, **paths) for x in scenarios[name]]
+
+    times = []
+    peak = 0
+    for i in range(args.runs):
+        status, elapsed, rss = run_once(argv)
+        times.append(elapsed)
+        peak = max(peak, rss)
+
+    size = os.path.getsize(output) if os.path.exists(output) else 0
+    if os.path.exists(output):
+        os.unlink(output)
+
+    return {
+        'scenario': name,
+        'filters': count,
+        'labels': args.labels,
+        'status': status,
+        'runs': args.runs,
+        'wall_time': round(min(times), 3),
+        'peak_rss_mb': round(peak, 1),
+        'input_bytes': os.path.getsize(
+            paths['yaml' if name.startswith('toxml') else 'xml']),
+        'output_bytes': size,
+    }
+
+
+def print_results(results, baseline):
+    fmt = '%-15s %9s %6s %6s %10s %10s %12s'
+    print(fmt % ('scenario', 'filters', 'labels', 'status', 'wall (s)',
+                 'RSS (MB)', 'output'))
+    for r in results:
+        print(fmt % (r['scenario'], r['filters'], r['labels'], r['status'],
+                     '%.3f' % r['wall_time'], '%.1f' % r['peak_rss_mb'],
+                     r['output_bytes']))
+
+        base = baseline.get((r['scenario'], r['filters'], r['labels']))
+        if base:
+            print(fmt % ('  vs baseline', '', '', '',
+                         ratio(r, base, 'wall_time'),
+                         ratio(r, base, 'peak_rss_mb'),
+                         ratio(r, base, 'output_bytes')))
+
+
+def ratio(result, base, key):
+    if not base[key]:
+        return '-'
+    return 'x%.2f' % (float(result[key]) / base[key])
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--filters', '-n', type=int, nargs='+',
+                   default=[100, 1000, 10000, 100000],
+                   help='Numbers of filters to test')
+    p.add_argument('--labels', type=int, default=3,
+                   help='Largest number of labels per filter (each filter '
+                   'becomes this many Atom entries, at most)')
+    p.add_argument('--distinct-labels', type=int, default=50,
+                   help='Number of different labels to choose from')
+    p.add_argument('--runs', '-r', type=int, default=1,
+                   help='Number of times to run each scenario (the best '
+                   'time and largest RSS are reported)')
+    p.add_argument('--scenario', '-s', action='append',
+                   choices=sorted(scenarios),
+                   help='Scenarios to run (default: all)')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--output', '-o',
+                   help='Write results to this JSON file')
+    p.add_argument('--compare', '-c',
+                   help='Compare results with a previous JSON file')
+
+    args = p.parse_args()
+    if args.labels > args.distinct_labels:
+        p.error('--labels cannot be more than --distinct-labels')
+    return args
+
+
+def main():
+    args = parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fd:
+            for r in json.load(fd):
+                baseline[(r['scenario'], r['filters'], r['labels'])] = r
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='gmf-bench-')
+    try:
+        for count in args.filters:
+            print('generating %d filters' % count, file=sys.stderr)
+            paths = generate(workdir, count, args)
+            for name in args.scenario or sorted(scenarios):
+                print('running %s' % name, file=sys.stderr)
+                results.append(run_scenario(name, count, paths, args,
+                                            workdir))
+            for path in paths.values():
+                os.unlink(path)
+    finally:
+        shutil.rmtree(workdir)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
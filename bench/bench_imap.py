@@ -0,0 +1,218 @@
+'''Measure gmf bulk-filter and apply-filters against a fake Gmail server.
+
+Each scenario runs a gmf command against a FakeGmailServer (see
+fakeimap.py) seeded with a synthetic mailbox, and reports the wall
+time, the number of IMAP commands and the bytes sent and received by
+the client.  gmailfilters must be installed (e.g. with ``pip install -e
+.``) so that its commands can be found.
+
+Examples:
+
+    python bench/bench_imap.py --messages 10000 100000 --latency 0.02
+    python bench/bench_imap.py --output before.json
+    python bench/bench_imap.py --compare before.json -- --workers 4
+    python bench/bench_imap.py --max-rate 50 -- --max-command-rate 40
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+
+from fakeimap import FakeGmailServer, Store
+from gmailfilters.main import GmailFilterApp
+
+scenarios = {
+    'bulk-label': ['bulk-filter', '-Q', 'subject:lunch',
+                   '-L', 'benchmark', '@all'],
+    'bulk-all': ['bulk-filter', '-F', '+SEEN', '@all'],
+    'bulk-show': ['bulk-filter', '-Q', 'subject:lunch', '--show',
+                  '@all'],
+    'apply-filters': ['apply-filters', '{filters}', '*'],
+    'bulk-throttled': ['bulk-filter', '-Q', 'subject:lunch', '-s', '5',
+                       '-L', 'benchmark', '@all'],
+}
+
+# Scenarios run against a server that throttles at this many commands
+# per second (whatever --max-rate says), to check that the governor
+# slows down enough for the command to finish.
+scenario_rates = {
+    'bulk-throttled': 10,
+}
+
+
+def write_filters(path, count, store):
+    '''Write count filters, spread across the senders and subjects in
+    store, with a mix of actions.'''
+
+    filters = []
+    for i in range(count):
+        f = {}
+        if i % 3 == 2:
+            f['subject'] = store.subjects[i % len(store.subjects)].split()[0]
+        else:
+            f['from'] = store.senders[i % len(store.senders)]
+        if i % 4 != 3:
+            f['label'] = 'filtered%d' % (i % 10)
+        if i % 5 == 0:
+            f['shouldArchive'] = True
+        if i % 7 == 0:
+            f['shouldMarkAsread'] = True
+        filters.append(f)
+
+    with open(path, 'w') as fd:
+        yaml.safe_dump(filters, fd, default_flow_style=False)
+
+
+def run_scenario(name, store, args, workdir):
+    filters = os.path.join(workdir, 'filters.yml')
+    write_filters(filters, args.filters, store)
+
+    max_rate = scenario_rates.get(name, args.max_rate)
+    with FakeGmailServer(store, latency=args.latency,
+                         max_rate=max_rate) as server:
+        config = os.path.join(workdir, 'config.yml')
+        with open(config, 'w') as fd:
+            yaml.safe_dump({'accounts': {'default': server.account()}}, fd)
+
+        argv = ['-q', '-f', config]
+        argv.extend(x.format(filters=filters) for x in scenarios[name])
+        argv[4:4] = args.gmf_args
+
+        stdout = sys.stdout
+        start = time.time()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                sys.stdout = devnull
+                rc = GmailFilterApp().run(argv)
+        finally:
+            sys.stdout = stdout
+        elapsed = time.time() - start
+
+        stats = server.stats.snapshot()
+
+    return {
+        'scenario': name,
+        'messages': len(store.sender),
+        'latency': args.latency,
+        'max_rate': max_rate,
+        'gmf_args': args.gmf_args,
+        'status': rc,
+        'wall_time': round(elapsed, 3),
+        'commands': stats['total_commands'],
+        'commands_by_type': stats['commands'],
+        # the server's input is the client's output, and vice versa
+        'bytes_sent': stats['bytes_in'],
+        'bytes_received': stats['bytes_out'],
+        'throttled': stats['throttled'],
+    }
+
+
+def print_results(results, baseline):
+    fmt = '%-14s %9s %6s %10s %9s %12s %12s'
+    print(fmt % ('scenario', 'messages', 'status', 'wall (s)', 'commands',
+                 'bytes sent', 'bytes recv'))
+    for r in results:
+        print(fmt % (r['scenario'], r['messages'],
+                     r['status'] if r['status'] == 0 else 'FAILED',
+                     '%.3f' % r['wall_time'], r['commands'],
+                     r['bytes_sent'], r['bytes_received']))
+
+        base = baseline.get((r['scenario'], r['messages']))
+        if base and r['status'] == 0 and base['status'] == 0:
+            print(fmt % ('  vs baseline', '', '',
+                         ratio(r, base, 'wall_time'),
+                         ratio(r, base, 'commands'),
+                         ratio(r, base, 'bytes_sent'),
+                         ratio(r, base, 'bytes_received')))
+
+
+def ratio(result, base, key):
+    if not base[key]:
+        return '-'
+    return 'x%.2f' % (float(result[key]) / base[key])
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='Arguments after "--" are passed to each gmf command.')
+    p.add_argument('--messages', '-m', type=int, nargs='+',
+                   default=[10000],
+                   help='Mailbox sizes to test')
+    p.add_argument('--labels', type=int, default=20,
+                   help='Number of labels in the synthetic mailbox')
+    p.add_argument('--filters', type=int, default=50,
+                   help='Number of filters used by apply-filters')
+    p.add_argument('--latency', '-l', type=float, default=0.01,
+                   help='Delay (in seconds) before each tagged response')
+    p.add_argument('--max-rate', type=float,
+                   help='Refuse commands with [THROTTLED] beyond this many '
+                   'per second, as Gmail does')
+    p.add_argument('--scenario', '-s', action='append',
+                   choices=sorted(scenarios),
+                   help='Scenarios to run (default: all)')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--output', '-o',
+                   help='Write results to this JSON file')
+    p.add_argument('--compare', '-c',
+                   help='Compare results with a previous JSON file')
+
+    argv = sys.argv[1:]
+    gmf_args = []
+    if '--' in argv:
+        gmf_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    args = p.parse_args(argv)
+    args.gmf_args = gmf_args
+    return args
+
+
+def main():
+    args = parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fd:
+            for r in json.load(fd):
+                baseline[(r['scenario'], r['messages'])] = r
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='gmf-bench-')
+    try:
+        for count in args.messages:
+            print('generating mailbox with %d messages' % count,
+                  file=sys.stderr)
+            seed = Store.generate(count, labels=args.labels, seed=args.seed)
+            for name in args.scenario or sorted(scenarios):
+                print('running %s' % name, file=sys.stderr)
+                results.append(run_scenario(name, seed.copy(), args,
+                                            workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+
+    # A command that fails early looks fast, so failures must not pass
+    # for timings.
+    failed = [r for r in results if r['status'] != 0]
+    for r in failed:
+        print('%s with %d messages failed with status %s' % (
+            r['scenario'], r['messages'], r['status']), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+'''Measure how long gmf takes to start.
+
+Each scenario runs a gmf command that does no real work in a fresh
+interpreter, several times, and reports the best and median wall time.
+On Python 3.7 and later, the slowest imports (from ``python -X
+importtime``) are listed as well.  With --budget, the benchmark exits
+with status 1 if the median time of any scenario exceeds the budget, so
+that startup regressions can be caught automatically.
+
+Examples:
+
+    python bench/bench_startup.py
+    python bench/bench_startup.py --budget 300 --output startup.json
+    python bench/bench_startup.py --compare startup.json
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run gmf without depending on the console script being installed.
+runner = ('import sys; from gmailfilters.main import main; '
+          'sys.exit(main(sys.argv[1:]))')
+
+scenarios = {
+    'version': ['--version'],
+    'help': ['--help'],
+    'help-command': ['help', 'apply-filters'],
+    'dump-config': ['-f', '{config}', 'dump-config'],
+}
+
+
+def gmf_command(name, config, extra=()):
+    return ([sys.executable] + list(extra) + ['-c', runner] +
+            [x.format(config=config) for x in scenarios[name]])
+
+
+def time_scenario(name, config, runs):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            status = subprocess.call(gmf_command(name, config),
+                                     stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+
+    times.sort()
+    return {
+        'scenario': name,
+        'status': status,
+        'runs': runs,
+        'best': round(times[0] * 1000, 1),
+        'median': round(times[len(times) // 2] * 1000, 1),
+    }
+
+
+def slowest_imports(name, config, top):
+    '''Return the top-level imports that took longest (cumulatively),
+    as (module, milliseconds) pairs, or None if this Python does not
+    support -X importtime.'''
+
+    if sys.version_info < (3, 7):
+        return None
+
+    proc = subprocess.Popen(gmf_command(name, config, ['-X', 'importtime']),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    _, stderr = proc.communicate()
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        _, cumulative, module = line.split(':', 1)[1].split('|')
+        # Nested imports are indented; only report the outermost ones.
+        if module.startswith('  '):
+            continue
+        imports.append((module.strip(), int(cumulative) / 1000.0))
+
+    imports.sort(key=lambda x: -x[1])
+    return imports[:top]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--runs', '-n', type=int, default=10,
+                   help='Number of times to run each scenario')
+    p.add_argument('--scenario', '-s', action='append',
+                   choices=sorted(scenarios),
+                   help='Scenarios to run (default: all)')
+    p.add_argument('--top', type=int, default=10,
+                   help='Number of slow imports to list')
+    p.add_argument('--budget', '-b', type=float,
+                   help='Fail if the median time of any scenario exceeds '
+                   'this many milliseconds')
+    p.add_argument('--output', '-o',
+                   help='Write results to this JSON file')
+    p.add_argument('--compare', '-c',
+                   help='Compare results with a previous JSON file')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fd:
+            for r in json.load(fd):
+                baseline[r['scenario']] = r
+
+    workdir = tempfile.mkdtemp(prefix='gmf-bench-')
+    try:
+        config = os.path.join(workdir, 'config.yml')
+        with open(config, 'w') as fd:
+            fd.write('accounts:\n  default:\n    host: imap.example.com\n')
+
+        results = []
+        for name in args.scenario or sorted(scenarios):
+            print('running %s' % name, file=sys.stderr)
+            result = time_scenario(name, config, args.runs)
+            result['imports'] = slowest_imports(name, config, args.top)
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+
+    fmt = '%-14s %6s %10s %12s'
+    print(fmt % ('scenario', 'status', 'best (ms)', 'median (ms)'))
+    for r in results:
+        print(fmt % (r['scenario'], r['status'], r['best'], r['median']))
+        base = baseline.get(r['scenario'])
+        if base and base['median']:
+            print(fmt % ('  vs baseline', '', '',
+                         'x%.2f' % (r['median'] / base['median'])))
+
+    for r in results:
+        if r['imports']:
+            print('\nslowest imports for %s:' % r['scenario'])
+            for module, ms in r['imports']:
+                print('  %8.1f ms  %s' % (ms, module))
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+
+    if args.budget is not None:
+        over = [r for r in results if r['median'] > args.budget]
+        for r in over:
+            print('%s: median %.1f ms exceeds budget of %.1f ms' % (
+                r['scenario'], r['median'], args.budget), file=sys.stderr)
+        if over:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
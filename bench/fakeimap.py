@@ -0,0 +1,1089 @@
+'''An in-process stand-in for the Gmail IMAP service.
+
+This implements just enough of IMAP4rev1 and the Gmail extensions
+(X-GM-RAW, X-GM-LABELS, X-GM-MSGID) for the gmf commands to run
+against it: CAPABILITY, LOGIN, LIST, SELECT/EXAMINE, STATUS, ENABLE,
+NOOP, IDLE, UID SEARCH, FETCH, UID FETCH, UID STORE, EXPUNGE, UID
+EXPUNGE, CLOSE and LOGOUT.
+
+Every folder is a view on a single message store (as with Gmail, a
+label is a folder), and all folders share one UID space.  The server
+counts commands and bytes in both directions and can delay the
+delivery of its responses to simulate network latency.  The delay is
+applied by a writer thread, so the server keeps reading commands while
+earlier responses are in flight, and pipelined commands overlap as
+they would on a real network.  With max_rate, the server refuses
+commands beyond that many per second with [THROTTLED], as Gmail does.
+'''
+
+from __future__ import absolute_import
+
+import array
+import bisect
+import datetime
+import random
+import re
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+EPOCH = datetime.date(2000, 1, 1)
+
+# flag bits stored per message
+FLAG_BITS = [
+    ('\\Seen', 1),
+    ('\\Answered', 2),
+    ('\\Flagged', 4),
+    ('\\Deleted', 8),
+    ('\\Draft', 16),
+]
+
+CAPABILITIES = [
+    'IMAP4rev1', 'UNSELECT', 'IDLE', 'NAMESPACE', 'CHILDREN',
+    'X-GM-EXT-1', 'UIDPLUS', 'ENABLE', 'CONDSTORE', 'ESEARCH',
+    'LIST-EXTENDED', 'LIST-STATUS', 'SPECIAL-USE',
+]
+
+WORDS = ('status report meeting invoice lunch release build failure '
+         'review patch update weekly notes travel receipt alert '
+         'security newsletter question reminder').split()
+
+
+def quote(s):
+    if s is None:
+        return 'NIL'
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def parse_date(s):
+    y, m, d = (int(x) for x in re.split('[/-]', s))
+    return (datetime.date(y, m, d) - EPOCH).days
+
+
+class Store(object):
+    '''The message store shared by every connection to a server.
+
+    Messages are kept column-wise so that a mailbox of a million
+    messages fits comfortably in memory.  Message *i* has UID *i + 1*.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.senders = []
+        self.recipients = []
+        self.subjects = []
+        self.sender = array.array('I')
+        self.recipient = array.array('I')
+        self.subject = array.array('I')
+        self.date = array.array('I')
+        self.flags = array.array('B')
+        self.modseq = array.array('d')
+        self.labels = []
+        self.expunged = array.array('B')
+        self.label_names = set()
+        self.highestmodseq = 1
+        self.uidvalidity = 1
+        self.changed = threading.Condition(self.lock)
+
+    @classmethod
+    def generate(cls, count, labels=20, senders=500, seed=0,
+                 inbox_ratio=0.1, days=3650):
+        '''Create a store with *count* synthetic messages.'''
+
+        rnd = random.Random(seed)
+        store = cls()
+        store.senders = ['user%d@example%d.com' % (i, i % 17)
+                         for i in range(senders)]
+        store.recipients = ['me@example.com'] + [
+            'list%d@lists.example.com' % i for i in range(20)]
+        store.subjects = ['%s %s %d' % (rnd.choice(WORDS),
+                                        rnd.choice(WORDS), i)
+                          for i in range(1000)]
+        label_names = ['label%d' % i for i in range(labels)]
+        store.label_names = set(label_names)
+
+        # Share label tuples between messages so that a million
+        # messages do not need a million tuples.
+        combos = [()]
+        for name in label_names:
+            combos.append((name,))
+        for i in range(len(label_names)):
+            combos.append((label_names[i],
+                           label_names[(i + 1) % len(label_names)]))
+        inbox = {}
+
+        for i in range(count):
+            store.sender.append(rnd.randrange(senders))
+            store.recipient.append(rnd.randrange(len(store.recipients)))
+            store.subject.append(rnd.randrange(len(store.subjects)))
+            store.date.append(int(days * i / max(count, 1)))
+            store.flags.append(1 if rnd.random() < 0.7 else 0)
+            store.modseq.append(1)
+            store.expunged.append(0)
+            combo = rnd.choice(combos) if labels else ()
+            if rnd.random() < inbox_ratio:
+                if combo not in inbox:
+                    inbox[combo] = ('\\Inbox',) + combo
+                combo = inbox[combo]
+            store.labels.append(combo)
+
+        return store
+
+    def copy(self):
+        '''Return an independent copy of the store, so that a generated
+        mailbox can be reused by several benchmark runs.'''
+
+        other = Store()
+        for attr in ('senders', 'recipients', 'subjects', 'labels'):
+            setattr(other, attr, list(getattr(self, attr)))
+        for attr in ('sender', 'recipient', 'subject', 'date', 'flags',
+                     'modseq', 'expunged'):
+            setattr(other, attr, array.array(getattr(self, attr).typecode,
+                                             getattr(self, attr)))
+        other.label_names = set(self.label_names)
+        other.highestmodseq = self.highestmodseq
+        other.uidvalidity = self.uidvalidity
+        return other
+
+    def deliver(self, sender, subject, recipient='me@example.com',
+                labels=('\\Inbox',)):
+        '''Add a new message to the store, as if it had just arrived.'''
+
+        with self.lock:
+            for pool, value, column in (
+                    (self.senders, sender, self.sender),
+                    (self.recipients, recipient, self.recipient),
+                    (self.subjects, subject, self.subject)):
+                try:
+                    idx = pool.index(value)
+                except ValueError:
+                    pool.append(value)
+                    idx = len(pool) - 1
+                column.append(idx)
+
+            self.date.append((datetime.date.today() - EPOCH).days)
+            self.flags.append(0)
+            self.highestmodseq += 1
+            self.modseq.append(self.highestmodseq)
+            self.expunged.append(0)
+            self.labels.append(tuple(labels))
+            self.changed.notify_all()
+            return len(self.sender)
+
+    @property
+    def uidnext(self):
+        return len(self.sender) + 1
+
+    def folders(self):
+        folders = [
+            ('(\\HasNoChildren)', 'INBOX'),
+            ('(\\HasChildren \\Noselect)', '[Gmail]'),
+            ('(\\All \\HasNoChildren)', '[Gmail]/All Mail'),
+            ('(\\HasNoChildren \\Trash)', '[Gmail]/Trash'),
+        ]
+        for name in sorted(self.label_names):
+            folders.append(('(\\HasNoChildren)', name))
+        return folders
+
+    def in_folder(self, folder, i):
+        if self.expunged[i]:
+            return False
+        labels = self.labels[i]
+        if folder == '[Gmail]/Trash':
+            return '\\Trash' in labels
+        if '\\Trash' in labels:
+            return False
+        if folder == '[Gmail]/All Mail':
+            return True
+        if folder == 'INBOX':
+            return '\\Inbox' in labels
+        return folder in labels
+
+    def members(self, folder):
+        '''Return the (sorted) list of indexes of messages in *folder*.'''
+
+        with self.lock:
+            return [i for i in range(len(self.sender))
+                    if self.in_folder(folder, i)]
+
+    def status(self, folder):
+        members = self.members(folder)
+        return {
+            'MESSAGES': len(members),
+            'RECENT': 0,
+            'UIDNEXT': self.uidnext,
+            'UIDVALIDITY': self.uidvalidity,
+            'UNSEEN': sum(1 for i in members if not self.flags[i] & 1),
+            'HIGHESTMODSEQ': int(max([self.modseq[i] for i in members] or
+                                     [1])),
+        }
+
+    def touch(self, i):
+        self.highestmodseq += 1
+        self.modseq[i] = self.highestmodseq
+
+    def add_labels(self, i, labels):
+        current = self.labels[i]
+        new = tuple(current) + tuple(x for x in labels if x not in current)
+        if new != current:
+            self.labels[i] = new
+            self.label_names.update(x for x in labels
+                                    if not x.startswith('\\'))
+            self.touch(i)
+
+    def remove_labels(self, i, labels):
+        current = self.labels[i]
+        new = tuple(x for x in current if x not in labels)
+        if new != current:
+            self.labels[i] = new
+            self.touch(i)
+
+    def set_flags(self, i, bits, mode):
+        current = self.flags[i]
+        if mode == '+':
+            new = current | bits
+        elif mode == '-':
+            new = current & ~bits
+        else:
+            new = bits
+        if new != current:
+            self.flags[i] = new
+            self.touch(i)
+
+    def flag_names(self, i):
+        return [name for name, bit in FLAG_BITS if self.flags[i] & bit]
+
+    def internaldate(self, i):
+        d = EPOCH + datetime.timedelta(days=self.date[i])
+        return '%02d-%s-%04d 12:00:00 +0000' % (d.day, MONTHS[d.month - 1],
+                                                d.year)
+
+    def envelope(self, i):
+        d = EPOCH + datetime.timedelta(days=self.date[i])
+        sender = self.senders[self.sender[i]]
+        recipient = self.recipients[self.recipient[i]]
+
+        def address(addr):
+            mbox, host = addr.split('@')
+            return '((NIL NIL %s %s))' % (quote(mbox), quote(host))
+
+        return '(%s %s %s %s %s %s NIL NIL NIL %s)' % (
+            quote(d.strftime('%a, %d %b %Y 12:00:00 +0000')),
+            quote(self.subjects[self.subject[i]]),
+            address(sender), address(sender), address(sender),
+            address(recipient),
+            quote('<%d@example.com>' % (i + 1)))
+
+    def header(self, i):
+        return ('From: %s\r\nTo: %s\r\nSubject: %s\r\n\r\n' % (
+            self.senders[self.sender[i]],
+            self.recipients[self.recipient[i]],
+            self.subjects[self.subject[i]]))
+
+
+class QueryError(Exception):
+    pass
+
+
+class GmailQuery(object):
+    '''A small subset of the Gmail search syntax.
+
+    Supported: bare words (matched against subject and sender),
+    ``from:``, ``to:``, ``subject:``, ``label:``, ``in:``, ``is:``,
+    ``after:``, ``before:``, negation with ``-``, ``OR``, ``{...}``
+    (any of) and ``(...)`` (all of).
+    '''
+
+    token_re = re.compile(r'\s*(\{|\}|\(|\)|-|"[^"]*"|[^\s{}()"]+)')
+
+    def __init__(self, store, query):
+        self.store = store
+        self.tokens = self.token_re.findall(query)
+        self.pos = 0
+        self.predicate = self.parse_all(None)
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+    def next(self):
+        tok = self.peek()
+        self.pos += 1
+        return tok
+
+    def parse_all(self, end):
+        terms = []
+        while self.peek() is not None and self.peek() != end:
+            term = self.parse_term()
+            if self.peek() == 'OR':
+                self.next()
+                alternatives = [term, self.parse_term()]
+                while self.peek() == 'OR':
+                    self.next()
+                    alternatives.append(self.parse_term())
+                term = self.any_of(alternatives)
+            terms.append(term)
+        if end is not None:
+            if self.next() != end:
+                raise QueryError('expected %s' % end)
+        return self.all_of(terms)
+
+    def parse_any(self):
+        terms = []
+        while self.peek() is not None and self.peek() != '}':
+            terms.append(self.parse_term())
+        if self.next() != '}':
+            raise QueryError('expected }')
+        return self.any_of(terms)
+
+    def parse_term(self):
+        tok = self.next()
+        if tok is None:
+            raise QueryError('unexpected end of query')
+        if tok == '-':
+            inner = self.parse_term()
+            return lambda i: not inner(i)
+        if tok == '{':
+            return self.parse_any()
+        if tok == '(':
+            return self.parse_all(')')
+        return self.parse_atom(tok)
+
+    @staticmethod
+    def all_of(terms):
+        return lambda i: all(t(i) for t in terms)
+
+    @staticmethod
+    def any_of(terms):
+        return lambda i: any(t(i) for t in terms)
+
+    def parse_atom(self, tok):
+        store = self.store
+        if ':' in tok:
+            key, value = tok.split(':', 1)
+        else:
+            key, value = None, tok
+        value = value.strip('"').lower()
+
+        if key == 'from':
+            return lambda i: value in store.senders[store.sender[i]]
+        elif key == 'to':
+            return lambda i: value in store.recipients[store.recipient[i]]
+        elif key == 'subject':
+            return lambda i: value in store.subjects[store.subject[i]].lower()
+        elif key == 'label':
+            return lambda i: any(value == x.lower() for x in store.labels[i])
+        elif key == 'in':
+            folder = {'inbox': 'INBOX',
+                      'trash': '[Gmail]/Trash',
+                      'anywhere': '[Gmail]/All Mail'}.get(value, value)
+            return lambda i: store.in_folder(folder, i)
+        elif key == 'is':
+            bit = {'read': 1, 'unread': 1, 'starred': 4}.get(value)
+            if bit is None:
+                raise QueryError('unsupported is: %s' % value)
+            if value == 'unread':
+                return lambda i: not store.flags[i] & bit
+            return lambda i: bool(store.flags[i] & bit)
+        elif key == 'after':
+            day = parse_date(value)
+            return lambda i: store.date[i] >= day
+        elif key == 'before':
+            day = parse_date(value)
+            return lambda i: store.date[i] < day
+        elif key is None:
+            return lambda i: (
+                value in store.subjects[store.subject[i]].lower() or
+                value in store.senders[store.sender[i]])
+        else:
+            raise QueryError('unsupported operator %s' % key)
+
+    def __call__(self, i):
+        return self.predicate(i)
+
+
+# Atoms may contain brackets (BODY.PEEK[HEADER.FIELDS (...)])
+ATOM_RE = re.compile(r'[^\s()"]+(\[[^\]]*\])?[^\s()"]*')
+
+
+def tokenize(text, literals):
+    '''Parse an IMAP command line into nested lists of strings.'''
+
+    stack = [[]]
+    pos = 0
+    while pos < len(text):
+        c = text[pos]
+        if c == ' ':
+            pos += 1
+        elif c == '(':
+            stack.append([])
+            pos += 1
+        elif c == ')':
+            inner = stack.pop()
+            stack[-1].append(inner)
+            pos += 1
+        elif c == '"':
+            end = pos + 1
+            out = []
+            while text[end] != '"':
+                if text[end] == '\\':
+                    end += 1
+                out.append(text[end])
+                end += 1
+            stack[-1].append(''.join(out))
+            pos = end + 1
+        elif c == '\x00':
+            end = text.index('\x00', pos + 1)
+            stack[-1].append(literals[int(text[pos + 1:end])])
+            pos = end + 1
+        else:
+            m = ATOM_RE.match(text, pos)
+            stack[-1].append(m.group(0))
+            pos += len(m.group(0))
+    return stack[0]
+
+
+def parse_sequence(spec, maximum):
+    '''Parse an IMAP sequence set into a list of (lo, hi) ranges.'''
+
+    ranges = []
+    for part in spec.split(','):
+        if ':' in part:
+            lo, hi = part.split(':')
+        else:
+            lo = hi = part
+        lo = maximum if lo == '*' else int(lo)
+        hi = maximum if hi == '*' else int(hi)
+        if lo > hi:
+            lo, hi = hi, lo
+        ranges.append((lo, hi))
+    return ranges
+
+
+def sequence_set(uids):
+    '''Format a sorted list of UIDs as a range-compressed sequence set.'''
+
+    parts = []
+    first = last = uids[0]
+    for uid in uids[1:]:
+        if uid != last + 1:
+            parts.append(str(first) if first == last
+                         else '%d:%d' % (first, last))
+            first = uid
+        last = uid
+    parts.append(str(first) if first == last else '%d:%d' % (first, last))
+    return ','.join(parts)
+
+
+def in_ranges(value, ranges):
+    for lo, hi in ranges:
+        if lo <= value <= hi:
+            return True
+    return False
+
+
+class BadCommand(Exception):
+    pass
+
+
+class Handler(socketserver.StreamRequestHandler):
+    '''Serves a single client connection.'''
+
+    # Responses are buffered and flushed (see flush()) after each
+    # tagged response.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.store = self.server.store
+        self.stats = self.server.stats
+        self.folder = None
+        self.members = []
+        self.readonly = False
+        self.condstore = False
+        self.pending = []
+        self.outbox = queue.Queue()
+        self.writer = threading.Thread(target=self.write_responses)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def finish(self):
+        self.outbox.put(None)
+        self.writer.join()
+        socketserver.StreamRequestHandler.finish(self)
+
+    def send(self, line):
+        data = (line + '\r\n').encode('utf-8')
+        self.stats.count('bytes_out', len(data))
+        self.pending.append(data)
+
+    def flush(self):
+        '''Pass the buffered responses to the writer thread, to be
+        delivered after the configured latency.'''
+
+        if self.pending:
+            self.outbox.put((time.time() + self.server.latency,
+                             b''.join(self.pending)))
+            self.pending = []
+
+    def write_responses(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+
+            when, data = item
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+                # Sending leaves quick ACK mode, so re-enter it for the
+                # client's next command.
+                self.quickack()
+            except (IOError, socket.error):
+                return
+
+    def quickack(self):
+        # imapclient sends a command (or a literal) and its trailing
+        # CRLF in separate writes; acknowledge immediately so that the
+        # client's Nagle algorithm does not hold back the CRLF for a
+        # delayed ACK.
+        if hasattr(socket, 'TCP_QUICKACK'):
+            self.connection.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_QUICKACK, 1)
+
+    def readline(self):
+        self.quickack()
+        line = self.rfile.readline()
+        self.stats.count('bytes_in', len(line))
+        return line
+
+    def read_command(self):
+        '''Read one command, including any literals it carries.'''
+
+        parts = []
+        literals = []
+        while True:
+            line = self.readline()
+            if not line:
+                return None
+            line = line.decode('utf-8').rstrip('\r\n')
+            m = re.search(r'\{(\d+)\}$', line)
+            if not m:
+                parts.append(line)
+                break
+            parts.append(line[:m.start()] + '\x00%d\x00' % len(literals))
+            self.send('+ go ahead')
+            self.flush()
+            self.quickack()
+            data = self.rfile.read(int(m.group(1)))
+            self.stats.count('bytes_in', len(data))
+            literals.append(data.decode('utf-8'))
+        return ''.join(parts), literals
+
+    def handle(self):
+        self.send('* OK Fake Gmail IMAP4rev1 ready')
+        self.flush()
+        while True:
+            cmd = self.read_command()
+            if cmd is None:
+                break
+            text, literals = cmd
+            tag, _, rest = text.partition(' ')
+            args = tokenize(rest, literals)
+            if not args:
+                self.send('%s BAD empty command' % tag)
+                continue
+
+            name = args.pop(0).upper()
+            if name == 'UID':
+                name = 'UID ' + args.pop(0).upper()
+            self.stats.command(name)
+
+            try:
+                if name not in ('LOGIN', 'LOGOUT', 'CAPABILITY') and \
+                        self.server.throttle():
+                    self.stats.count('throttled', 1)
+                    result = 'NO [THROTTLED] Too many commands'
+                else:
+                    result = self.dispatch(tag, name, args)
+            except (BadCommand, QueryError, ValueError, IndexError) as exc:
+                result = 'BAD %s' % exc
+
+            self.send('%s %s' % (tag, result or 'OK %s completed' % name))
+            self.flush()
+            if name == 'LOGOUT':
+                break
+
+    def dispatch(self, tag, name, args):
+        method = getattr(self, 'cmd_' + name.replace(' ', '_').lower(), None)
+        if method is None:
+            raise BadCommand('unsupported command %s' % name)
+        with self.store.lock:
+            return method(tag, args)
+
+    def cmd_capability(self, tag, args):
+        self.send('* CAPABILITY %s' % ' '.join(CAPABILITIES))
+
+    def cmd_login(self, tag, args):
+        self.send('* CAPABILITY %s' % ' '.join(CAPABILITIES))
+
+    def cmd_logout(self, tag, args):
+        self.send('* BYE logging out')
+
+    def cmd_noop(self, tag, args):
+        self.report_new()
+
+    def cmd_enable(self, tag, args):
+        if 'CONDSTORE' in [x.upper() for x in args]:
+            self.condstore = True
+        self.send('* ENABLED %s' % ' '.join(args))
+
+    def cmd_namespace(self, tag, args):
+        self.send('* NAMESPACE (("" "/")) NIL NIL')
+
+    def cmd_id(self, tag, args):
+        self.send('* ID ("name" "fakeimap")')
+
+    def cmd_list(self, tag, args):
+        pattern = args[1] if len(args) > 1 else '*'
+        regex = re.compile('^%s$' % re.escape(pattern)
+                           .replace('\\*', '.*').replace('\\%', '[^/]*'))
+        status = None
+        if len(args) > 3 and args[2].upper() == 'RETURN':
+            for i, item in enumerate(args[3]):
+                if not isinstance(item, list) and item.upper() == 'STATUS':
+                    status = args[3][i + 1]
+
+        for flags, folder in self.store.folders():
+            if regex.match(folder):
+                self.send('* LIST %s "/" %s' % (flags, quote(folder)))
+                if status is not None and '\\Noselect' not in flags:
+                    self.send_status(folder, status)
+
+    cmd_xlist = cmd_list
+
+    def send_status(self, folder, items):
+        status = self.store.status(folder)
+        self.send('* STATUS %s (%s)' % (quote(folder), ' '.join(
+            '%s %d' % (item.upper(), status[item.upper()])
+            for item in items)))
+
+    def cmd_status(self, tag, args):
+        if args[0] not in [f[1] for f in self.store.folders()]:
+            return 'NO no such folder'
+        self.send_status(args[0], args[1])
+
+    def cmd_select(self, tag, args, readonly=False):
+        folder = args[0]
+        if folder not in [f[1] for f in self.store.folders()
+                          if '\\Noselect' not in f[0]]:
+            self.folder = None
+            return 'NO [NONEXISTENT] no such folder'
+
+        if len(args) > 1 and 'CONDSTORE' in [x.upper() for x in args[1]]:
+            self.condstore = True
+
+        self.folder = folder
+        self.readonly = readonly
+        self.members = self.store.members(folder)
+        status = self.store.status(folder)
+        self.send('* FLAGS (%s)' % ' '.join(n for n, b in FLAG_BITS))
+        self.send('* OK [PERMANENTFLAGS (%s \\*)] Flags permitted.' %
+                  ' '.join(n for n, b in FLAG_BITS))
+        self.send('* OK [UIDVALIDITY %d] UIDs valid.' % status['UIDVALIDITY'])
+        self.send('* %d EXISTS' % len(self.members))
+        self.send('* 0 RECENT')
+        self.send('* OK [UIDNEXT %d] Predicted next UID.' % status['UIDNEXT'])
+        if self.condstore:
+            self.send('* OK [HIGHESTMODSEQ %d]' % status['HIGHESTMODSEQ'])
+        if self.readonly:
+            return 'OK [READ-ONLY] %s selected.' % folder
+        return 'OK [READ-WRITE] %s selected.' % folder
+
+    def cmd_examine(self, tag, args):
+        return self.cmd_select(tag, args, readonly=True)
+
+    def cmd_close(self, tag, args):
+        self.expunge(None, silent=True)
+        self.folder = None
+
+    def cmd_unselect(self, tag, args):
+        self.folder = None
+
+    def require_folder(self):
+        if self.folder is None:
+            raise BadCommand('no folder selected')
+
+    def report_new(self):
+        '''Send EXISTS if messages have arrived in the selected folder.'''
+
+        if self.folder is None:
+            return
+        last = self.members[-1] if self.members else -1
+        new = [i for i in range(last + 1, len(self.store.sender))
+               if self.store.in_folder(self.folder, i)]
+        if new:
+            self.members.extend(new)
+            self.send('* %d EXISTS' % len(self.members))
+
+    def cmd_idle(self, tag, args):
+        self.require_folder()
+        self.send('+ idling')
+        self.flush()
+
+        done = []
+
+        def wait_done():
+            line = self.readline()
+            done.append(line)
+            with self.store.lock:
+                self.store.changed.notify_all()
+
+        t = threading.Thread(target=wait_done)
+        t.daemon = True
+        t.start()
+
+        seen = len(self.store.sender)
+        while not done:
+            self.store.changed.wait(1)
+            if len(self.store.sender) != seen:
+                seen = len(self.store.sender)
+                self.report_new()
+                self.flush()
+        t.join()
+
+    def selected_uids(self, spec):
+        '''Resolve a UID sequence set against the selected folder.'''
+
+        members = self.members
+        selected = []
+        for lo, hi in parse_sequence(spec, self.store.uidnext - 1):
+            selected.extend(members[bisect.bisect_left(members, lo - 1):
+                                    bisect.bisect_right(members, hi - 1)])
+        return sorted(set(selected))
+
+    def cmd_uid_search(self, tag, args):
+        self.require_folder()
+        args = list(args)
+        esearch = False
+        if args and str(args[0]).upper() == 'RETURN':
+            args.pop(0)
+            args.pop(0)
+            esearch = True
+        if args and str(args[0]).upper() == 'CHARSET':
+            args.pop(0)
+            args.pop(0)
+
+        predicates = []
+        while args:
+            predicates.append(self.search_key(args))
+
+        uids = [i + 1 for i in self.members
+                if all(p(i) for p in predicates)]
+        if esearch:
+            if uids:
+                self.send('* ESEARCH (TAG "%s") UID ALL %s' % (
+                    tag, sequence_set(uids)))
+            else:
+                self.send('* ESEARCH (TAG "%s") UID' % tag)
+        else:
+            self.send('* SEARCH %s' % ' '.join(str(uid) for uid in uids)
+                      if uids else '* SEARCH')
+
+    def search_key(self, args):
+        '''Consume one search key from args and return a predicate.'''
+
+        store = self.store
+        item = args.pop(0)
+        if isinstance(item, list):
+            inner = list(item)
+            predicates = []
+            while inner:
+                predicates.append(self.search_key(inner))
+            return lambda i: all(p(i) for p in predicates)
+
+        key = item.upper()
+        if key == 'ALL':
+            return lambda i: True
+        elif key == 'OR':
+            left = self.search_key(args)
+            right = self.search_key(args)
+            return lambda i: left(i) or right(i)
+        elif key == 'NOT':
+            inner = self.search_key(args)
+            return lambda i: not inner(i)
+        elif key == 'UID':
+            ranges = parse_sequence(args.pop(0), store.uidnext - 1)
+            return lambda i: in_ranges(i + 1, ranges)
+        elif key == 'X-GM-RAW':
+            return GmailQuery(store, args.pop(0))
+        elif key in ('DELETED', 'UNDELETED'):
+            want = key == 'DELETED'
+            return lambda i: bool(store.flags[i] & 8) == want
+        elif key in ('SEEN', 'UNSEEN'):
+            want = key == 'SEEN'
+            return lambda i: bool(store.flags[i] & 1) == want
+        elif key == 'MODSEQ':
+            modseq = int(args.pop(0))
+            return lambda i: store.modseq[i] >= modseq
+        elif re.match(r'^[\d:*,]+$', key):
+            ranges = parse_sequence(key, len(self.members))
+            return lambda i: in_ranges(self.seq_of(i), ranges)
+        raise BadCommand('unsupported search key %s' % key)
+
+    def seq_of(self, i):
+        return bisect.bisect_left(self.members, i) + 1
+
+    def fetch_item(self, i, item):
+        store = self.store
+        key = item.upper()
+        if key == 'UID':
+            return 'UID %d' % (i + 1)
+        elif key == 'FLAGS':
+            return 'FLAGS (%s)' % ' '.join(store.flag_names(i))
+        elif key == 'X-GM-LABELS':
+            return 'X-GM-LABELS (%s)' % ' '.join(
+                x if x.startswith('\\') else quote(x)
+                for x in store.labels[i])
+        elif key == 'X-GM-MSGID':
+            return 'X-GM-MSGID %d' % (1000000000000 + i)
+        elif key == 'X-GM-THRID':
+            return 'X-GM-THRID %d' % (1000000000000 + i)
+        elif key == 'ENVELOPE':
+            return 'ENVELOPE %s' % store.envelope(i)
+        elif key == 'INTERNALDATE':
+            return 'INTERNALDATE "%s"' % store.internaldate(i)
+        elif key == 'RFC822.SIZE':
+            return 'RFC822.SIZE %d' % (1000 + i % 5000)
+        elif key == 'MODSEQ':
+            return 'MODSEQ (%d)' % store.modseq[i]
+        elif key.startswith('BODY.PEEK[HEADER') or key.startswith(
+                'BODY[HEADER'):
+            header = store.header(i)
+            return '%s {%d}\r\n%s' % (
+                key.replace('.PEEK', ''), len(header.encode('utf-8')),
+                header)
+        raise BadCommand('unsupported fetch item %s' % item)
+
+    def cmd_uid_fetch(self, tag, args):
+        self.require_folder()
+        members = self.selected_uids(args[0])
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [x for x in items if not isinstance(x, list)]
+        changedsince = None
+        if len(args) > 2:
+            modifiers = args[2]
+            if modifiers and modifiers[0].upper() == 'CHANGEDSINCE':
+                changedsince = int(modifiers[1])
+                if 'MODSEQ' not in [x.upper() for x in items]:
+                    items.append('MODSEQ')
+
+        if 'UID' not in [x.upper() for x in items]:
+            items.insert(0, 'UID')
+
+        for i in members:
+            if changedsince is not None and \
+                    self.store.modseq[i] <= changedsince:
+                continue
+            self.send('* %d FETCH (%s)' % (
+                self.seq_of(i),
+                ' '.join(self.fetch_item(i, x) for x in items)))
+
+    def cmd_fetch(self, tag, args):
+        self.require_folder()
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        for lo, hi in parse_sequence(args[0], len(self.members)):
+            for seq in range(max(lo, 1), min(hi, len(self.members)) + 1):
+                i = self.members[seq - 1]
+                self.send('* %d FETCH (%s)' % (
+                    seq, ' '.join(self.fetch_item(i, x) for x in items)))
+
+    def cmd_uid_store(self, tag, args):
+        self.require_folder()
+        if self.readonly:
+            return 'NO mailbox is read-only'
+
+        members = self.selected_uids(args[0])
+        action = args[1].upper()
+        values = args[2] if isinstance(args[2], list) else [args[2]]
+        silent = action.endswith('.SILENT')
+        action = action.replace('.SILENT', '')
+        mode = action[0] if action[0] in '+-' else ''
+        what = action.lstrip('+-')
+
+        store = self.store
+        for i in members:
+            if what == 'X-GM-LABELS':
+                labels = [self.normalise_label(x) for x in values]
+                if mode == '+':
+                    store.add_labels(i, labels)
+                elif mode == '-':
+                    store.remove_labels(i, labels)
+                else:
+                    store.remove_labels(i, store.labels[i])
+                    store.add_labels(i, labels)
+            elif what == 'FLAGS':
+                bits = 0
+                for name, bit in FLAG_BITS:
+                    if name.lower() in [x.lower() for x in values]:
+                        bits |= bit
+                store.set_flags(i, bits, mode)
+            else:
+                raise BadCommand('unsupported store item %s' % what)
+
+            if not silent:
+                self.send('* %d FETCH (UID %d %s)' % (
+                    self.seq_of(i), i + 1, self.fetch_item(i, what)))
+
+    @staticmethod
+    def normalise_label(label):
+        special = {'\\inbox': '\\Inbox', '\\trash': '\\Trash',
+                   '\\important': '\\Important', '\\starred': '\\Starred'}
+        return special.get(label.lower(), label)
+
+    def expunge(self, ranges, silent=False):
+        store = self.store
+        remaining = []
+        expunged = []
+        for seq, i in enumerate(self.members):
+            if store.flags[i] & 8 and (
+                    ranges is None or in_ranges(i + 1, ranges)):
+                expunged.append(seq + 1)
+                if self.folder in ('[Gmail]/All Mail', '[Gmail]/Trash'):
+                    store.expunged[i] = 1
+                elif self.folder == 'INBOX':
+                    store.remove_labels(i, ['\\Inbox'])
+                    store.set_flags(i, 8, '-')
+                else:
+                    store.remove_labels(i, [self.folder])
+                    store.set_flags(i, 8, '-')
+            else:
+                remaining.append(i)
+        self.members = remaining
+        if not silent:
+            # sequence numbers shift down as each message is removed
+            for n, seq in enumerate(expunged):
+                self.send('* %d EXPUNGE' % (seq - n))
+
+    def cmd_expunge(self, tag, args):
+        self.require_folder()
+        self.expunge(None)
+
+    def cmd_uid_expunge(self, tag, args):
+        self.require_folder()
+        self.expunge(parse_sequence(args[0], self.store.uidnext - 1))
+
+
+class Stats(object):
+    '''Counts commands and bytes seen by a server.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.counters = {'bytes_in': 0, 'bytes_out': 0, 'throttled': 0}
+
+    def command(self, name):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            out = dict(self.counters)
+            out['commands'] = dict(self.commands)
+            out['total_commands'] = sum(self.commands.values())
+            return out
+
+
+class FakeGmailServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''A threaded IMAP server bound to localhost.
+
+    Use as a context manager; the server runs in a background thread
+    and listens on ``server.port``.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, latency=0, host='127.0.0.1', port=0,
+                 max_rate=None):
+        socketserver.TCPServer.__init__(self, (host, port), Handler)
+        self.store = store
+        self.latency = latency
+        self.max_rate = max_rate
+        self.recent = []
+        self.recent_lock = threading.Lock()
+        self.stats = Stats()
+        self.thread = None
+
+    def throttle(self):
+        '''Return whether to refuse a command because more than max_rate
+        commands (across all connections, as Gmail counts them per
+        account) have arrived in the last second.'''
+
+        if not self.max_rate:
+            return False
+
+        with self.recent_lock:
+            now = time.time()
+            self.recent = [t for t in self.recent if now - t < 1]
+            if len(self.recent) >= self.max_rate:
+                return True
+            self.recent.append(now)
+            return False
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def account(self):
+        '''Return an account entry suitable for a gmf config file.'''
+
+        return {
+            'host': '127.0.0.1',
+            'port': self.port,
+            'ssl': False,
+            'username': 'user@example.com',
+            'password': 'secret',
+        }
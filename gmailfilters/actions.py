@@ -0,0 +1,100 @@
+import collections
+
+from gmailfilters.uidset import UIDSet
+
+
+class Actions(collections.namedtuple('Actions', [
+        'add_labels', 'remove_labels', 'add_flags', 'remove_flags',
+        'delete'])):
+    '''The label and flag changes to make to a message.'''
+
+    __slots__ = ()
+
+    def __new__(cls, add_labels=(), remove_labels=(), add_flags=(),
+                remove_flags=(), delete=False):
+        return super(Actions, cls).__new__(
+            cls,
+            frozenset(add_labels),
+            frozenset(remove_labels),
+            frozenset(add_flags),
+            frozenset(remove_flags),
+            bool(delete))
+
+    def merge(self, other):
+        '''Return the combined effect of self and other.'''
+
+        return Actions(self.add_labels | other.add_labels,
+                       self.remove_labels | other.remove_labels,
+                       self.add_flags | other.add_flags,
+                       self.remove_flags | other.remove_flags,
+                       self.delete or other.delete)
+
+    def __nonzero__(self):
+        return any([self.add_labels, self.remove_labels, self.add_flags,
+                    self.remove_flags, self.delete])
+
+    __bool__ = __nonzero__
+
+
+class Planner(object):
+    '''Collects the combined actions of every filter that matches
+    each message, so that messages needing the same change can be
+    updated with a single STORE.'''
+
+    def __init__(self):
+        self.planned = {}
+        self.merged = {}
+
+    def add(self, messages, actions):
+        planned = self.planned
+        merged = self.merged
+        for msg in messages:
+            current = planned.get(msg)
+            if current is None:
+                planned[msg] = actions
+            elif current != actions:
+                # Most messages end up with one of a small number of
+                # combinations, so reuse the merged Actions objects.
+                key = (current, actions)
+                if key not in merged:
+                    merged[key] = current.merge(actions)
+                planned[msg] = merged[key]
+
+    def __len__(self):
+        return len(self.planned)
+
+    def messages(self, delete=None):
+        '''Return a UIDSet of the planned messages, or (if delete is not
+        None) only of those whose actions do or do not include
+        deletion.'''
+
+        if delete is None:
+            return UIDSet(self.planned)
+
+        return UIDSet(msg for msg, actions in self.planned.items()
+                      if actions.delete == delete)
+
+    def discard(self, messages):
+        '''Forget the actions planned for messages.'''
+
+        for msg in messages:
+            self.planned.pop(msg, None)
+
+    def operations(self):
+        '''Return a list of (action, value, messages) tuples, one for
+        each distinct value of each action field, where messages is a
+        UIDSet.  Messages that need the same change share a single
+        operation, however the rest of their actions differ.
+        Operations are ordered by field (so deletions come last) and
+        then by first message.'''
+
+        operations = {}
+        for msg, actions in self.planned.items():
+            for action, value in zip(actions._fields, actions):
+                if value:
+                    operations.setdefault((action, value), []).append(msg)
+
+        return sorted(((action, value, UIDSet(messages))
+                       for (action, value), messages in operations.items()),
+                      key=lambda op: (Actions._fields.index(op[0]),
+                                      op[2][0]))
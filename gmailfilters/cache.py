@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import os
+import sys
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from gmailfilters import default
+from gmailfilters.util import atomic_write
+
+LOG = logging.getLogger(__name__)
+
+# Increment this whenever the structure of cached values changes, so
+# that caches written by older versions are ignored.
+version = 1
+
+
+class CompiledCache(object):
+    '''Caches the result of compiling a file (such as the filters for
+    apply-filters) so that it does not need to be parsed and compiled
+    again until the file changes.
+
+    Each source file has its own cache file, named after a hash of the
+    file's absolute path.  A cached value is used only if the source
+    file's mtime and size, the options it was compiled with, the cache
+    version and the Python version all match those it was saved with.'''
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = default.cache_dir
+
+        self.cache_dir = cache_dir
+
+    def cache_path(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+        return os.path.join(self.cache_dir, name.hexdigest() + '.pickle')
+
+    def key(self, path, options):
+        st = os.stat(path)
+        return (version, sys.version_info[:2], os.path.abspath(path),
+                st.st_mtime, st.st_size, options)
+
+    def get(self, path, options, build):
+        '''Return the value compiled from path with options, calling
+        build(path) and caching its result if there is no valid cached
+        value.'''
+
+        # The key is computed before the file is read, so that changes
+        # made while it is being compiled invalidate the cache.
+        key = self.key(path, options)
+        value = self.load(path, key)
+        if value is None:
+            value = build(path)
+            self.save(path, key, value)
+
+        return value
+
+    def load(self, path, key):
+        cache_path = self.cache_path(path)
+        try:
+            with open(cache_path, 'rb') as fd:
+                cached_key, value = pickle.load(fd)
+        except Exception as exc:
+            # A missing, unreadable or corrupt cache file just means
+            # the source needs to be compiled again.
+            LOG.debug('no usable cache for %s: %s', path, exc)
+            return None
+
+        if cached_key != key:
+            LOG.debug('cache for %s is out of date', path)
+            return None
+
+        LOG.debug('using cache for %s from %s', path, cache_path)
+        return value
+
+    def save(self, path, key, value):
+        '''Failing to write the cache is not an error.'''
+
+        cache_path = self.cache_path(path)
+        try:
+            with atomic_write(cache_path, 'wb') as fd:
+                pickle.dump((key, value), fd, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError) as exc:
+            LOG.warning('failed to write cache for %s: %s', path, exc)
+            return
+
+        LOG.debug('wrote cache for %s to %s', path, cache_path)
@@ -1,15 +1,21 @@
-import argparse
-import cliff.command
-import imapclient
+import hashlib
 import imaplib
-import yaml
+import os
+import time
 
 from gmailfilters import exceptions
 from gmailfilters import default
-from gmailfilters.cmd.baseclient import BaseClientCommand
-from gmailfilters.util import chunker
+from gmailfilters.actions import Actions, Planner
+from gmailfilters.cache import CompiledCache
+from gmailfilters.cmd.baseclient import BaseClientCommand, uid_fetch
+from gmailfilters.state import StateFile
+from gmailfilters.uidset import UIDSet
+from gmailfilters.util import load_yaml
+
 
 class ApplyFilters(BaseClientCommand):
+    mirror = None
+
     def get_parser(self, prog_name):
         p = super(ApplyFilters, self).get_parser(prog_name)
 
@@ -17,6 +23,33 @@ class ApplyFilters(BaseClientCommand):
         g.add_argument('--skip-smartlabels', '-S',
                        action='store_true',
                        help='Ignore smartlabel filters')
+        g.add_argument('--no-consolidate',
+                       action='store_true',
+                       help='Search for each filter separately, rather than '
+                       'combining filters that have the same actions')
+        g.add_argument('--max-query-length',
+                       default=default.max_query_length,
+                       type=int,
+                       help='Longest query to build when combining filters')
+        g.add_argument('--no-cache',
+                       action='store_true',
+                       help='Always read and compile the filters, rather '
+                       'than using the compiled filters from an earlier run')
+        g.add_argument('--cache-dir',
+                       default=default.cache_dir,
+                       help='Where to keep compiled filters')
+        g.add_argument('--local-eval',
+                       action='store_true',
+                       help='Keep a local mirror of message headers, labels '
+                       'and flags, and evaluate simple from, to and subject '
+                       'filters against it instead of searching the server')
+        g.add_argument('--incremental', '-i',
+                       action='store_true',
+                       help='Only process messages that are new (or, with '
+                       'CONDSTORE, changed) since the last incremental run')
+        g.add_argument('--state-dir',
+                       default=default.state_dir,
+                       help='Where to keep checkpoints for --incremental')
 
         p.add_argument('filters',
                        help='Filters in YAML syntax')
@@ -25,12 +58,16 @@ class ApplyFilters(BaseClientCommand):
 
         return p
 
+    def input_paths(self, args):
+        return super(ApplyFilters, self).input_paths(args) + [args.filters]
+
     def build_filters(self, filters):
         _filters = []
         for filter in filters:
             _query = []
             if 'hasTheWord' in filter:
-                if '^smartlabel' in filter['hasTheWord'] and self.args.skip_smartlabels:
+                smartlabel = '^smartlabel' in filter['hasTheWord']
+                if smartlabel and self.args.skip_smartlabels:
                     continue
 
                 _query.append(filter['hasTheWord'])
@@ -41,32 +78,195 @@ class ApplyFilters(BaseClientCommand):
 
             _query = ' '.join(_query)
             filter['query'] = _query
+            filter['actions'] = self.build_actions(filter)
             _filters.append(filter)
 
         return _filters
 
-    def take_action(self, args):
-        self.args = args
+    def consolidate_filters(self, filters):
+        '''Combine filters that have the same actions into a single
+        filter whose query matches any of theirs ({q1 q2 ...} in Gmail
+        syntax), so that each folder needs fewer searches.  Combined
+        queries are kept under --max-query-length characters.  The
+        original queries are kept in the 'queries' key.'''
 
-        try:
-            account = self.app.config['accounts'][args.account]
-        except (TypeError, KeyError):
-            raise exceptions.NoSuchAccount(
-                'Unable to find account named "%s"' % args.account)
+        groups = []
+        by_actions = {}
+        for filter in filters:
+            if not filter['actions'] or not filter['query']:
+                groups.append([filter])
+                continue
+
+            group = by_actions.get(filter['actions'])
+            if group is None:
+                group = by_actions[filter['actions']] = []
+                groups.append(group)
+            group.append(filter)
+
+        _filters = []
+        for group in groups:
+            if len(group) == 1:
+                _filters.append(group[0])
+                continue
+
+            queries = []
+            length = 0
+            for filter in group:
+                term = filter['query']
+                if ' ' in term:
+                    term = '(%s)' % term
+
+                if queries and \
+                        length + len(term) + 3 > self.args.max_query_length:
+                    _filters.append(self.combine_queries(
+                        queries, group[0]['actions']))
+                    queries = []
+                    length = 0
 
-        with open(args.filters) as fd:
-            filters = yaml.safe_load(fd)
+                queries.append((term, filter['query']))
+                length += len(term) + 1
 
-        self.filters = self.build_filters(filters)
+            _filters.append(self.combine_queries(
+                queries, group[0]['actions']))
 
-        self.server = imapclient.IMAPClient(account['host'],
-                                            use_uid=True,
-                                            ssl=account.get('ssl', True))
-        self.server.debug = args.debug_imap
+        if len(_filters) < len(filters):
+            self.app.LOG.info('combined %d filters into %d searches '
+                              '(%d fewer searches per folder)',
+                              len(filters), len(_filters),
+                              len(filters) - len(_filters))
 
-        self.server.login(account['username'], account['password'])
+        return _filters
+
+    def combine_queries(self, queries, actions):
+        '''Build a filter from a list of (term, query) pairs that share
+        the same actions.'''
+
+        if len(queries) == 1:
+            query = queries[0][1]
+        else:
+            query = '{%s}' % ' '.join(term for term, _ in queries)
+
+        return {
+            'query': query,
+            'queries': [q for _, q in queries],
+            'actions': actions,
+        }
 
-        selected_folders = self.select_folders(args.folders)
+    def build_actions(self, filter):
+        '''Translate the actions in a filter into an Actions object.'''
+
+        import imapclient
+
+        add_labels = []
+        remove_labels = []
+        add_flags = []
+        delete = False
+
+        for k, v in filter.items():
+            if k in ['query', 'hasTheWord', 'to', 'from', 'subject']:
+                continue
+            elif k == 'label':
+                add_labels.extend(v.split())
+            elif k == 'shouldMarkAsread' and v:
+                add_flags.append(imapclient.SEEN)
+            elif k == 'shouldArchive' and v:
+                remove_labels.append('\\Inbox')
+            elif k == 'shouldTrash' and v:
+                delete = True
+            else:
+                self.app.LOG.warn('ignoring unsupported action: %s (%s)',
+                                  k, v)
+
+        return Actions(add_labels=add_labels,
+                       remove_labels=remove_labels,
+                       add_flags=add_flags,
+                       delete=delete)
+
+    def compile_filters(self, path):
+        '''Read the filters from path and build their queries and
+        actions.  Return the filters and their digest.'''
+
+        self.app.LOG.info('compiling filters from %s', path)
+        with open(path) as fd:
+            filters = self.build_filters(load_yaml(fd))
+
+        return filters, self.digest_filters(filters)
+
+    def digest_filters(self, filters):
+        '''Return a digest of the queries and actions in filters, so that
+        incremental runs can tell when the filters have changed.'''
+
+        digest = hashlib.sha1()
+        for filter in filters:
+            actions = [sorted(value) if isinstance(value, frozenset)
+                       else value for value in filter['actions']]
+            digest.update(repr((filter['query'], actions)).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def connect(self):
+        server = super(ApplyFilters, self).connect()
+        if (self.args.incremental or self.args.local_eval) and \
+                server.has_capability('CONDSTORE'):
+            server.enable('CONDSTORE')
+
+        return server
+
+    def prepare(self):
+        args = self.args
+
+        if args.no_cache:
+            self.filters, self.filters_digest = self.compile_filters(
+                args.filters)
+        else:
+            cache = CompiledCache(args.cache_dir)
+            self.filters, self.filters_digest = cache.get(
+                args.filters, (args.skip_smartlabels,),
+                self.compile_filters)
+
+        self.local_filters = []
+        if args.local_eval:
+            self.local_filters, self.filters = self.split_filters(
+                self.filters)
+
+        if not args.no_consolidate:
+            self.filters = self.consolidate_filters(self.filters)
+
+    def split_filters(self, filters):
+        '''Separate the filters that can be evaluated against the local
+        mirror from those that the server must search for.  Return a
+        list of (conditions, filter) pairs and a list of filters.'''
+
+        from gmailfilters.mirror import local_conditions
+
+        local = []
+        remote = []
+        for filter in filters:
+            conditions = local_conditions(filter)
+            if conditions is None:
+                remote.append(filter)
+            else:
+                local.append((conditions, filter))
+
+        self.app.LOG.info('evaluating %d of %d filters locally',
+                          len(local), len(filters))
+        return local, remote
+
+    def process_account(self):
+        self.state = None
+        if self.args.incremental:
+            self.state = StateFile.for_account(self.account_name,
+                                               self.args.state_dir)
+
+        self.mirror = None
+        if self.local_filters:
+            from gmailfilters.mirror import Mirror
+            self.mirror = Mirror(os.path.join(
+                self.args.cache_dir, 'mirror-%s.sqlite' % self.account_name))
+
+        self.server = self.connect()
+
+        selected_folders = self.select_folders(self.args.folders)
         if not selected_folders:
             raise exceptions.NoMatchingFolders('No folders to process')
 
@@ -79,42 +279,342 @@ class ApplyFilters(BaseClientCommand):
             info = self.server.select_folder(folder)
         except imaplib.IMAP4.error as exc:
             self.app.LOG.error('failed to select %s (%s): %s',
-                          folder, type(exc), exc)
+                               folder, type(exc), exc)
             return
 
+        checkpoint = None
+        criteria = None
+        if self.state is not None:
+            checkpoint = self.make_checkpoint(info)
+            criteria = self.incremental_criteria(
+                folder, self.state.get(folder), checkpoint)
+            if criteria is False:
+                self.app.LOG.info('%s is unchanged since the last run',
+                                  folder)
+                return
+
+        if self.mirror is not None:
+            self.sync_mirror(folder, info)
+
+        # The messages deleted from each shard are expunged together
+        # once all of the shards are done.
+        deleted = []
+        if self.args.shard:
+            self.process_shards(
+                folder, info, bool(self.filters),
+                lambda shard: self.process_shard(folder, shard, criteria,
+                                                 deleted))
+        else:
+            self.process_shard(folder, None, criteria, deleted)
+
+        messages = UIDSet()
+        for x in deleted:
+            messages = messages | x
+        self.expunge_messages(folder, messages)
+
+        if checkpoint is not None:
+            self.save_checkpoint(folder, checkpoint)
+
+    def process_shard(self, folder, shard, criteria, deleted):
+        '''Apply the filters to the messages in shard of the selected
+        folder (or, if shard is None, to the whole folder), appending
+        the UIDs of the messages that they deleted, which are still to
+        be expunged, to deleted.  Return the number of messages that
+        they matched.'''
+
+        planner = self.plan_folder(folder, criteria, shard)
+        if self.seen is not None:
+            self.discard_seen(folder, planner)
+
+        deleted.append(self.apply_plan(folder, planner))
+        return len(planner)
+
+    def discard_seen(self, folder, planner):
+        '''Drop the messages that were already processed in another
+        folder from planner.'''
+
+        # Deleting a message only removes it from the folder it is
+        # found in, so messages that are to be deleted are never
+        # skipped.
+        candidates = planner.messages(delete=False)
+        planner.discard(candidates - self.unseen_messages(folder, candidates))
+
+    def apply_plan(self, folder, planner):
+        '''Make the changes collected in planner to the messages in the
+        selected folder.  Return the UIDs of the messages that were
+        deleted, which the caller must expunge (see expunge_messages)
+        once it is done with the folder.'''
+
+        operations = planner.operations()
+        self.app.LOG.info('applying %d operations to %d messages in %s',
+                          len(operations), len(planner), folder)
+
+        current = None
+        if operations:
+            current = self.current_state(folder, planner.messages())
+
+        # Deleted messages are left for the caller to expunge once all
+        # of the operations are done, so that the folder is not
+        # renumbered while they are in progress.
+        deleted = UIDSet()
+        for action, value, messages in operations:
+            for chunk in self.chunks(messages):
+                self.store_messages(folder, action, value, chunk, current)
+            if action == 'delete':
+                deleted = deleted | messages
+        self.wait_stores()
+        return deleted
+
+    def current_state(self, folder, messages):
+        '''With --skip-noop, return the current labels and flags of
+        messages, from the mirror (which has just been synchronized) if
+        there is one, or otherwise from the server.'''
+
+        if not self.args.skip_noop or self.mirror is None:
+            return self.fetch_current(folder, messages)
+
+        from gmailfilters.delta import CurrentState
+
+        current = CurrentState(folder)
+        for uid, labels, flags in self.mirror.labels_and_flags_of(
+                self.mirror.folder(folder), messages):
+            current.add(uid, labels, flags)
+
+        return current
+
+    def make_checkpoint(self, info):
+        '''Build a checkpoint from the response to select_folder.'''
+
+        checkpoint = {
+            'filters': self.filters_digest,
+            'uidvalidity': info[b'UIDVALIDITY'],
+            'uidnext': info[b'UIDNEXT'],
+        }
+        if b'HIGHESTMODSEQ' in info:
+            checkpoint['highestmodseq'] = info[b'HIGHESTMODSEQ']
+
+        return checkpoint
+
+    def save_checkpoint(self, folder, checkpoint):
+        '''Record checkpoint for folder once it has been processed.
+
+        HIGHESTMODSEQ is fetched again first, so that the next run does
+        not search the messages that this run just changed.  (Changes
+        made by anything else while this run was in progress are missed
+        until those messages change again.)'''
+
+        if 'highestmodseq' in checkpoint:
+            status = self.server.folder_status(folder, [b'HIGHESTMODSEQ'])
+            if b'HIGHESTMODSEQ' in status:
+                checkpoint['highestmodseq'] = status[b'HIGHESTMODSEQ']
+
+        self.state.update(folder, checkpoint)
+
+    def folder_unchanged(self, folder, status):
+        '''With --incremental, a folder whose status matches its
+        checkpoint has not changed since the last run.'''
+
+        if self.state is None:
+            return False
+
+        previous = self.state.get(folder)
+        if previous is None:
+            return False
+
+        current = self.make_checkpoint(status)
+        if any(previous.get(key) != current[key]
+               for key in ['uidvalidity', 'filters']):
+            return False
+
+        if previous['uidnext'] < current['uidnext']:
+            return False
+
+        if 'highestmodseq' in previous and 'highestmodseq' in current:
+            return previous['highestmodseq'] == current['highestmodseq']
+
+        return True
+
+    def incremental_criteria(self, folder, previous, current):
+        '''Compare the previous checkpoint for a folder with the current
+        one.  Return None if the whole folder needs to be searched, False
+        if nothing has changed, or otherwise search criteria that select
+        messages that are new or modified since the previous run.'''
+
+        if previous is None:
+            self.app.LOG.info('no checkpoint for %s; searching all messages',
+                              folder)
+            return None
+
+        for key, reason in [('uidvalidity', 'UIDVALIDITY has changed'),
+                            ('filters', 'filters have changed')]:
+            if previous.get(key) != current[key]:
+                self.app.LOG.info('%s for %s; searching all messages',
+                                  reason, folder)
+                return None
+
+        new = previous['uidnext'] < current['uidnext']
+        if 'highestmodseq' in previous and 'highestmodseq' in current:
+            if not new and \
+                    previous['highestmodseq'] == current['highestmodseq']:
+                return False
+
+            self.app.LOG.info('searching messages in %s with UID >= %d '
+                              'or MODSEQ > %d', folder, previous['uidnext'],
+                              previous['highestmodseq'])
+            # MODSEQ n matches mod-sequences of n or more.
+            return ['OR',
+                    'UID', '%d:*' % previous['uidnext'],
+                    'MODSEQ', previous['highestmodseq'] + 1]
+
+        if not new:
+            return False
+
+        self.app.LOG.info('searching messages in %s with UID >= %d',
+                          folder, previous['uidnext'])
+        return ['UID', '%d:*' % previous['uidnext']]
+
+    def plan_folder(self, folder, criteria=None, shard=None):
+        '''Search the selected folder (or shard of it) with each filter
+        (restricted by any additional search criteria) and collect the
+        combined actions for every matching message.'''
+
+        planner = Planner()
+        if self.local_filters:
+            self.plan_local(folder, planner, criteria, shard)
+
+        where = folder
+        if shard is not None:
+            where = '%s (%s)' % (folder, shard)
+
         for filter in self.filters:
+            if not filter['actions']:
+                self.app.LOG.debug('skipping filter with no actions: %s',
+                                   filter['query'])
+                continue
+
+            query, restricted = filter['query'], criteria
+            if shard is not None:
+                query, restricted = shard.restrict(query, criteria)
+
             self.app.LOG.info('selecting messages in %s matching: %s',
-                          folder, filter['query'])
-            messages = self.server.gmail_search(filter['query'])
+                              where, filter['query'])
+            with self.stats.scope(filter=filter['query']):
+                messages = self.search(query, restricted)
             self.app.LOG.info('found %d messages', len(messages))
+            planner.add(messages, filter['actions'])
 
-            for chunk in chunker(messages, self.args.chunksize):
-                self.process_messages(folder, filter, chunk)
+        return planner
 
-    def process_messages(self, folder, filter, chunk):
-        for k, v in filter.items():
-            if k in ['query', 'hasTheWord', 'to', 'from', 'subject']:
+    def plan_local(self, folder, planner, criteria=None, shard=None):
+        '''Evaluate the local filters against the mirror of folder,
+        restricted (if there are search criteria, or a shard) to the
+        messages that the server finds with the criteria in the
+        shard.'''
+
+        record = self.mirror.folder(folder)
+        candidates = None
+        if shard is not None:
+            candidates = self.search(*shard.restrict(None, criteria))
+        elif criteria is not None:
+            candidates = self.search(None, criteria)
+
+        start = time.time()
+        for conditions, filter in self.local_filters:
+            if not filter['actions']:
                 continue
-            elif k == 'label':
-                labels = v.split()
-                self.app.LOG.info('labelling messages %d...%d from %s (%s)',
-                             chunk[0], chunk[-1], folder, labels)
-                res = self.server.add_gmail_labels(chunk, labels)
-            elif k == 'shouldMarkAsread' and v:
-                self.app.LOG.info('marking messages %d...%d as read from %s',
-                             chunk[0], chunk[-1], folder)
-                res = self.server.add_flags(chunk, imapclient.SEEN)
-            elif k == 'shouldArchive' and v:
-                self.app.LOG.info('archiving messages %d...%d as read from %s',
-                             chunk[0], chunk[-1], folder)
-                res = self.server.remove_gmail_labels(chunk, '\\Inbox')
-            elif k == 'shouldTrash' and v:
-                self.app.LOG.info('deleting messages %d...%d from %s',
-                             chunk[0], chunk[-1], folder)
-                res = self.server.delete_messages(chunk)
-                self.app.LOG.info('expunging messages %d...%d from %s',
-                                  chunk[0], chunk[-1], folder)
-                self.server.expunge()
-            else:
-                self.app.LOG.warn('ignoring unsupported action: %s (%s)',
-                                  k, v)
+
+            messages = self.mirror.evaluate(record, conditions)
+            if candidates is not None:
+                messages = messages & candidates
+            self.app.LOG.debug('found %d messages matching %s locally',
+                               len(messages), filter['query'])
+            planner.add(messages, filter['actions'])
+
+        self.app.LOG.info('evaluated %d filters against the mirror of %s '
+                          'in %.3f seconds', len(self.local_filters), folder,
+                          time.time() - start)
+
+    def sync_mirror(self, folder, info):
+        '''Bring the mirror of the selected folder up to date.  New
+        messages are added and expunged ones removed.  With CONDSTORE,
+        the labels and flags of messages changed since the last sync are
+        updated; without it, those of every message are.'''
+
+        mirror = self.mirror
+        uidvalidity = info[b'UIDVALIDITY']
+        highestmodseq = info.get(b'HIGHESTMODSEQ')
+
+        record = mirror.folder(folder)
+        if record is not None and record.uidvalidity != uidvalidity:
+            self.app.LOG.info('UIDVALIDITY of %s has changed; rebuilding '
+                              'its mirror', folder)
+            record = None
+
+        if record is None:
+            record = mirror.reset_folder(folder, uidvalidity)
+            known = UIDSet()
+        else:
+            known = mirror.uids(record)
+
+        current = self.search(None)
+        new = current - known
+        gone = known - current
+        kept = known & current
+
+        mirror.remove_messages(record, gone)
+
+        # Messages are committed a chunk at a time, so that an
+        # interrupted sync does not have to fetch them again.
+        for chunk in self.chunks(new, 'fetch'):
+            with self.chunk_sizers['fetch'].measure(len(chunk)):
+                res = uid_fetch(self.server, chunk, [
+                    'ENVELOPE', 'X-GM-MSGID', 'X-GM-LABELS', 'FLAGS'])
+            mirror.add_messages(record, res)
+            mirror.commit()
+
+        changed = 0
+        if highestmodseq is not None and record.highestmodseq is not None:
+            if kept and highestmodseq != record.highestmodseq:
+                res = uid_fetch(
+                    self.server, '1:*', ['X-GM-LABELS', 'FLAGS'],
+                    modifiers=['CHANGEDSINCE %d' % record.highestmodseq])
+                res = dict((uid, msg) for uid, msg in res.items()
+                           if uid in kept)
+                mirror.update_messages(record, res)
+                changed = len(res)
+        else:
+            for chunk in self.chunks(kept, 'fetch'):
+                with self.chunk_sizers['fetch'].measure(len(chunk)):
+                    res = uid_fetch(self.server, chunk,
+                                    ['X-GM-LABELS', 'FLAGS'])
+                mirror.update_messages(record, res)
+                changed += len(res)
+
+        mirror.set_highestmodseq(record, highestmodseq)
+        mirror.commit()
+        self.app.LOG.info('synchronized mirror of %s: %d new, %d expunged '
+                          'and %d updated messages', folder, len(new),
+                          len(gone), changed)
+
+    def store_messages(self, folder, action, value, chunk, current=None):
+        if action == 'add_labels':
+            labels = sorted(value)
+            self.app.LOG.info('labelling messages %d...%d from %s (%s)',
+                              chunk[0], chunk[-1], folder, labels)
+            self.store('add_gmail_labels', chunk, labels, current)
+        elif action == 'add_flags':
+            self.app.LOG.info('marking messages %d...%d as read from %s',
+                              chunk[0], chunk[-1], folder)
+            self.store('add_flags', chunk, sorted(value), current)
+        elif action == 'remove_labels':
+            self.app.LOG.info('archiving messages %d...%d from %s',
+                              chunk[0], chunk[-1], folder)
+            self.store('remove_gmail_labels', chunk, sorted(value),
+                       current)
+        elif action == 'delete':
+            self.app.LOG.info('deleting messages %d...%d from %s',
+                              chunk[0], chunk[-1], folder)
+            self.store('delete_messages', chunk, current=current)
+        else:
+            self.app.LOG.warn('ignoring unsupported action: %s (%s)',
+                              action, value)
@@ -1,18 +1,239 @@
+import abc
+import argparse
 import cliff.command
+import collections
+import cProfile
+import datetime
 import fnmatch
+import imaplib
+import multiprocessing
+import os
+import re
+import socket
+import sys
+import threading
+import time
 
 from gmailfilters import default
+from gmailfilters import exceptions
+from gmailfilters.instrument import Stats
+from gmailfilters.pool import ConnectionPool
+from gmailfilters.seen import SeenSet
+from gmailfilters.uidset import UIDSet
+from gmailfilters.util import ChunkSizer, chunker
+
+# imapclient (and everything else that is only needed to talk to the
+# server) is imported where it is used, so that loading the commands
+# (for example, for "gmf --help") stays fast.
+
+# The command being run, for worker processes started by
+# process_accounts (which inherit it when they are forked).
+_command = None
+
+
+def count(value):
+    '''Parse an argument that is a number of messages, which must be
+    at least 1.'''
+
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
+
+
+def chunksize(value):
+    '''Parse the argument to --chunksize, which is either a number of
+    messages or "auto".'''
+
+    if value == 'auto':
+        return value
+
+    return count(value)
+
+
+def run_account(name):
+    return _command.run_account(name)
+
+
+def transient_error(exc):
+    '''Return whether exc is likely to go away if the command that
+    raised it is retried over a new connection: a dropped connection,
+    or Gmail throttling or being temporarily unavailable.  Other NO and
+    BAD responses (such as for an invalid label or a read-only folder)
+    are permanent.'''
+
+    if isinstance(exc, (imaplib.IMAP4.abort, socket.error)):
+        return True
+
+    if isinstance(exc, exceptions.StoreFailed):
+        return any(transient_error(x) for x in exc.errors)
+
+    if isinstance(exc, imaplib.IMAP4.error):
+        message = str(exc).upper()
+        return '[THROTTLED]' in message or '[UNAVAILABLE]' in message
+
+    return False
+
+
+def uid_fetch(server, messages, items, modifiers=None):
+    '''Fetch items for messages (a UIDSet, or a sequence set such as
+    "1:*") and return the parsed responses by UID, as IMAPClient.fetch
+    does.  The messages are sent as a compressed sequence set, which
+    IMAPClient 3 and later no longer accept from fetch().'''
+
+    from imapclient.imapclient import join_message_ids
+    from imapclient.imapclient import seq_to_parenstr_upper
+    from imapclient.response_parser import parse_fetch_response
+
+    if not messages:
+        return {}
+
+    if not isinstance(messages, str):
+        messages = messages.sequence_set()
+
+    imap = server._imap
+    tag = imap._command(
+        'UID', 'FETCH', join_message_ids(messages),
+        seq_to_parenstr_upper(items),
+        seq_to_parenstr_upper(modifiers) if modifiers else None)
+    typ, data = imap._command_complete('FETCH', tag)
+    server._checkok('fetch', typ, data)
+    typ, data = imap._untagged_response(typ, data, 'FETCH')
+    return parse_fetch_response(data, server.normalise_times, True)
+
+
+def parse_status(data):
+    '''Parse untagged STATUS responses into a dictionary mapping each
+    folder name to a dictionary of its status items (such as
+    b'MESSAGES'), as returned by IMAPClient.folder_status.'''
+
+    from imapclient import imap_utf7
+    from imapclient.response_parser import parse_response
+
+    parsed = parse_response([x for x in data if x not in (b'', None)])
+    statuses = {}
+    for name, items in zip(parsed[::2], parsed[1::2]):
+        if isinstance(name, int):
+            # Folder names that look like numbers are parsed as numbers.
+            name = str(name)
+        else:
+            name = imap_utf7.decode(name)
+        statuses[name] = dict(zip(items[::2], items[1::2]))
+
+    return statuses
+
 
 class BaseClientCommand(cliff.command.Command):
+    _server = None
+    seen = None
+    governor = None
+
+    def __init__(self, *args, **kwargs):
+        super(BaseClientCommand, self).__init__(*args, **kwargs)
+        self._local = threading.local()
+        self.stats = Stats()
+        self.skipped_lock = threading.Lock()
+        self.skipped = {'stores': 0, 'messages': 0}
+
+    @property
+    def server(self):
+        '''The IMAP connection used by the current thread.  Worker
+        threads started by process_folders each have their own
+        connection; everything else uses the main connection.'''
+
+        return getattr(self._local, 'server', None) or self._server
+
+    @server.setter
+    def server(self, server):
+        self._server = server
+
     def get_parser(self, prog_name):
         p = super(BaseClientCommand, self).get_parser(prog_name)
         p.add_argument('-a', '--account',
-                       default='default',
-                       help='Which account (from configuration file) to use')
+                       action='append',
+                       help='Which account (from configuration file) to use; '
+                       'repeat to process several accounts, or use "all" '
+                       'for every account (default: "default")')
+        p.add_argument('--account-workers',
+                       default=default.account_workers,
+                       type=int,
+                       help='Number of accounts to process concurrently, '
+                       'each in its own process')
         p.add_argument('-s', '--chunksize',
                        default=default.chunk_size,
+                       type=chunksize,
+                       help='Number of messages to process at a time, or '
+                       '"auto" to adjust it as commands are timed')
+        p.add_argument('-w', '--workers',
+                       default=default.workers,
+                       type=int,
+                       help='Number of folders to process concurrently')
+        p.add_argument('--pipeline',
+                       default=default.pipeline,
                        type=int,
-                       help='Number of messages to process at a time')
+                       help='Number of STORE commands to keep in flight on '
+                       'each connection')
+        p.add_argument('--dedup',
+                       action='store_true',
+                       help='Process each message only once, even if it '
+                       'appears in several of the selected folders')
+        p.add_argument('--no-status-check',
+                       action='store_true',
+                       help='Select every folder, rather than first asking '
+                       'for the status of all of them and skipping those '
+                       'that are empty or unchanged')
+        p.add_argument('--skip-noop',
+                       action='store_true',
+                       help='Fetch the labels and flags of messages before '
+                       'changing them, and only change the messages that '
+                       'need it')
+
+        g = p.add_argument_group('Sharding')
+        g.add_argument('--shard',
+                       action='store_true',
+                       help='Split each folder into date ranges (or, without '
+                       'a query, UID ranges) that are searched and processed '
+                       'separately, on up to --workers connections')
+        g.add_argument('--shard-size',
+                       default=default.shard_size,
+                       type=int,
+                       help='Number of messages to aim for in each shard')
+
+        g = p.add_argument_group('Adaptive chunk sizing')
+        g.add_argument('--chunk-min',
+                       default=default.chunk_min,
+                       type=count,
+                       help='Smallest chunk to use with --chunksize auto')
+        g.add_argument('--chunk-max',
+                       default=default.chunk_max,
+                       type=count,
+                       help='Largest chunk to use with --chunksize auto')
+        g.add_argument('--chunk-target',
+                       default=default.chunk_target,
+                       type=float,
+                       help='How long (in seconds) each command should '
+                       'take with --chunksize auto')
+
+        g = p.add_argument_group('Rate limiting')
+        g.add_argument('--max-command-rate',
+                       default=default.max_command_rate,
+                       type=float,
+                       metavar='COMMANDS',
+                       help='Most IMAP commands to send per second, across '
+                       'all connections to an account (default: no limit '
+                       'until the server throttles us)')
+        g.add_argument('--max-bandwidth',
+                       default=default.max_bandwidth,
+                       type=int,
+                       metavar='BYTES',
+                       help='Most bytes to send and receive per minute, '
+                       'across all connections to an account')
+        g.add_argument('--throttle-recovery',
+                       default=default.throttle_recovery,
+                       type=float,
+                       metavar='SECONDS',
+                       help='How long to take to return to full speed '
+                       'after the server throttles us')
 
         g = p.add_argument_group('Debugging')
         g.add_argument('--debug-imap',
@@ -21,9 +242,457 @@ class BaseClientCommand(cliff.command.Command):
                        metavar='debug_level',
                        choices=range(6),
                        help='Enable IMAP protocol debugging')
+        g.add_argument('--stats',
+                       action='store_true',
+                       help='Report the count, latency and size of IMAP '
+                       'commands by command, folder and filter')
+        g.add_argument('--stats-file',
+                       metavar='PATH',
+                       help='Write the --stats report to PATH instead of '
+                       'standard error (implies --stats)')
+        g.add_argument('--stats-format',
+                       choices=['text', 'json', 'prometheus'],
+                       default='text',
+                       help='Format of the --stats report')
+        g.add_argument('--profile',
+                       metavar='PATH',
+                       help='Profile the command with cProfile and write '
+                       'the results to PATH')
 
         return p
 
+    def run(self, parsed_args):
+        path = parsed_args.stats_file
+        if path:
+            parsed_args.stats = True
+            inputs = [x for x in self.input_paths(parsed_args)
+                      if x and os.path.exists(x)]
+            if os.path.exists(path) and \
+                    any(os.path.samefile(path, x) for x in inputs):
+                raise exceptions.InvalidOptions(
+                    '--stats-file %s is also an input file' % path)
+
+        try:
+            if parsed_args.profile:
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(
+                        super(BaseClientCommand, self).run, parsed_args)
+                finally:
+                    profiler.dump_stats(parsed_args.profile)
+                    self.app.LOG.info('wrote profile to %s',
+                                      parsed_args.profile)
+
+            return super(BaseClientCommand, self).run(parsed_args)
+        finally:
+            if parsed_args.stats:
+                self.write_stats(parsed_args.stats_file,
+                                 parsed_args.stats_format)
+
+    def input_paths(self, args):
+        '''Return the paths of the files that the command reads, which
+        must not be overwritten by its output.'''
+
+        return [self.app.options.config]
+
+    def write_stats(self, path, format):
+        if path is None:
+            self.stats.write(sys.stderr, format)
+        else:
+            with open(path, 'w') as fd:
+                self.stats.write(fd, format)
+            self.app.LOG.info('wrote statistics to %s', path)
+
+    def take_action(self, args):
+        self.args = args
+
+        self.accounts = self.account_names(args.account)
+        self.prepare()
+
+        if len(self.accounts) == 1:
+            self.select_account(self.accounts[0])
+            self.process_account()
+        else:
+            self.process_accounts(self.accounts)
+
+    def prepare(self):
+        '''Do the work that is the same for every account.  This runs
+        before any worker processes are started, so its results are
+        shared by all of them.'''
+
+    @abc.abstractmethod
+    def process_account(self):
+        '''Process the account selected by select_account(), whose name
+        is self.account_name, after prepare().  Subclasses must connect
+        (self.server = self.connect()), choose the folders and process
+        them, for example with process_folders().  This runs in a
+        worker process when several accounts are processed at once, so
+        anything it records for the report must go in self.stats.'''
+
+    def account_names(self, names):
+        '''Expand the list of --account names (in which "all" stands
+        for every configured account) into a list of distinct account
+        names, checking that each of them is configured.'''
+
+        if not names:
+            names = ['default']
+
+        selected = []
+        for name in names:
+            if name == 'all':
+                try:
+                    expanded = sorted(self.app.config['accounts'])
+                except (TypeError, KeyError):
+                    raise exceptions.NoSuchAccount('No accounts configured')
+            else:
+                self.get_account(name)
+                expanded = [name]
+
+            selected.extend(x for x in expanded if x not in selected)
+
+        return selected
+
+    def select_account(self, name):
+        self.account_name = name
+        self.account = self.get_account(name)
+        self.chunk_sizers = self.make_chunk_sizers()
+        self.governor = self.make_governor()
+
+    def process_accounts(self, names):
+        '''Process each of the named accounts in a separate process,
+        up to --account-workers at a time, then report the outcome for
+        every account.  Raise AccountsFailed if any of them failed.'''
+
+        global _command
+
+        workers = max(1, min(self.args.account_workers, len(names)))
+        self.app.LOG.info('processing %d accounts using %d processes',
+                          len(names), workers)
+
+        try:
+            context = multiprocessing.get_context('fork')
+        except AttributeError:
+            # Python 2, which always forks.
+            context = multiprocessing
+
+        _command = self
+        pool = context.Pool(workers)
+        try:
+            results = {}
+            for result in pool.imap_unordered(run_account, names):
+                results[result[0]] = result
+        finally:
+            pool.close()
+            pool.join()
+            _command = None
+
+        for name, error, elapsed, entries in results.values():
+            self.stats.merge(entries)
+
+        self.report_accounts([results[name] for name in names])
+
+        failed = [name for name in names if results[name][1] is not None]
+        if failed:
+            raise exceptions.AccountsFailed(
+                '%d of %d accounts failed: %s' % (
+                    len(failed), len(names), ', '.join(failed)))
+
+    def run_account(self, name):
+        '''Process one account in a worker process.  Return the
+        account name, a description of the error that stopped it (or
+        None), the time it took, and the statistics it recorded.'''
+
+        start = time.time()
+        error = None
+        try:
+            self.select_account(name)
+            self.process_account()
+        except Exception as exc:
+            self.app.LOG.error('failed to process account %s: %s',
+                               name, exc)
+            error = '%s: %s' % (type(exc).__name__, exc)
+
+        return name, error, time.time() - start, dict(self.stats.entries)
+
+    def report_accounts(self, results):
+        fmt = '%-20s %-8s %10s  %s'
+        lines = [fmt % ('account', 'status', 'time (s)', 'error')]
+        for name, error, elapsed, entries in results:
+            lines.append(fmt % (name, 'failed' if error else 'ok',
+                                '%.1f' % elapsed, error or ''))
+
+        for line in lines:
+            self.app.stderr.write(line.rstrip() + '\n')
+
+    def get_account(self, name):
+        try:
+            return self.app.config['accounts'][name]
+        except (TypeError, KeyError):
+            raise exceptions.NoSuchAccount(
+                'Unable to find account named "%s"' % name)
+
+    def make_governor(self):
+        '''Create the Governor shared by every connection to the selected
+        account.  Gmail applies its limits to each account, so accounts
+        (which are processed in separate processes) each have their
+        own.'''
+
+        from gmailfilters.governor import Governor
+
+        return Governor(commands_per_second=self.args.max_command_rate,
+                        bytes_per_minute=self.args.max_bandwidth,
+                        recovery=self.args.throttle_recovery)
+
+    def make_chunk_sizers(self):
+        '''Create the chunk sizers for STORE and FETCH commands, which
+        adapt independently with --chunksize auto.'''
+
+        sizers = {}
+        for kind in ['store', 'fetch']:
+            if self.args.chunksize == 'auto':
+                sizers[kind] = ChunkSizer(default.chunk_size,
+                                          minimum=self.args.chunk_min,
+                                          maximum=self.args.chunk_max,
+                                          target=self.args.chunk_target,
+                                          name=kind)
+            else:
+                sizers[kind] = ChunkSizer(self.args.chunksize)
+
+        return sizers
+
+    def chunks(self, messages, kind='store'):
+        '''Split messages into chunks sized for kind ('store' or
+        'fetch') commands.'''
+
+        return chunker(messages, self.chunk_sizers[kind])
+
+    def store(self, method, chunk, values=None, current=None):
+        '''Call the IMAPClient store method (such as add_gmail_labels)
+        of the current connection on the messages in chunk.  With
+        --pipeline, the command is sent without waiting for its
+        response; call wait_stores() before depending on its effects.
+
+        If current (a CurrentState, from fetch_current) is given, the
+        command is only sent to the messages that it would change, if
+        there are any.'''
+
+        if current is not None:
+            changed = current.changed(method, chunk, values)
+            self.record_skipped(len(chunk) - len(changed),
+                                0 if changed else 1)
+            if not changed:
+                return
+            chunk = changed
+
+        if self.args.pipeline > 1:
+            self.get_pipeline().store(method, chunk, values)
+            return
+
+        from gmailfilters.pipeline import store_args
+
+        with self.chunk_sizers['store'].measure(len(chunk)):
+            self.server._command_and_check(
+                'STORE', *store_args(self.server, method, chunk, values),
+                uid=True)
+
+    def fetch_current(self, folder, messages):
+        '''With --skip-noop, fetch the labels and flags of messages (a
+        UIDSet) in the selected folder, and return them as a
+        CurrentState to pass to store().  Otherwise, return None.'''
+
+        if not self.args.skip_noop:
+            return None
+
+        from gmailfilters.delta import CurrentState
+
+        current = CurrentState(folder)
+        for chunk in self.chunks(messages, 'fetch'):
+            with self.chunk_sizers['fetch'].measure(len(chunk)):
+                res = uid_fetch(self.server, chunk, ['X-GM-LABELS', 'FLAGS'])
+            current.update(res)
+
+        return current
+
+    def record_skipped(self, messages, stores):
+        with self.skipped_lock:
+            self.skipped['messages'] += messages
+            self.skipped['stores'] += stores
+
+    def report_skipped(self):
+        if not self.args.skip_noop:
+            return
+
+        self.app.LOG.info('skipped %d messages that needed no change '
+                          '(%d STORE commands avoided)',
+                          self.skipped['messages'], self.skipped['stores'])
+
+    def report_governor(self):
+        if self.governor is None:
+            return
+
+        throttles, waited, rate = self.governor.summary()
+        if throttles or waited:
+            self.app.LOG.info('throttled %d times by the server; waited %.1f '
+                              'seconds for the rate limit (now %s commands '
+                              'per second)', throttles, waited,
+                              'unlimited' if rate is None else '%.1f' % rate)
+
+    def get_pipeline(self):
+        '''Return the StorePipeline for the current connection.'''
+
+        from gmailfilters.pipeline import StorePipeline
+
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is None or pipeline.server is not self.server:
+            pipeline = StorePipeline(self.server, self.args.pipeline,
+                                     sizer=self.chunk_sizers['store'])
+            self._local.pipeline = pipeline
+
+        return pipeline
+
+    def wait_stores(self):
+        '''Wait for any STORE commands still in flight on the current
+        connection.'''
+
+        pipeline = getattr(self._local, 'pipeline', None)
+        if pipeline is not None and pipeline.server is self.server:
+            pipeline.wait()
+
+    def expunge_messages(self, folder, messages):
+        '''Expunge messages (a UIDSet of messages already marked
+        \\Deleted) from the selected folder with a single command.  If the
+        server supports UIDPLUS, this uses UID EXPUNGE, which removes
+        only these messages; otherwise it falls back to EXPUNGE, which
+        removes every message in the folder that is marked \\Deleted.'''
+
+        if not messages:
+            return
+
+        self.wait_stores()
+
+        self.app.LOG.info('expunging %d messages from %s',
+                          len(messages), folder)
+        if self.server.has_capability('UIDPLUS'):
+            # Unlike fetch() and the store methods, expunge() passes a
+            # sequence set string straight through, in every version of
+            # IMAPClient.
+            self.server.expunge(messages.sequence_set())
+        else:
+            self.server.expunge()
+
+    def connect(self):
+        '''Return a new connection to the server for self.account,
+        logged in and ready to use.'''
+
+        import imapclient
+
+        account = self.account
+        server = imapclient.IMAPClient(account['host'],
+                                       port=account.get('port'),
+                                       use_uid=True,
+                                       ssl=account.get('ssl', True))
+        server.debug = self.args.debug_imap
+        if self.args.stats:
+            self.stats.instrument(server)
+        # The governor is installed last, so that time spent waiting for
+        # it is not counted as command latency.
+        if self.governor is not None:
+            self.governor.instrument(server)
+
+        server.login(account['username'], account['password'])
+        return server
+
+    def reconnect(self):
+        '''Replace the current thread's connection, after it has failed,
+        with a new one.'''
+
+        # Connections dropped under load are often Gmail's way of
+        # throttling.
+        if self.governor is not None:
+            self.governor.throttled()
+
+        old = self.server
+        try:
+            old.logout()
+        except Exception as exc:
+            self.app.LOG.debug('failed to log out: %s', exc)
+
+        server = self.connect()
+        if getattr(self._local, 'server', None) is not None:
+            self._local.server = server
+        else:
+            self._server = server
+
+        return server
+
+    def search(self, query, criteria=None):
+        '''Return a UIDSet of the messages in the selected folder that
+        match the Gmail query (or all messages if query is None) and any
+        additional IMAP search criteria.'''
+
+        criteria = list(criteria or [])
+        if query is not None:
+            criteria.extend(['X-GM-RAW', query])
+
+        if self.server.has_capability('ESEARCH'):
+            return self.esearch(criteria or ['ALL'])
+
+        if not criteria:
+            return UIDSet(self.server.search())
+
+        return UIDSet(self.server.search(criteria, charset='UTF-8'))
+
+    def esearch(self, criteria):
+        '''Search using the ESEARCH extension (RFC 4731), which returns
+        the matching UIDs as a sequence set (e.g. "1:500,502") rather than
+        one number per message.  imapclient does not support ESEARCH, so
+        this uses its lower-level command interface.'''
+
+        import imapclient.imapclient
+
+        args = [b'RETURN', b'(ALL)', b'CHARSET', b'UTF-8']
+        args.extend(imapclient.imapclient._normalise_search_criteria(
+            criteria, 'UTF-8'))
+        data = self.server._raw_command_untagged(b'SEARCH', args,
+                                                 response_name='ESEARCH')
+
+        for line in data:
+            if line is None:
+                continue
+            if isinstance(line, bytes):
+                line = line.decode('ascii')
+            match = re.search(r'\bALL (\S+)', line)
+            if match:
+                return UIDSet.from_sequence_set(match.group(1))
+
+        return UIDSet()
+
+    def unseen_messages(self, folder, messages):
+        '''With --dedup, return the messages (a UIDSet) in the selected
+        folder that have not already been processed in another folder,
+        and remember them as processed.  Messages are identified across
+        folders by their Gmail message id (X-GM-MSGID).'''
+
+        if self.seen is None or not messages:
+            return messages
+
+        unseen = []
+        for chunk in self.chunks(messages, 'fetch'):
+            with self.chunk_sizers['fetch'].measure(len(chunk)):
+                res = uid_fetch(self.server, chunk, ['X-GM-MSGID'])
+
+            uids = [uid for uid in chunk if uid in res]
+            claimed = self.seen.claim([res[uid][b'X-GM-MSGID']
+                                       for uid in uids])
+            unseen.extend(uid for uid, new in zip(uids, claimed) if new)
+
+        if len(unseen) < len(messages):
+            self.app.LOG.info('skipping %d messages in %s that were '
+                              'processed in another folder',
+                              len(messages) - len(unseen), folder)
+
+        return UIDSet(unseen)
+
     def select_folders(self, folders):
         '''Use wildcard matching to transform a list of folder names and
         patterns into a list of folder names.'''
@@ -34,23 +703,284 @@ class BaseClientCommand(cliff.command.Command):
             self.app.LOG.debug('applying pattern %s', pattern)
             for folder in all_folders:
                 self.app.LOG.debug('considering folder %s', folder)
-                if r'\Noselect' in folder[0]:
-                    self.app.LOG.debug('rejecting folder %s (noselect)', folder)
+                # imapclient returns the flags as bytes on Python 3.
+                flags = [x.decode('ascii') if isinstance(x, bytes) else x
+                         for x in folder[0]]
+                if r'\Noselect' in flags:
+                    self.app.LOG.debug('rejecting folder %s (noselect)',
+                                       folder)
                     continue
 
                 if pattern.startswith('@'):
                     flag = '\\' + pattern[1:].title()
-                    if flag in folder[0]:
-                        self.app.LOG.debug('selecting folder %s (flag)', folder)
+                    if flag in flags:
+                        self.app.LOG.debug('selecting folder %s (flag)',
+                                           folder)
                         selected_folders.append(folder[2])
                 else:
                     if fnmatch.fnmatch(folder[2], pattern):
-                        self.app.LOG.debug('selecting folder %s (pattern)', folder)
+                        self.app.LOG.debug('selecting folder %s (pattern)',
+                                           folder)
                         selected_folders.append(folder[2])
 
         self.app.LOG.debug('selected folders = %s', selected_folders)
         return selected_folders
 
     def process_folders(self, folders):
+        if self.args.dedup:
+            self.seen = SeenSet()
+
+        folders = self.check_folders(folders)
+
+        # With --shard, the workers process the shards of one folder at
+        # a time instead.
+        workers = 1
+        if not self.args.shard:
+            workers = min(self.args.workers, len(folders))
+        if workers <= 1:
+            for folder in folders:
+                self.process_folder(folder)
+        else:
+            self.app.LOG.info('processing %d folders using %d workers',
+                              len(folders), workers)
+            self.run_parallel(folders, self.process_folder, workers)
+
+        self.report_skipped()
+        self.report_governor()
+
+    def check_folders(self, folders):
+        '''Ask for the status of folders (if there are several) and
+        return those that are not empty and that folder_unchanged does
+        not report as unchanged, so that they need not be selected.'''
+
+        if self.args.no_status_check or len(folders) < 2:
+            return folders
+
+        start = time.time()
+        try:
+            statuses = self.folder_status(folders)
+        except (imaplib.IMAP4.error, socket.error) as exc:
+            self.app.LOG.warning('failed to get the status of folders: %s; '
+                                 'processing all of them', exc)
+            if transient_error(exc):
+                self.reconnect()
+            return folders
+
+        empty = unchanged = 0
+        selected = []
+        for folder in folders:
+            status = statuses.get(folder)
+            if status is None:
+                selected.append(folder)
+            elif status.get(b'MESSAGES') == 0:
+                self.app.LOG.debug('skipping empty folder %s', folder)
+                empty += 1
+            elif self.folder_unchanged(folder, status):
+                self.app.LOG.debug('skipping unchanged folder %s', folder)
+                unchanged += 1
+            else:
+                selected.append(folder)
+
+        self.app.LOG.info('checked the status of %d folders in %.2f seconds; '
+                          'skipping %d empty and %d unchanged folders',
+                          len(folders), time.time() - start, empty, unchanged)
+        return selected
+
+    def folder_unchanged(self, folder, status):
+        '''Return whether folder, given its STATUS, is known to be
+        unchanged since it was last processed.  Commands that keep
+        state between runs can override this.'''
+
+        return False
+
+    def folder_status(self, folders):
+        '''Return the MESSAGES, UIDNEXT, UIDVALIDITY and (with
+        CONDSTORE) HIGHESTMODSEQ of each of folders, as returned by
+        parse_status.  This uses a single LIST-STATUS command (RFC 5819)
+        if the server supports it, and otherwise pipelined STATUS
+        commands.  Folders whose status is unavailable are left out.'''
+
+        items = [b'MESSAGES', b'UIDNEXT', b'UIDVALIDITY']
+        if self.server.has_capability('CONDSTORE'):
+            items.append(b'HIGHESTMODSEQ')
+        what = b'(' + b' '.join(items) + b')'
+
+        if self.server.has_capability('LIST-STATUS'):
+            try:
+                statuses = self.list_status(what)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as exc:
+                self.app.LOG.warning('LIST-STATUS failed: %s; using STATUS',
+                                     exc)
+            else:
+                return dict((folder, statuses[folder]) for folder in folders
+                            if folder in statuses)
+
+        return self.pipelined_status(folders, what)
+
+    def list_status(self, what):
+        server = self.server
+        data = server._raw_command_untagged(
+            b'LIST', [b'""', b'"*"', b'RETURN', b'(STATUS ' + what + b')'],
+            response_name='STATUS', uid=False)
+        # Only the STATUS responses are needed.
+        server._imap.untagged_responses.pop('LIST', None)
+        return parse_status(data)
+
+    def pipelined_status(self, folders, what):
+        '''Send a STATUS command for each of folders, keeping up to
+        default.status_window of them in flight, and return their
+        results.'''
+
+        server = self.server
+        imap = server._imap
+        inflight = collections.deque()
+
+        def complete():
+            folder, tag = inflight.popleft()
+            typ, data = imap._command_complete('STATUS', tag)
+            if typ != 'OK':
+                self.app.LOG.debug('STATUS of %s failed: %s', folder, data)
+
         for folder in folders:
+            while len(inflight) >= default.status_window:
+                complete()
+            inflight.append((folder, imap._command(
+                'STATUS', server._normalise_folder(folder), what)))
+
+        while inflight:
+            complete()
+
+        typ, data = imap._untagged_response('OK', [None], 'STATUS')
+        return parse_status(data)
+
+    def process_folder(self, folder):
+        with self.stats.scope(folder=folder):
             self.process_one_folder(folder)
+
+    def process_shards(self, folder, info, by_date, func, planned=(),
+                       started=None):
+        '''Divide the selected folder into shards (see Sharder) of date
+        ranges, if by_date is true, or otherwise of UID ranges, and call
+        func(shard) for each of them, using up to --workers connections
+        (each of which selects folder).  func must return the number of
+        messages that it found in the shard, which is used to size later
+        shards.
+
+        The shards in planned, which an earlier attempt handed out, are
+        processed first, with the same boundaries.  If started is given,
+        started(shard) is called as each shard is handed out, before it
+        is processed.'''
+
+        from gmailfilters.shard import Sharder
+
+        messages = info[b'EXISTS']
+        if not messages:
+            return
+
+        if by_date:
+            sharder = Sharder.by_date(self.oldest_date(), messages,
+                                      self.args.shard_size)
+        else:
+            sharder = Sharder.by_uid(info[b'UIDNEXT'], messages,
+                                     self.args.shard_size)
+        sharder.replay(planned)
+
+        def shards():
+            for shard in sharder:
+                if started is not None:
+                    started(shard)
+                yield shard
+
+        selected = [self.server]
+        lock = threading.Lock()
+
+        def process(shard):
+            server = self.server
+            with lock:
+                select = not any(x is server for x in selected)
+            if select:
+                server.select_folder(folder)
+                with lock:
+                    selected.append(server)
+
+            with self.stats.scope(folder=folder):
+                count = func(shard)
+            self.app.LOG.debug('%s of %s held %d messages', shard, folder,
+                               count)
+            sharder.record(shard, count)
+
+        # run_parallel only advances the generator while holding its
+        # lock, so shards are handed out (and started) one at a time.
+        self.run_parallel(shards(), process, max(1, self.args.workers))
+
+    def oldest_date(self):
+        '''Return the date of the first message in the selected folder,
+        which is usually the oldest, or today if there is none.'''
+
+        from imapclient.response_parser import parse_fetch_response
+
+        data = self.server._raw_command_untagged(
+            b'FETCH', [b'1', b'(INTERNALDATE)'], uid=False)
+        for msg in parse_fetch_response(data, uid_is_key=False).values():
+            if b'INTERNALDATE' in msg:
+                return msg[b'INTERNALDATE'].date()
+
+        return datetime.date.today()
+
+    def run_parallel(self, items, func, workers):
+        '''Call func on each of items (which may be any iterable, as long
+        as its iterator can be used from several threads) using up to
+        workers threads.  Each thread gets its own connection from a
+        pool (which includes the main connection), available to func as
+        self.server.  If func raises an exception, no further items are
+        started and the first exception is re-raised once all threads
+        have finished.'''
+
+        pool = ConnectionPool(self.connect, workers)
+        pool.add(self._server)
+
+        pending = iter(items)
+        finished = object()
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if errors:
+                        return
+                    item = next(pending, finished)
+                    if item is finished:
+                        return
+
+                try:
+                    server = pool.get()
+                    self._local.server = server
+                    try:
+                        func(item)
+                    finally:
+                        # func may have replaced the connection with
+                        # reconnect().
+                        if self._local.server is not server:
+                            pool.replace(server, self._local.server)
+                        pool.put(self._local.server)
+                except Exception as exc:
+                    self.app.LOG.error('failed to process %s: %s', item, exc)
+                    with lock:
+                        errors.append(exc)
+                finally:
+                    self._local.server = None
+
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            pool.close()
+
+        if errors:
+            raise errors[0]
@@ -1,12 +1,23 @@
-import argparse
-import cliff.command
-import imapclient
+from __future__ import print_function
+
+import collections
+import csv
+import email.utils
 import imaplib
+import json
+import multiprocessing
+import sys
+import threading
+import time
 
 from gmailfilters import exceptions
 from gmailfilters.cmd.baseclient import BaseClientCommand
+from gmailfilters.cmd.baseclient import transient_error, uid_fetch
 from gmailfilters import default
-from gmailfilters.util import chunker
+from gmailfilters.journal import Journal
+from gmailfilters.shard import Shard
+from gmailfilters.uidset import UIDSet
+from gmailfilters.util import prefetch
 
 valid_flags = [
     'SEEN',
@@ -26,6 +37,88 @@ headers = (
 )
 
 
+def to_unicode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def format_address(addr):
+    if addr.mailbox and addr.host:
+        address = to_unicode(addr.mailbox) + '@' + to_unicode(addr.host)
+    else:
+        address = to_unicode(addr.mailbox or addr.host or '')
+
+    if addr.name:
+        return email.utils.formataddr((to_unicode(addr.name), address))
+
+    return address
+
+
+def envelope_field(name):
+    '''Return a function that extracts an envelope field from a
+    message.'''
+
+    def extract(msg):
+        value = getattr(msg[b'ENVELOPE'], name)
+        if value is None:
+            return None
+        elif isinstance(value, tuple):
+            return [format_address(addr) for addr in value]
+        elif hasattr(value, 'isoformat'):
+            return value.isoformat()
+        else:
+            return to_unicode(value)
+
+    return extract
+
+
+# The fields that --fields can select, with the FETCH item that each
+# one needs and a function that extracts it from the FETCH response.
+# account, folder and uid are handled separately.
+fields = collections.OrderedDict([
+    ('msgid', ('X-GM-MSGID', lambda msg: msg[b'X-GM-MSGID'])),
+    ('thrid', ('X-GM-THRID', lambda msg: msg[b'X-GM-THRID'])),
+    ('date', ('ENVELOPE', envelope_field('date'))),
+    ('from', ('ENVELOPE', envelope_field('from_'))),
+    ('reply_to', ('ENVELOPE', envelope_field('reply_to'))),
+    ('to', ('ENVELOPE', envelope_field('to'))),
+    ('cc', ('ENVELOPE', envelope_field('cc'))),
+    ('subject', ('ENVELOPE', envelope_field('subject'))),
+    ('message_id', ('ENVELOPE', envelope_field('message_id'))),
+    ('labels', ('X-GM-LABELS',
+                lambda msg: [to_unicode(x) for x in msg[b'X-GM-LABELS']])),
+    ('flags', ('FLAGS', lambda msg: [to_unicode(x) for x in msg[b'FLAGS']])),
+    ('size', ('RFC822.SIZE', lambda msg: msg[b'RFC822.SIZE'])),
+])
+
+special_fields = ['account', 'folder', 'uid']
+default_fields = ['folder', 'uid', 'date', 'from', 'to', 'subject', 'labels']
+
+
+def fieldlist(spec):
+    '''Transform a comma-separated list of field names into a list,
+    validating the names against fields.'''
+
+    selected = [name.strip() for name in spec.split(',') if name.strip()]
+    for name in selected:
+        if name not in fields and name not in special_fields:
+            raise ValueError(name)
+
+    return selected
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = ', '.join(value)
+    if not isinstance(value, str) and hasattr(value, 'encode'):
+        # Python 2's csv module only handles byte strings.
+        value = value.encode('utf-8')
+    return value
+
+
 def labelspec(spec):
     '''Transform a list of labels, optionally prefixed with a '+' or '-',
     into a list of (action, label) tuples.'''
@@ -55,6 +148,8 @@ def flagspec(spec):
     if flag not in valid_flags:
         raise ValueError(flag)
 
+    import imapclient
+
     return (action, getattr(imapclient, flag))
 
 
@@ -93,121 +188,428 @@ class BulkFilter(BaseClientCommand):
                        action='store_true',
                        help='Remove matching messages from your inbox')
 
+        g = p.add_argument_group('Output')
+        g.add_argument('--output-format',
+                       choices=['text', 'jsonl', 'csv'],
+                       default='text',
+                       help='How to show messages with --show')
+        g.add_argument('--fields',
+                       type=fieldlist,
+                       help='Comma-separated list of fields to show with '
+                       '--output-format jsonl or csv (choose from: %s)' % (
+                           ', '.join(special_fields + list(fields))))
+
+        g = p.add_argument_group('Recovery')
+        g.add_argument('--resume',
+                       action='store_true',
+                       help='Continue an earlier run with the same query, '
+                       'folders and actions from where it stopped')
+        g.add_argument('--retries',
+                       default=default.retries,
+                       type=int,
+                       help='How many times to reconnect and retry after a '
+                       'dropped connection or throttling in each folder')
+        g.add_argument('--journal-dir',
+                       default=default.journal_dir,
+                       help='Where to record progress for --resume')
+
         p.add_argument('folders', nargs='*',
                        default=['@all'])
 
         return p
 
     def show_message(self, msgid, msg):
-        print '%04d: %s' % (msgid, msg['ENVELOPE'].subject)
-        for header in headers:
-            if not getattr(msg['ENVELOPE'], header[0], None):
+        envelope = msg[b'ENVELOPE']
+        lines = ['%04d: %s' % (msgid, to_unicode(envelope.subject))]
+        for attr, title in headers:
+            hval = getattr(envelope, attr, None)
+            if not hval:
                 continue
 
-            hval = getattr(msg['ENVELOPE'], header[0])
             if isinstance(hval, tuple):
-                try:
-                    hval = ', '.join(str(x) for x in hval)
-                except TypeError:
-                    hval = '...'
-
-            print '      %s: %s' % (
-                header[1], hval)
-        print '      Labels: %s' % (
-            ' ' .join(str(x) for x in msg['X-GM-LABELS']))
-        print
-
-    def take_action(self, args):
-        self.args = args
-
+                hval = ', '.join(format_address(addr) for addr in hval)
+            lines.append('      %s: %s' % (title, to_unicode(hval)))
+
+        lines.append('      Labels: %s' % ' '.join(
+            to_unicode(x) for x in msg[b'X-GM-LABELS']))
+
+        text = '\n'.join(lines) + '\n\n'
+        if not isinstance(text, str):
+            # Python 2's sys.stdout takes byte strings.
+            text = text.encode('utf-8')
+        sys.stdout.write(text)
+
+    def make_record(self, folder, msgid, msg):
+        record = collections.OrderedDict()
+        for name in self.fields:
+            if name == 'account':
+                record[name] = self.account_name
+            elif name == 'folder':
+                record[name] = folder
+            elif name == 'uid':
+                record[name] = msgid
+            else:
+                record[name] = fields[name][1](msg)
+
+        return record
+
+    def fetch_items(self):
+        '''Return the FETCH items needed for the selected output.'''
+
+        if self.args.output_format == 'text':
+            return ['ENVELOPE', 'X-GM-LABELS']
+
+        items = []
+        for name in self.fields:
+            if name in fields and fields[name][0] not in items:
+                items.append(fields[name][0])
+
+        # FETCH needs at least one item; UID is included in every
+        # response anyway.
+        return items or ['UID']
+
+    def prepare(self):
+        args = self.args
+
+        if args.dedup and args.delete:
+            raise exceptions.InvalidOptions(
+                '--dedup cannot be used with --delete, which only removes '
+                'messages from the folder in which they are found')
+
+        self.fields = args.fields
+        if not self.fields:
+            self.fields = default_fields
+            if len(self.accounts) > 1:
+                self.fields = ['account'] + self.fields
+
+        # Accounts are processed in separate processes, which must not
+        # write to the shared standard output at the same time.
+        if len(self.accounts) > 1:
+            self.output_lock = multiprocessing.Lock()
+        else:
+            self.output_lock = threading.Lock()
+
+        if args.show and args.output_format == 'csv':
+            self.csv = csv.writer(sys.stdout)
+            self.csv.writerow(self.fields)
+            sys.stdout.flush()
+
+    def process_account(self):
+        args = self.args
+
+        # Everything that affects which messages are changed, and how,
+        # identifies the job in the journal.
+        job = ('bulk-filter', args.query, args.folders, args.flag,
+               args.label, args.archive, args.trash, args.delete,
+               args.show, args.dedup)
+        self.journal = Journal.for_job(self.account_name, job,
+                                       args.journal_dir)
+        if args.resume:
+            if self.journal.load():
+                self.app.LOG.info('resuming from journal %s',
+                                  self.journal.path)
+            else:
+                self.app.LOG.warning('no journal found at %s; starting '
+                                     'from the beginning', self.journal.path)
+
+        # Progress is only worth saving if the run was interrupted, or
+        # stopped by an error that may go away; other errors would stop
+        # a resumed run in the same way.
         try:
-            account = self.app.config['accounts'][args.account]
-        except (TypeError, KeyError):
-            raise exceptions.NoSuchAccount(
-                'Unable to find account named "%s"' % args.account)
-
-        self.server = imapclient.IMAPClient(account['host'],
-                                            use_uid=True,
-                                            ssl=account.get('ssl', True))
-        self.server.debug = args.debug_imap
-
-        self.server.login(account['username'], account['password'])
-
-        selected_folders = self.select_folders(args.folders)
+            self.process_account_folders()
+        except KeyboardInterrupt:
+            self.save_progress()
+            raise
+        except Exception as exc:
+            if transient_error(exc):
+                self.save_progress()
+            raise
+
+        self.journal.remove()
+
+    def save_progress(self):
+        if len(self.journal):
+            self.journal.flush()
+            self.app.LOG.warning('progress saved to %s; use --resume to '
+                                 'continue', self.journal.path)
+
+    def process_account_folders(self):
+        self.server = self.connect()
+
+        selected_folders = self.select_folders(self.args.folders)
         if not selected_folders:
             raise exceptions.NoMatchingFolders('No folders to process')
 
-        if args.fail_if_empty and len(selected_folders) > 1:
+        if self.args.fail_if_empty and len(selected_folders) > 1:
             raise exceptions.InvalidOptions(
                 '--fail-if-empty can only be used when processing '
                 'a single folder')
         self.process_folders(selected_folders)
 
+    def process_folder(self, folder):
+        '''Process folder, reconnecting and continuing from the last
+        completed chunk after transient errors.'''
+
+        attempt = 0
+        while True:
+            try:
+                return super(BulkFilter, self).process_folder(folder)
+            except Exception as exc:
+                if attempt >= self.args.retries or not transient_error(exc):
+                    raise
+
+                attempt += 1
+                delay = min(2 ** (attempt - 1), default.max_backoff)
+                self.app.LOG.warning('error processing %s: %s; retrying '
+                                     'in %d seconds (attempt %d of %d)',
+                                     folder, exc, delay, attempt,
+                                     self.args.retries)
+                time.sleep(delay)
+                self.reconnect()
+
     def process_one_folder(self, folder):
+        if self.journal.done(folder):
+            self.app.LOG.info('skipping %s, which an earlier run completed',
+                              folder)
+            return
+
         self.app.LOG.info('processing folder %s', folder)
 
         try:
             info = self.server.select_folder(folder)
+        except imaplib.IMAP4.abort:
+            raise
         except imaplib.IMAP4.error as exc:
             self.app.LOG.error('failed to select %s (%s): %s',
-                          folder, type(exc), exc)
+                               folder, type(exc), exc)
             return
 
+        if self.args.shard:
+            found = []
+
+            def process_shard(shard):
+                messages = self.process_selection(
+                    folder, '%s (%s)' % (folder, shard), info, shard)
+                found.append(len(messages))
+                return len(messages)
+
+            # Shards that an earlier attempt started are processed again
+            # with the same boundaries, so that their journal entries
+            # (keyed by the shard) are found.
+            uidvalidity = info[b'UIDVALIDITY']
+            planned = [Shard.decode(x)
+                       for x in self.journal.shards(folder, uidvalidity)]
+            if planned:
+                self.app.LOG.info('continuing with %d shards of %s started '
+                                  'by an earlier attempt', len(planned),
+                                  folder)
+
+            self.process_shards(
+                folder, info, self.args.query is not None, process_shard,
+                planned, lambda shard: self.journal.add_shard(
+                    folder, uidvalidity, shard.encode()))
+            if self.args.fail_if_empty and not sum(found):
+                raise exceptions.NoMatchingMessages(
+                    'Filter returned zero messages')
+            self.journal.finish(folder)
+        else:
+            self.process_selection(folder, folder, info)
+
+    def process_selection(self, folder, key, info, shard=None):
+        '''Find and process the messages in the selected folder (or, if
+        shard is given, in that shard of it), recording progress in the
+        journal under key.  Return the messages.'''
+
+        messages = self.journal_messages(key, info)
+        if messages is not None and self.journal.done(key):
+            return messages
+
+        if messages is None:
+            messages = self.find_messages(folder, shard)
+            self.journal.start(key, info[b'UIDVALIDITY'], messages)
+
+        # Messages are shown after they have been labelled, but before
+        # they are trashed or deleted.
+        if self.args.flag or self.args.label or self.args.archive:
+            self.run_phase(folder, 'label', messages, self.label_messages,
+                           key)
+
+        if self.args.show:
+            self.run_phase(folder, 'show', messages, self.show_all_messages,
+                           key)
+
+        if self.args.trash or self.args.delete:
+            self.run_phase(folder, 'remove', messages,
+                           self.remove_all_messages, key)
+
+        if self.args.delete:
+            self.expunge_messages(folder, messages)
+
+        self.journal.finish(key)
+        return messages
+
+    def find_messages(self, folder, shard=None):
+        query, criteria = self.args.query, None
+        where = folder
+        if shard is not None:
+            query, criteria = shard.restrict(query)
+            where = '%s (%s)' % (folder, shard)
+
         if self.args.query is None:
-            self.app.LOG.info('selecting all messages in %s', folder)
-            messages = self.server.search()
+            self.app.LOG.info('selecting all messages in %s', where)
         else:
             self.app.LOG.info('selecting messages in %s matching: %s',
-                          folder, self.args.query)
-            messages = self.server.gmail_search(self.args.query)
+                              where, self.args.query)
+        messages = self.search(query, criteria)
 
         self.app.LOG.info('found %d messages', len(messages))
 
-        if self.args.fail_if_empty and not messages:
-            raise exceptions.NoMatchingMessages('Filter returned zero messages')
+        # With --shard, process_one_folder checks whether any shard
+        # had messages.
+        if self.args.fail_if_empty and shard is None and not messages:
+            raise exceptions.NoMatchingMessages(
+                'Filter returned zero messages')
+
+        return self.unseen_messages(folder, messages)
+
+    def journal_messages(self, folder, info):
+        '''Return the messages that an earlier (or failed) run found in
+        the selected folder, according to the journal, or None.'''
+
+        # A folder that was processed in shards has no messages of its
+        # own.
+        entry = self.journal.get(folder)
+        if entry is None or 'messages' not in entry:
+            return None
+
+        if entry['uidvalidity'] != info[b'UIDVALIDITY']:
+            self.app.LOG.warning('UIDVALIDITY of %s has changed; searching '
+                                 'it again', folder)
+            return None
+
+        messages = UIDSet.from_sequence_set(entry['messages'])
+        self.app.LOG.info('continuing with %d messages found in %s by an '
+                          'earlier attempt', len(messages), folder)
+        return messages
+
+    def run_phase(self, folder, phase, messages, func, key=None):
+        '''Process the messages that the journal does not record as
+        already done by phase, recording progress under key (by default,
+        the folder).  func(folder, messages) must process messages a
+        chunk at a time, in order, yielding each chunk once it is done.
+
+        Without --pipeline, progress is recorded after every chunk, so a
+        retry repeats only the chunk that failed.  With --pipeline, STORE
+        commands are only waited for (and progress recorded) each time
+        the journal is written.'''
+
+        if key is None:
+            key = folder
+
+        done = self.journal.progress(key, phase)
+        remaining = messages.since(done + 1)
+        if len(remaining) < len(messages):
+            self.app.LOG.info('skipping %d messages in %s that were already '
+                              'processed (%s)', len(messages) - len(remaining),
+                              folder, phase)
+
+        for chunk in func(folder, remaining):
+            if self.args.pipeline > 1 and not self.journal.due():
+                continue
+            self.wait_stores()
+            self.journal.update(key, phase, chunk[-1])
+
+        self.wait_stores()
+        if remaining:
+            self.journal.update(key, phase, remaining[-1])
 
-        for chunk in chunker(messages, self.args.chunksize):
+    def label_messages(self, folder, messages):
+        for chunk in self.chunks(messages):
             self.process_messages(folder, chunk)
+            yield chunk
+
+    def show_all_messages(self, folder, messages):
+        for chunk, res in self.fetch_messages(folder, messages):
+            self.show_messages(folder, chunk, res)
+            yield chunk
+
+    def remove_all_messages(self, folder, messages):
+        for chunk in self.chunks(messages):
+            self.remove_messages(folder, chunk)
+            yield chunk
 
     def process_messages(self, folder, chunk):
         add_flags = [flag[1] for flag in self.args.flag if flag[0] == '+']
         del_flags = [flag[1] for flag in self.args.flag if flag[0] == '-']
         add_labels = [label[1] for label in self.args.label if label[0] == '+']
         del_labels = [label[1] for label in self.args.label if label[0] == '-']
+        current = self.fetch_current(folder, chunk)
 
         if self.args.flag:
-            self.app.LOG.info('applying flags to  messages %d...%d from %s (%s)',
-                         chunk[0], chunk[-1], folder, self.args.flag)
-            res = self.server.add_flags(chunk, add_flags)
-            res = self.server.remove_flags(chunk, del_flags)
+            self.app.LOG.info('applying flags to  messages %d...%d from %s '
+                              '(%s)', chunk[0], chunk[-1], folder,
+                              self.args.flag)
+            self.store('add_flags', chunk, add_flags, current)
+            self.store('remove_flags', chunk, del_flags, current)
 
         if self.args.label:
             self.app.LOG.info('labelling messages %d...%d from %s (%s)',
-                         chunk[0], chunk[-1], folder, self.args.label)
-            res = self.server.add_gmail_labels(chunk, add_labels)
-            res = self.server.remove_gmail_labels(chunk, del_labels)
+                              chunk[0], chunk[-1], folder, self.args.label)
+            self.store('add_gmail_labels', chunk, add_labels, current)
+            self.store('remove_gmail_labels', chunk, del_labels, current)
 
         if self.args.archive:
             self.app.LOG.info('archiving messages %d...%d from %s (%s)',
-                         chunk[0], chunk[-1], folder, self.args.label)
-            res = self.server.remove_gmail_labels(chunk, ['\\Inbox'])
+                              chunk[0], chunk[-1], folder, self.args.label)
+            self.store('remove_gmail_labels', chunk, ['\\Inbox'],
+                       current)
 
-        if self.args.show:
+    def fetch_messages(self, folder, messages):
+        '''Yield (chunk, response) for each chunk of messages, fetching
+        the next chunk in the background while the caller shows the
+        current one.'''
+
+        server = self.server
+        items = self.fetch_items()
+
+        def fetch(chunk):
             self.app.LOG.info('getting info for messages %d...%d from %s',
-                         chunk[0], chunk[-1], folder)
-            res = self.server.fetch(chunk, data=['ENVELOPE', 'X-GM-LABELS'])
-            for msg in sorted(res.keys()):
-                self.show_message(msg, res[msg])
+                              chunk[0], chunk[-1], folder)
+            # This runs in another thread, which needs its own scope.
+            with self.stats.scope(folder=folder), \
+                    self.chunk_sizers['fetch'].measure(len(chunk)):
+                return uid_fetch(server, chunk, items)
+
+        return prefetch(self.chunks(messages, 'fetch'), fetch)
+
+    def show_messages(self, folder, chunk, res):
+        with self.output_lock:
+            if self.args.output_format == 'text':
+                for msg in sorted(res.keys()):
+                    self.show_message(msg, res[msg])
+            else:
+                for msgid in chunk:
+                    if msgid not in res:
+                        continue
+
+                    record = self.make_record(folder, msgid, res[msgid])
+                    if self.args.output_format == 'jsonl':
+                        sys.stdout.write(json.dumps(record) + '\n')
+                    else:
+                        self.csv.writerow([csv_value(value)
+                                           for value in record.values()])
+
+            sys.stdout.flush()
+
+    def remove_messages(self, folder, chunk):
+        current = self.fetch_current(folder, chunk)
 
         if self.args.trash:
             self.app.LOG.info('trashing messages %d...%d from %s',
                               chunk[0], chunk[-1], folder)
-            res = self.server.add_gmail_labels(chunk, ['\\Trash'])
+            self.store('add_gmail_labels', chunk, ['\\Trash'], current)
 
         if self.args.delete:
             self.app.LOG.info('deleting messages %d...%d from %s',
-                         chunk[0], chunk[-1], folder)
-            res = self.server.delete_messages(chunk)
-            self.app.LOG.info('expunging messages %d...%d from %s',
                               chunk[0], chunk[-1], folder)
-            self.server.expunge()
+            self.store('delete_messages', chunk, current=current)
@@ -1,12 +1,15 @@
 from __future__ import absolute_import
 
 import cliff.command
-from copy import deepcopy
-from lxml import etree
-import argparse
 import datetime
 import sys
 import yaml
+import yaml.composer
+
+from gmailfilters.util import SafeLoader, load_yaml
+
+# lxml is imported where it is used, so that loading this module (for
+# example, for "gmf --help") stays fast.
 
 NS_FEED = 'http://www.w3.org/2005/Atom'
 NS_APP = 'http://schemas.google.com/apps/2006'
@@ -37,6 +40,15 @@ basic_props = [
     'subject',
 ]
 
+
+def condition_key(f):
+    '''Return a hashable key for the conditions (and non-label actions)
+    of a filter.  Two filters with the same key differ only in their
+    labels.'''
+
+    return tuple((prop, f[prop]) for prop in basic_props if prop in f)
+
+
 def same_condition(f1, f2):
     '''Deterine if two filters are identical.'''
 
@@ -45,15 +57,29 @@ def same_condition(f1, f2):
     if not ('label' in f1 and 'label' in f2):
         return False
 
-    for prop in basic_props:
-        inf1 = prop in f1
-        inf2 = prop in f2
-        if (inf1 and inf2) and not (f1[prop] == f2[prop]):
-            return False
-        elif (inf1 != inf2):
-            return False
+    return condition_key(f1) == condition_key(f2)
+
+
+def coalesce(filters):
+    '''Merge the labels of all filters with the same conditions into the
+    first such filter, wherever they appear.  Filters are otherwise kept
+    in the order in which they were first seen.'''
 
-    return True
+    merged = []
+    seen = {}
+    for filterdict in filters:
+        if 'label' not in filterdict:
+            merged.append(filterdict)
+            continue
+
+        key = condition_key(filterdict)
+        if key in seen:
+            seen[key]['label'] += ' %s' % filterdict['label']
+        else:
+            seen[key] = filterdict
+            merged.append(filterdict)
+
+    return merged
 
 
 def to_prop_str(v):
@@ -66,6 +92,149 @@ def to_prop_str(v):
         return str(v)
 
 
+def entry_to_dict(entry):
+    '''Return the properties of an Atom entry as a dictionary.'''
+
+    filterdict = {}
+    for prop in entry.iterfind('{%s}property' % NS_APP):
+        if prop.get('name').startswith('size'):
+            continue
+
+        filterdict[prop.get('name')] = prop.get('value')
+
+    return filterdict
+
+
+def make_entry(filter, updated):
+    '''Build an Atom entry with the basic properties of filter.  If the
+    filter has labels, the entry ends with an empty label property for
+    the caller to fill in.'''
+
+    from lxml import etree
+
+    entry = etree.Element('{%s}entry' % NS_FEED)
+    title = etree.SubElement(entry, '{%s}title' % NS_FEED)
+    title.text = 'Mail Filter'
+    cat = etree.SubElement(entry, '{%s}category' % NS_FEED)
+    cat.set('term', 'filter')
+    e_updated = etree.SubElement(entry, '{%s}updated' % NS_FEED)
+    e_updated.text = updated
+    cat = etree.SubElement(entry, '{%s}content' % NS_FEED)
+
+    for propname in basic_props:
+        if propname in filter:
+            prop = etree.SubElement(entry, '{%s}property' % NS_APP)
+            prop.set('name', propname)
+
+            # prop.set requires a string, so we call
+            # to_prop_str() to convert bools, ints, etc. to
+            # strings.
+            prop.set('value', to_prop_str(filter[propname]))
+
+    if 'label' in filter:
+        prop = etree.SubElement(entry, '{%s}property' % NS_APP)
+        prop.set('name', 'label')
+
+    return entry
+
+
+def write_entries(fd, filter, updated):
+    '''Write one Atom entry per label in filter (or a single entry if it
+    has no labels) to fd, a binary file, laid out as make_entry() and
+    pretty printing would lay them out.  The entries are written as
+    text: lxml's incremental writer would repeat the namespace
+    declarations of the feed on every entry.'''
+
+    from xml.sax.saxutils import escape, quoteattr
+
+    head = ('  <entry>\n'
+            '    <title>Mail Filter</title>\n'
+            '    <category term="filter"/>\n'
+            '    <updated>%s</updated>\n'
+            '    <content/>\n' % escape(updated))
+    for propname in basic_props:
+        if propname in filter:
+            head += '    <app:property name=%s value=%s/>\n' % (
+                quoteattr(propname), quoteattr(to_prop_str(filter[propname])))
+
+    if 'label' not in filter:
+        fd.write((head + '  </entry>\n').encode('utf-8'))
+        return
+
+    for label in filter['label'].split():
+        fd.write((head + '    <app:property name="label" value=%s/>\n'
+                  '  </entry>\n' % quoteattr(label)).encode('utf-8'))
+
+
+class StreamLoader(SafeLoader, yaml.composer.Composer):
+    '''A YAML loader that can compose one node at a time.  libyaml's
+    loader only composes whole documents, but the events that it parses
+    are all that the pure-Python Composer needs.'''
+
+    def __init__(self, stream):
+        super(StreamLoader, self).__init__(stream)
+        self.anchors = {}
+
+
+def iter_yaml_filters(fd):
+    '''Yield the filters in a YAML list one at a time, without loading
+    the whole document.'''
+
+    loader = StreamLoader(fd)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+
+        loader.get_event()
+        if not loader.check_event(yaml.SequenceStartEvent):
+            raise ValueError('filters must be a YAML list')
+        loader.get_event()
+
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node = loader.compose_node(None, None)
+            yield loader.construct_object(node, deep=True)
+
+            # Forget the objects constructed so far, so that memory use
+            # does not grow with the number of filters.
+            loader.constructed_objects = {}
+    finally:
+        loader.dispose()
+
+
+def iter_xml_filters(fd):
+    '''Yield the filters in an Atom export one at a time, discarding
+    each entry once it has been read.'''
+
+    from lxml import etree
+
+    for _, entry in etree.iterparse(fd, tag='{%s}entry' % NS_FEED):
+        yield entry_to_dict(entry)
+
+        entry.clear()
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
+
+
+def collapse(filters):
+    '''Merge the labels of consecutive filters with the same
+    conditions.  Unlike coalesce(), this only needs to remember one
+    filter at a time, so it is used when streaming.'''
+
+    pending = None
+    for filterdict in filters:
+        if pending is not None and same_condition(filterdict, pending):
+            pending['label'] += ' %s' % filterdict['label']
+            continue
+
+        if pending is not None:
+            yield pending
+        pending = filterdict
+
+    if pending is not None:
+        yield pending
+
+
 class ConvertFilters(cliff.command.Command):
     def get_parser(self, prog_name):
         p = super(ConvertFilters, self).get_parser(prog_name)
@@ -77,42 +246,70 @@ class ConvertFilters(cliff.command.Command):
                        action='store_false')
         p.add_argument('--output', '-o')
         p.add_argument('--no-collapse', '-n',
-                       action='store_true')
+                       action='store_true',
+                       help='Do not merge the labels of filters that have '
+                       'the same conditions')
+        p.add_argument('--stream',
+                       action='store_true',
+                       help='Read and write filters incrementally, so that '
+                       'memory use does not grow with the number of filters '
+                       '(with --fromxml, only adjacent filters are merged)')
         p.add_argument('input',
                        nargs='?')
 
         return p
 
     def take_action(self, args):
-        if args.toxml:
+        if args.toxml and args.stream:
+            self.cmd_toxml_stream(args)
+        elif args.toxml:
             self.cmd_toxml(args)
+        elif args.stream:
+            self.cmd_fromxml_stream(args)
         else:
             self.cmd_fromxml(args)
 
     def cmd_fromxml(self, args):
+        from lxml import etree
+
         with (sys.stdin if args.input is None else open(args.input)) as fd:
             doc = etree.parse(fd)
 
-        filters = []
-        for filter in doc.xpath('/feed:feed/feed:entry', namespaces=querymap):
-            filterdict = {}
-            for prop in filter.xpath('app:property', namespaces=querymap):
-                if prop.get('name').startswith('size'):
-                    continue
+        filters = [entry_to_dict(filter) for filter in
+                   doc.xpath('/feed:feed/feed:entry', namespaces=querymap)]
 
-                filterdict[prop.get('name')] = prop.get('value')
+        if not args.no_collapse:
+            filters = coalesce(filters)
 
-            if filters and not args.no_collapse and same_condition(filterdict, filters[-1]):
-                filters[-1]['label'] += ' %s' % filterdict['label']
-            else:
-                filters.append(filterdict)
-
-        with (sys.stdout if args.output is None else open(args.output, 'w')) as fd:
+        output = sys.stdout if args.output is None else open(args.output, 'w')
+        with output as fd:
             fd.write(yaml.dump(filters, default_flow_style=False))
 
+    def cmd_fromxml_stream(self, args):
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        with (stdin if args.input is None else open(args.input, 'rb')) as fd:
+            filters = iter_xml_filters(fd)
+            if not args.no_collapse:
+                filters = collapse(filters)
+
+            output = (sys.stdout if args.output is None
+                      else open(args.output, 'w'))
+            with output as outfd:
+                empty = True
+                for filterdict in filters:
+                    # Dumping a one-item list gives the same output as
+                    # the corresponding part of a dump of the whole list.
+                    yaml.dump([filterdict], outfd, default_flow_style=False)
+                    empty = False
+
+                if empty:
+                    yaml.dump([], outfd, default_flow_style=False)
+
     def cmd_toxml(self, args):
+        from lxml import etree
+
         with (sys.stdin if args.input is None else open(args.input)) as fd:
-            filters = yaml.safe_load(fd)
+            filters = load_yaml(fd)
 
         doc = etree.Element('{%s}feed' % NS_FEED, nsmap=nsmap)
         title = etree.SubElement(doc, '{%s}title' % NS_FEED)
@@ -121,34 +318,28 @@ class ConvertFilters(cliff.command.Command):
         now = datetime.datetime.utcnow().isoformat()
 
         for filter in filters:
-            entry = etree.Element('{%s}entry' % NS_FEED)
-            title = etree.SubElement(entry, '{%s}title' % NS_FEED)
-            title.text = 'Mail Filter'
-            cat = etree.SubElement(entry, '{%s}category' % NS_FEED)
-            cat.set('term', 'filter')
-            updated = etree.SubElement(entry, '{%s}updated' % NS_FEED)
-            updated.text = now
-            cat = etree.SubElement(entry, '{%s}content' % NS_FEED)
-
-            for propname in basic_props:
-                if propname in filter:
-                    prop = etree.SubElement(entry, '{%s}property' % NS_APP)
-                    prop.set('name', propname)
-
-                    # prop.set requires a string, so we call
-                    # to_prop_str() to convert bools, ints, etc. to
-                    # strings.
-                    prop.set('value', to_prop_str(filter[propname]))
-
             if 'label' in filter:
                 for label in filter['label'].split():
-                    e = deepcopy(entry)
-                    prop = etree.SubElement(e, '{%s}property' % NS_APP)
-                    prop.set('name', 'label')
-                    prop.set('value', label)
-                    doc.append(e)
+                    entry = make_entry(filter, now)
+                    entry[-1].set('value', label)
+                    doc.append(entry)
             else:
-                doc.append(entry)
+                doc.append(make_entry(filter, now))
 
-        with (sys.stdout if args.output is None else open(args.output, 'w')) as fd:
+        output = sys.stdout if args.output is None else open(args.output, 'w')
+        with output as fd:
             fd.write(etree.tostring(doc, pretty_print=True).decode())
+
+    def cmd_toxml_stream(self, args):
+        now = datetime.datetime.utcnow().isoformat()
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        output = stdout if args.output is None else open(args.output, 'wb')
+
+        with (sys.stdin if args.input is None else open(args.input)) as fd:
+            with output as outfd:
+                outfd.write(('<feed xmlns="%s" xmlns:app="%s">\n'
+                             '  <title>Mail Filters</title>\n' %
+                             (NS_FEED, NS_APP)).encode('utf-8'))
+                for filter in iter_yaml_filters(fd):
+                    write_entries(outfd, filter, now)
+                outfd.write(b'</feed>\n')
@@ -0,0 +1,307 @@
+import imaplib
+import os
+import select
+import socket
+import threading
+import time
+
+from gmailfilters import exceptions
+from gmailfilters import default
+from gmailfilters.cmd.applyfilters import ApplyFilters
+
+
+class WatchFilters(ApplyFilters):
+    '''Apply filters to new messages as they arrive.
+
+    Each selected folder is watched over its own connection, using IDLE
+    if the server supports it and polling with NOOP otherwise.  With
+    more folders than --max-connections, the folders are divided
+    between that many connections, and those that share a connection
+    are polled in turn with STATUS.  When messages arrive, only the new
+    UIDs are searched.  After an error, the connection is re-established
+    with exponential backoff, and messages that arrived in the meantime
+    are processed once it is.'''
+
+    def get_parser(self, prog_name):
+        p = super(WatchFilters, self).get_parser(prog_name)
+
+        g = p.add_argument_group('Watching')
+        g.add_argument('--no-idle',
+                       action='store_true',
+                       help='Poll for new messages even if the server '
+                       'supports IDLE')
+        g.add_argument('--poll-interval',
+                       default=default.poll_interval,
+                       type=float,
+                       help='How often (in seconds) to poll for new messages '
+                       'without IDLE')
+        g.add_argument('--idle-timeout',
+                       default=default.idle_timeout,
+                       type=float,
+                       help='How long (in seconds) to wait before restarting '
+                       'IDLE')
+        g.add_argument('--max-connections',
+                       default=default.watch_connections,
+                       type=int,
+                       help='Most connections to open (Gmail allows %d '
+                       'per account); folders beyond this many share '
+                       'connections and are polled' %
+                       default.gmail_connections)
+        g.add_argument('--max-backoff',
+                       default=default.max_backoff,
+                       type=float,
+                       help='Longest time (in seconds) to wait before '
+                       'reconnecting after an error')
+
+        return p
+
+    def prepare(self):
+        if self.args.incremental:
+            raise exceptions.InvalidOptions(
+                '--incremental cannot be used with watch-filters, which '
+                'only processes new messages')
+        if self.args.local_eval:
+            raise exceptions.InvalidOptions(
+                '--local-eval cannot be used with watch-filters, which '
+                'only searches new messages')
+        if self.args.shard:
+            raise exceptions.InvalidOptions(
+                '--shard cannot be used with watch-filters, which only '
+                'searches new messages')
+
+        if self.args.max_connections < 1:
+            raise exceptions.InvalidOptions(
+                '--max-connections must be at least 1')
+        if self.args.max_connections > default.gmail_connections:
+            self.app.LOG.warning(
+                '--max-connections %d is more than the %d connections that '
+                'Gmail allows for each account', self.args.max_connections,
+                default.gmail_connections)
+
+        self.filters_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.load_filters()
+
+    def load_filters(self):
+        self.filters_mtime = os.stat(self.args.filters).st_mtime
+        super(WatchFilters, self).prepare()
+
+    def reload_filters(self):
+        '''Compile the filters again if the filters file has changed.'''
+
+        with self.filters_lock:
+            if os.stat(self.args.filters).st_mtime == self.filters_mtime:
+                return
+
+            self.app.LOG.info('%s has changed; reloading filters',
+                              self.args.filters)
+            self.load_filters()
+
+    def process_account(self):
+        self.state = None
+        self.server = self.connect()
+
+        selected_folders = self.select_folders(self.args.folders)
+        if not selected_folders:
+            raise exceptions.NoMatchingFolders('No folders to process')
+
+        self.server.logout()
+        self.server = None
+
+        connections = min(len(selected_folders), self.args.max_connections)
+        if connections < len(selected_folders):
+            self.app.LOG.warning('watching %d folders over %d connections; '
+                                 'folders that share a connection are '
+                                 'polled every %s seconds',
+                                 len(selected_folders), connections,
+                                 self.args.poll_interval)
+
+        groups = [selected_folders[i::connections]
+                  for i in range(connections)]
+        threads = [threading.Thread(target=self.watch_folders, args=(group,))
+                   for group in groups]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        # Join with a timeout so that the main thread still receives
+        # KeyboardInterrupt.
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1)
+        finally:
+            self.stopping.set()
+
+        raise exceptions.WatchFailed('Stopped watching every folder')
+
+    def watch_folders(self, folders):
+        '''Apply the filters to messages that arrive in folders, over
+        one connection, until stopped.  A single folder is watched with
+        wait_for_messages(); several are polled in turn.'''
+
+        # The UIDVALIDITY of each folder, and the UID from which to look
+        # for new messages in it, kept across reconnections.
+        positions = {}
+        backoff = 1
+        while not self.stopping.is_set():
+            try:
+                self._local.server = self.connect()
+                if len(folders) == 1:
+                    folder = folders[0]
+                    with self.stats.scope(folder=folder):
+                        info = self.server.select_folder(folder)
+                        uidnext = self.start_position(folder, info,
+                                                      positions)
+                        backoff = 1
+                        self.watch_folder(folder, uidnext, positions)
+                else:
+                    statuses = self.folder_status(folders)
+                    for folder, status in statuses.items():
+                        self.start_position(folder, status, positions)
+                    backoff = 1
+                    self.poll_folders(folders, positions)
+            except (imaplib.IMAP4.error, socket.error,
+                    exceptions.StoreFailed) as exc:
+                self.app.LOG.error('error while watching %s: %s; '
+                                   'reconnecting in %d seconds',
+                                   ', '.join(folders), exc, backoff)
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, self.args.max_backoff)
+            except Exception:
+                self.app.LOG.exception('stopped watching %s',
+                                       ', '.join(folders))
+                return
+            finally:
+                self.disconnect()
+
+    def start_position(self, folder, status, positions):
+        '''Return the UID from which to look for new messages in folder,
+        given its status (from SELECT or STATUS), and record it in
+        positions if the folder has not been seen before or its
+        UIDVALIDITY has changed.'''
+
+        uidvalidity = status[b'UIDVALIDITY']
+        if folder in positions:
+            if positions[folder][0] == uidvalidity:
+                return positions[folder][1]
+
+            self.app.LOG.warning('UIDVALIDITY of %s has changed; ignoring '
+                                 'messages that arrived while disconnected',
+                                 folder)
+
+        positions[folder] = (uidvalidity, status[b'UIDNEXT'])
+        return status[b'UIDNEXT']
+
+    def watch_folder(self, folder, uidnext, positions):
+        '''Apply the filters to messages that arrive in the selected
+        folder, starting from uidnext, until stopped.'''
+
+        self.app.LOG.info('watching %s for messages with UID >= %d',
+                          folder, uidnext)
+        while not self.stopping.is_set():
+            uidnext = self.process_new_messages(folder, uidnext)
+            positions[folder] = (positions[folder][0], uidnext)
+            self.wait_for_messages(folder)
+
+    def poll_folders(self, folders, positions):
+        '''Every --poll-interval seconds, ask for the status of folders,
+        and apply the filters to the new messages in those whose UIDNEXT
+        has grown, until stopped.'''
+
+        self.app.LOG.info('polling %s for new messages', ', '.join(folders))
+        while not self.stopping.is_set():
+            for folder, status in sorted(self.folder_status(folders).items()):
+                uidnext = self.start_position(folder, status, positions)
+                if status[b'UIDNEXT'] <= uidnext:
+                    continue
+
+                with self.stats.scope(folder=folder):
+                    self.server.select_folder(folder)
+                    uidnext = self.process_new_messages(folder, uidnext)
+
+                # Gmail's folders share one UID space, so UIDNEXT grows
+                # when messages arrive in any of them.
+                positions[folder] = (positions[folder][0],
+                                     max(uidnext, status[b'UIDNEXT']))
+
+            self.stopping.wait(self.args.poll_interval)
+
+    def disconnect(self):
+        server, self._local.server = self._local.server, None
+        if server is None:
+            return
+
+        try:
+            server.logout()
+        except (imaplib.IMAP4.error, socket.error):
+            pass
+
+    def process_new_messages(self, folder, uidnext):
+        '''Apply the filters to the messages in the selected folder whose
+        UIDs are at least uidnext.  Return the UID after the last of
+        them, from which to continue next time.'''
+
+        # "UID n:*" always matches the last message in the folder, even
+        # if its UID is less than n.
+        messages = self.search(None, ['UID', '%d:*' % uidnext]).since(uidnext)
+        if not messages:
+            return uidnext
+
+        self.app.LOG.info('%d new messages in %s', len(messages), folder)
+        self.reload_filters()
+
+        start = time.time()
+        planner = self.plan_folder(folder, ['UID', messages.sequence_set()])
+        self.expunge_messages(folder, self.apply_plan(folder, planner))
+        self.app.LOG.info('filtered %d new messages in %s in %.2f seconds',
+                          len(messages), folder, time.time() - start)
+
+        return messages[-1] + 1
+
+    def wait_for_messages(self, folder):
+        '''Wait until the server reports that messages have arrived in
+        the selected folder, or until watch-filters is stopped.'''
+
+        server = self.server
+        idle = not self.args.no_idle and server.has_capability('IDLE')
+
+        while not self.stopping.is_set():
+            if idle:
+                responses = self.idle(server)
+            else:
+                self.stopping.wait(self.args.poll_interval)
+                responses = server.noop()[1]
+
+            if any(len(r) > 1 and r[1] == b'EXISTS' for r in responses):
+                return
+
+    def idle(self, server):
+        '''IDLE until the server sends a response, --idle-timeout
+        expires, or watch-filters is stopped.  Return the responses.'''
+
+        deadline = time.time() + self.args.idle_timeout
+        server.idle()
+        try:
+            while not self.stopping.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+
+                # Wake up regularly to check whether we are stopping.
+                readable, _, _ = select.select([server._sock], [], [],
+                                               min(remaining, 5))
+                if not readable:
+                    continue
+
+                responses = server.idle_check(timeout=0)
+                if responses:
+                    return responses
+
+                # idle_check returns nothing, rather than raising an
+                # error, once the server has closed the connection.
+                raise imaplib.IMAP4.abort('connection closed while idling')
+        finally:
+            server.idle_done()
+
+        return []
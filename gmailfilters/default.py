@@ -1,7 +1,36 @@
 import os
-import xdg.BaseDirectory
+
+# Equivalent to xdg.BaseDirectory.xdg_config_home and xdg_cache_home,
+# without importing pyxdg (which is not otherwise needed) every time gmf
+# starts.
+xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(
+    os.path.expanduser('~'), '.config')
+xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+    os.path.expanduser('~'), '.cache')
 
 chunk_size = 200
-config_path = os.path.join(xdg.BaseDirectory.xdg_config_home,
+chunk_min = 20
+chunk_max = 5000
+chunk_target = 1.0
+workers = 1
+account_workers = 4
+pipeline = 1
+status_window = 32
+max_command_rate = None
+max_bandwidth = None
+throttle_recovery = 60
+max_query_length = 1000
+poll_interval = 60
+idle_timeout = 600
+max_backoff = 300
+watch_connections = 10
+gmail_connections = 15
+retries = 3
+journal_interval = 5
+shard_size = 5000
+config_path = os.path.join(xdg_config_home,
                            'gmailfilters.yml')
-
+state_dir = os.path.join(xdg_config_home,
+                         'gmailfilters-state')
+journal_dir = os.path.join(state_dir, 'journal')
+cache_dir = os.path.join(xdg_cache_home, 'gmailfilters')
@@ -0,0 +1,98 @@
+from gmailfilters.uidset import UIDSet
+
+# The kind of value (labels or flags) that each IMAPClient store method
+# changes, and whether it adds (True) or removes (False) its values.
+methods = {
+    'add_gmail_labels': ('labels', True),
+    'remove_gmail_labels': ('labels', False),
+    'add_flags': ('flags', True),
+    'remove_flags': ('flags', False),
+    'delete_messages': ('flags', True),
+}
+
+
+def fetched_value(value):
+    '''Normalise a label or flag from a FETCH response, in which labels
+    are encoded in IMAP's modified UTF-7.  Labels and flags are both
+    compared without regard to case, as Gmail and IMAP do.'''
+
+    from imapclient import imap_utf7
+
+    if not isinstance(value, bytes):
+        value = value.encode('ascii', 'replace')
+    return imap_utf7.decode(value).lower()
+
+
+def stored_value(value):
+    '''Normalise a label or flag that is about to be stored.'''
+
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value.lower()
+
+
+def folder_label(folder):
+    '''Return the (normalised) label that every message in folder has,
+    or None.  Gmail may leave the label of the selected folder out of
+    X-GM-LABELS.'''
+
+    if folder is None:
+        return None
+    if folder.upper() == 'INBOX':
+        return u'\\inbox'
+    if folder.startswith('[Gmail]/') or folder.startswith('[Google Mail]/'):
+        return None
+    return stored_value(folder)
+
+
+class CurrentState(object):
+    '''The labels and flags of messages in the selected folder, fetched
+    before changing them, so that each STORE can be limited to the
+    messages whose labels or flags it would actually change.'''
+
+    def __init__(self, folder=None):
+        self.labels = {}
+        self.flags = {}
+        self.implicit = folder_label(folder)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, uid, labels, flags):
+        labels = set(fetched_value(x) for x in labels)
+        if self.implicit is not None:
+            labels.add(self.implicit)
+        self.labels[uid] = labels
+        self.flags[uid] = set(fetched_value(x) for x in flags)
+
+    def update(self, res):
+        '''Add the messages in a FETCH response that includes
+        X-GM-LABELS and FLAGS.'''
+
+        for uid, msg in res.items():
+            self.add(uid, msg.get(b'X-GM-LABELS', ()), msg.get(b'FLAGS', ()))
+
+    def changed(self, method, messages, values=None):
+        '''Return a UIDSet of those of messages that calling the store
+        method (such as add_gmail_labels) with values would change.
+        Messages whose state is unknown are assumed to need changing.'''
+
+        kind, adding = methods[method]
+        if method == 'delete_messages':
+            values = [u'\\deleted']
+        values = set(stored_value(x) for x in values or ())
+        if not values:
+            return UIDSet()
+
+        current = getattr(self, kind)
+        changed = []
+        for uid in messages:
+            have = current.get(uid)
+            if have is None:
+                changed.append(uid)
+            elif adding and not values <= have:
+                changed.append(uid)
+            elif not adding and values & have:
+                changed.append(uid)
+
+        return UIDSet(changed)
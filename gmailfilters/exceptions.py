@@ -1,17 +1,39 @@
 class GmailFilterError(Exception):
     pass
 
+
 class NoConfigurationFile(GmailFilterError):
     pass
 
+
 class NoSuchAccount(GmailFilterError):
     pass
 
+
 class NoMatchingMessages(GmailFilterError):
     pass
 
+
 class NoMatchingFolders(GmailFilterError):
     pass
 
+
 class InvalidOptions(GmailFilterError):
     pass
+
+
+class StoreFailed(GmailFilterError):
+    '''One or more pipelined STORE commands failed.  errors holds the
+    exception raised for each of them.'''
+
+    def __init__(self, message, errors=()):
+        super(StoreFailed, self).__init__(message)
+        self.errors = list(errors)
+
+
+class AccountsFailed(GmailFilterError):
+    pass
+
+
+class WatchFailed(GmailFilterError):
+    pass
@@ -0,0 +1,257 @@
+import collections
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Responses that mean the server wants us to slow down.  Gmail sends
+# [THROTTLED] when an account exceeds its command or bandwidth limits,
+# and [UNAVAILABLE] when it is (often for the same reason) temporarily
+# refusing service.
+throttle_codes = (b'[THROTTLED]', b'[UNAVAILABLE]')
+
+
+def throttle_response(line):
+    '''Return whether line is a NO, BAD or BYE response (tagged or
+    untagged) with one of the throttle_codes.'''
+
+    if not any(code in line for code in throttle_codes):
+        return False
+
+    words = line.split(None, 2)
+    return len(words) == 3 and words[1].upper() in (b'NO', b'BAD', b'BYE')
+
+
+class TokenBucket(object):
+    '''Tokens accumulate at rate per second, up to burst.  Taking
+    tokens may leave the bucket in debt, which must be repaid before
+    anyone can proceed.'''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        self.refill(now)
+        self.tokens -= amount
+
+    def delay(self, now):
+        '''Return how long it will be until the bucket is out of debt.'''
+
+        self.refill(now)
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def set_rate(self, rate, burst_seconds):
+        self.rate = rate
+        self.burst = max(1, rate * burst_seconds)
+        self.tokens = min(self.tokens, self.burst)
+
+
+class Governor(object):
+    '''Limits the rate of IMAP commands, and the bandwidth they use,
+    across every connection instrumented with instrument().
+
+    Each command takes a token from a bucket that fills at the command
+    rate, and waits if there is none left.  Bytes sent and received
+    are taken from a second bucket that fills at the byte rate, and a
+    command waits while that bucket is in debt.  A rate of None is
+    unlimited.
+
+    The limits adapt to the server (additive increase, multiplicative
+    decrease): when a response says the account is being throttled,
+    both rates are halved (an unlimited command rate starts from half
+    of the rate achieved over the last window seconds), and then they
+    grow back by a fixed step each second, over about recovery seconds,
+    up to their configured values (the command rate only up to margin
+    times the last rate that was throttled).  The rates keep being
+    halved for as long as commands sent after the last reduction are
+    throttled.'''
+
+    def __init__(self, commands_per_second=None, bytes_per_minute=None,
+                 recovery=60, burst_seconds=0.5, min_commands=0.5,
+                 holdoff=5.0, window=1.0, margin=0.9):
+        self.lock = threading.Lock()
+        self.recovery = recovery
+        self.burst_seconds = burst_seconds
+        self.min_commands = min_commands
+        self.holdoff = holdoff
+        self.window = window
+        self.margin = margin
+
+        self.commands = self.bytes = None
+        self.command_ceiling = commands_per_second
+        self.byte_ceiling = None
+        if commands_per_second:
+            self.commands = TokenBucket(commands_per_second,
+                                        commands_per_second * burst_seconds)
+        if bytes_per_minute:
+            self.byte_ceiling = bytes_per_minute / 60.0
+            self.bytes = TokenBucket(self.byte_ceiling,
+                                     self.byte_ceiling * burst_seconds)
+
+        self.recent = collections.deque()
+        self.adjusted = self.last_throttle = 0
+        self.throttles = 0
+        self.waited = 0.0
+
+    def instrument(self, server):
+        '''Wrap the methods of server's underlying imaplib connection so
+        that its commands and bytes are governed.'''
+
+        imap = server._imap
+        governor = self
+
+        new_tag = imap._new_tag
+        send = imap.send
+        read = imap.read
+        readline = imap.readline
+
+        # When each command still awaiting its tagged response was sent.
+        sent = {}
+
+        def _new_tag():
+            governor.acquire()
+            tag = new_tag()
+            sent[tag] = time.time()
+            return tag
+
+        def _send(data):
+            governor.transferred(len(data))
+            return send(data)
+
+        def _read(size):
+            data = read(size)
+            governor.transferred(len(data))
+            return data
+
+        def _readline():
+            line = readline()
+            governor.transferred(len(line))
+
+            when = None
+            if line.startswith(imap.tagpre):
+                when = sent.pop(line.split(None, 1)[0], None)
+            if throttle_response(line):
+                governor.throttled(line.strip().decode('utf-8', 'replace'),
+                                   when)
+            return line
+
+        imap._new_tag = _new_tag
+        imap.send = _send
+        imap.read = _read
+        imap.readline = _readline
+
+    def acquire(self):
+        '''Wait until another command may be sent.'''
+
+        with self.lock:
+            now = time.time()
+            self.increase(now)
+            self.recent.append(now)
+            while now - self.recent[0] > self.window:
+                self.recent.popleft()
+
+            delay = 0
+            if self.commands is not None:
+                self.commands.take(1, now)
+                delay = self.commands.delay(now)
+            if self.bytes is not None:
+                delay = max(delay, self.bytes.delay(now))
+            self.waited += delay
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def transferred(self, size):
+        if self.bytes is None:
+            return
+
+        with self.lock:
+            self.bytes.take(size, time.time())
+
+    def observed_rate(self, now):
+        '''Return the rate at which commands were sent over the last
+        window seconds, or None if there were none.'''
+
+        recent = sum(1 for t in self.recent if now - t <= self.window)
+        if not recent:
+            return None
+        return recent / float(self.window)
+
+    def throttled(self, reason=None, sent=None):
+        '''Slow down after the server says we are being throttled (or
+        after a failure that may be due to throttling).  sent is when
+        the refused command was sent, if known.
+
+        A refused command that was sent after the last reduction shows
+        that it was not enough, and always counts.  Otherwise, such as
+        for the responses to commands that were already in flight, or
+        for a lost connection, repeated signals within holdoff seconds
+        count once.'''
+
+        with self.lock:
+            now = time.time()
+            if sent is not None:
+                if sent < self.last_throttle:
+                    return
+            elif now - self.last_throttle < self.holdoff:
+                return
+            self.last_throttle = self.adjusted = now
+            self.throttles += 1
+
+            if self.commands is None:
+                rate = self.observed_rate(now) or 2 * self.min_commands
+                self.commands = TokenBucket(rate, rate * self.burst_seconds)
+
+            # The server refused the current rate, so recover to just
+            # below it rather than all the way back.
+            ceiling = self.commands.rate * self.margin
+            self.command_ceiling = min(self.command_ceiling or ceiling,
+                                       ceiling)
+
+            rate = max(self.min_commands, self.commands.rate / 2)
+            self.commands.set_rate(rate, self.burst_seconds)
+            self.commands.tokens = min(self.commands.tokens, 0)
+
+            if self.bytes is not None:
+                self.bytes.set_rate(max(1024, self.bytes.rate / 2),
+                                    self.burst_seconds)
+
+        LOG.warning('server is throttling commands (%s); slowing down to '
+                    '%.1f commands per second', reason or 'connection lost',
+                    rate)
+
+    def increase(self, now):
+        '''Raise the limits back towards their ceilings, at a rate that
+        takes recovery seconds to go from nothing to the ceiling.'''
+
+        elapsed = now - self.adjusted
+        if elapsed < 1 or not self.throttles:
+            return
+        self.adjusted = now
+
+        for bucket, ceiling in [(self.commands, self.command_ceiling),
+                                (self.bytes, self.byte_ceiling)]:
+            if bucket is not None and ceiling and bucket.rate < ceiling:
+                step = ceiling * elapsed / self.recovery
+                bucket.set_rate(min(ceiling, bucket.rate + step),
+                                self.burst_seconds)
+
+    def summary(self):
+        '''Return the number of times the server throttled us, the total
+        time spent waiting, and the current command rate limit (or
+        None).'''
+
+        with self.lock:
+            rate = self.commands.rate if self.commands is not None else None
+            return self.throttles, self.waited, rate
@@ -0,0 +1,283 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Entry(object):
+    '''Statistics for one combination of command, folder and filter.'''
+
+    __slots__ = ('count', 'seconds', 'max_seconds', 'bytes_sent',
+                 'bytes_received', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.histogram = [0] * len(buckets)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        for i, bound in enumerate(buckets):
+            if elapsed <= bound:
+                self.histogram[i] += 1
+                break
+
+    def merge(self, other):
+        self.count += other.count
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.histogram = [a + b for a, b in
+                          zip(self.histogram, other.histogram)]
+
+
+class Stats(object):
+    '''Records the number, latency and size of the IMAP commands sent
+    on instrumented connections.
+
+    Commands are counted under the scope (a folder and a filter) that
+    the thread sending them has set with scope().  Latency is measured
+    from the time a command's tag is allocated to the time its tagged
+    response arrives.  Bytes sent are counted against the command being
+    sent, and bytes received against the oldest command still waiting
+    for its response (or against "(untagged)" if there is none).'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.defaultdict(Entry)
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def scope(self, **kwargs):
+        '''Count commands sent by this thread in the enclosed block
+        against the given folder and/or filter.'''
+
+        previous = getattr(self.local, 'scope', {})
+        scope = dict(previous)
+        scope.update(kwargs)
+        self.local.scope = scope
+        try:
+            yield
+        finally:
+            self.local.scope = previous
+
+    def current_scope(self):
+        scope = getattr(self.local, 'scope', {})
+        return (scope.get('folder'), scope.get('filter'))
+
+    def entry(self, command, scope):
+        return self.entries[(command,) + scope]
+
+    def merge(self, entries):
+        '''Add entries recorded by another Stats object (for example,
+        in a worker process) to these.'''
+
+        with self.lock:
+            for key, entry in entries.items():
+                self.entries[key].merge(entry)
+
+    def instrument(self, server):
+        '''Wrap the methods of server's underlying imaplib connection so
+        that the commands sent on it are recorded.'''
+
+        imap = server._imap
+        stats = self
+        inflight = collections.OrderedDict()
+        sending = []
+
+        new_tag = imap._new_tag
+        send = imap.send
+        read = imap.read
+        readline = imap.readline
+        get_response = imap._get_response
+
+        def _new_tag():
+            tag = new_tag()
+            inflight[tag] = [None, time.time(), stats.current_scope()]
+            sending[:] = [tag]
+            return tag
+
+        def _send(data):
+            if sending:
+                tag = sending[0]
+                command = inflight[tag][0]
+                if command is None:
+                    inflight[tag][0] = command = command_name(data)
+                key = (command, inflight[tag][2])
+            else:
+                key = ('(untagged)', stats.current_scope())
+
+            with stats.lock:
+                stats.entry(*key).bytes_sent += len(data)
+            return send(data)
+
+        def count_received(data):
+            if inflight:
+                command, _, scope = next(iter(inflight.values()))
+                key = (command or '(unknown)', scope)
+            else:
+                key = ('(untagged)', stats.current_scope())
+
+            with stats.lock:
+                stats.entry(*key).bytes_received += len(data)
+            return data
+
+        def _read(size):
+            return count_received(read(size))
+
+        def _readline():
+            return count_received(readline())
+
+        def _get_response():
+            resp = get_response()
+
+            done = [tag for tag in inflight
+                    if imap.tagged_commands.get(tag) is not None]
+            now = time.time()
+            for tag in done:
+                command, start, scope = inflight.pop(tag)
+                if tag in sending:
+                    del sending[:]
+                with stats.lock:
+                    stats.entry(command or '(unknown)', scope).add(
+                        now - start)
+
+            return resp
+
+        imap._new_tag = _new_tag
+        imap.send = _send
+        imap.read = _read
+        imap.readline = _readline
+        imap._get_response = _get_response
+
+    def summary(self):
+        '''Return the entries as a list of dictionaries, sorted by total
+        time.'''
+
+        with self.lock:
+            items = list(self.entries.items())
+
+        summary = []
+        for (command, folder, filter), entry in items:
+            summary.append({
+                'command': command,
+                'folder': folder,
+                'filter': filter,
+                'count': entry.count,
+                'seconds': round(entry.seconds, 6),
+                'max_seconds': round(entry.max_seconds, 6),
+                'bytes_sent': entry.bytes_sent,
+                'bytes_received': entry.bytes_received,
+                'histogram': list(zip([str(b) for b in buckets],
+                                      entry.histogram)),
+            })
+
+        summary.sort(key=lambda e: (-e['seconds'], e['command'],
+                                    e['folder'] or '', e['filter'] or ''))
+        return summary
+
+    def write(self, fd, format='text'):
+        if format == 'json':
+            json.dump(self.summary(), fd, indent=2, sort_keys=True)
+            fd.write('\n')
+        elif format == 'prometheus':
+            self.write_prometheus(fd)
+        else:
+            self.write_text(fd)
+
+    def write_text(self, fd):
+        summary = self.summary()
+
+        totals = collections.OrderedDict()
+        for e in summary:
+            total = totals.setdefault(e['command'], [0, 0.0, 0, 0])
+            total[0] += e['count']
+            total[1] += e['seconds']
+            total[2] += e['bytes_sent']
+            total[3] += e['bytes_received']
+
+        fmt = '%-16s %8s %10s %10s %12s %12s\n'
+        fd.write(fmt % ('command', 'count', 'total (s)', 'mean (ms)',
+                        'bytes sent', 'bytes recv'))
+        for command, (count, seconds, sent, received) in totals.items():
+            fd.write(fmt % (command, count, '%.3f' % seconds,
+                            '%.1f' % (1000 * seconds / count) if count
+                            else '-', sent, received))
+
+        fd.write('\n')
+        fmt = '%-16s %8s %10s %10s  %s\n'
+        fd.write(fmt % ('command', 'count', 'total (s)', 'max (ms)',
+                        'folder / filter'))
+        for e in summary:
+            if not e['count']:
+                continue
+
+            where = e['folder'] or '-'
+            if e['filter']:
+                where += ' / ' + e['filter']
+            fd.write(fmt % (e['command'], e['count'],
+                            '%.3f' % e['seconds'],
+                            '%.1f' % (1000 * e['max_seconds']), where))
+
+    def write_prometheus(self, fd):
+        fd.write('# HELP gmf_imap_command_seconds Time from sending an '
+                 'IMAP command to receiving its tagged response.\n')
+        fd.write('# TYPE gmf_imap_command_seconds histogram\n')
+        fd.write('# HELP gmf_imap_sent_bytes_total Bytes sent.\n')
+        fd.write('# TYPE gmf_imap_sent_bytes_total counter\n')
+        fd.write('# HELP gmf_imap_received_bytes_total Bytes received.\n')
+        fd.write('# TYPE gmf_imap_received_bytes_total counter\n')
+
+        for e in self.summary():
+            labels = 'command="%s"' % prometheus_escape(e['command'])
+            for name in ['folder', 'filter']:
+                if e[name] is not None:
+                    labels += ',%s="%s"' % (name,
+                                            prometheus_escape(e[name]))
+
+            cumulative = 0
+            for bound, (_, count) in zip(buckets, e['histogram']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                fd.write('gmf_imap_command_seconds_bucket{%s,le="%s"} %d\n'
+                         % (labels, le, cumulative))
+            fd.write('gmf_imap_command_seconds_sum{%s} %f\n' % (
+                labels, e['seconds']))
+            fd.write('gmf_imap_command_seconds_count{%s} %d\n' % (
+                labels, e['count']))
+            fd.write('gmf_imap_sent_bytes_total{%s} %d\n' % (
+                labels, e['bytes_sent']))
+            fd.write('gmf_imap_received_bytes_total{%s} %d\n' % (
+                labels, e['bytes_received']))
+
+
+def command_name(data):
+    '''Extract the command name (such as "UID STORE") from the first
+    line of a command, which starts with its tag.'''
+
+    words = data.split(b' ', 3)
+    if len(words) < 2:
+        return '(unknown)'
+
+    name = words[1].strip().upper()
+    if name == b'UID' and len(words) > 2:
+        name += b' ' + words[2].strip().upper()
+
+    return name.decode('ascii', 'replace')
+
+
+def prometheus_escape(value):
+    return (value.replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
@@ -0,0 +1,167 @@
+import errno
+import hashlib
+import logging
+import os
+import threading
+import time
+import yaml
+
+from gmailfilters import default
+from gmailfilters.util import atomic_write, load_yaml
+
+LOG = logging.getLogger(__name__)
+
+
+class Journal(object):
+    '''Records the progress of a long-running job so that it can be
+    resumed after a failure.
+
+    For each folder, the journal holds the folder's UIDVALIDITY, the
+    messages that the job found in it (as a sequence set), the highest
+    UID completed so far by each phase of the job (such as labelling
+    or showing messages), and whether the folder is done.  A folder
+    that is processed in shards instead holds the shards that were
+    started, each of which has an entry of its own.  Phases
+    process messages in ascending UID order, so everything up to that
+    UID is known to be complete.
+
+    Progress is kept in memory as it is recorded, and written to the
+    journal file at most once every interval seconds (and whenever a
+    folder is started or finished), so that large jobs do not spend
+    their time rewriting it.'''
+
+    def __init__(self, path, interval=None):
+        if interval is None:
+            interval = default.journal_interval
+
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.folders = {}
+        self.saved = time.time()
+
+    @classmethod
+    def for_job(cls, account, job, journal_dir=None):
+        '''Return the journal for a job, identified by any value with a
+        stable repr() (such as a tuple of the options that affect which
+        messages it changes and how).'''
+
+        if journal_dir is None:
+            journal_dir = default.journal_dir
+
+        digest = hashlib.sha1(repr(job).encode('utf-8')).hexdigest()
+        return cls(os.path.join(journal_dir,
+                                '%s-%s.yml' % (account, digest[:16])))
+
+    def load(self):
+        '''Read the journal file, if there is one.  Return True if it
+        was found.'''
+
+        try:
+            with open(self.path) as fd:
+                data = load_yaml(fd) or {}
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return False
+
+        with self.lock:
+            self.folders = data.get('folders', {})
+        return True
+
+    def __len__(self):
+        with self.lock:
+            return len(self.folders)
+
+    def get(self, folder):
+        with self.lock:
+            return self.folders.get(folder)
+
+    def start(self, folder, uidvalidity, messages):
+        '''Record the messages (a UIDSet) that the job will process in
+        folder.'''
+
+        with self.lock:
+            self.folders[folder] = {
+                'uidvalidity': uidvalidity,
+                'messages': messages.sequence_set(),
+                'progress': {},
+                'done': False,
+            }
+            self.save()
+
+    def shards(self, folder, uidvalidity):
+        '''Return the shards (see Shard.encode) of folder that were
+        started while its UIDVALIDITY was uidvalidity.'''
+
+        with self.lock:
+            entry = self.folders.get(folder, {})
+            if entry.get('uidvalidity') != uidvalidity:
+                return []
+            return list(entry.get('shards', []))
+
+    def add_shard(self, folder, uidvalidity, shard):
+        '''Record that a shard of folder (which is processed in shards,
+        each with its own entry) has been started.'''
+
+        with self.lock:
+            entry = self.folders.setdefault(folder, {})
+            if entry.get('uidvalidity') != uidvalidity:
+                entry.update(uidvalidity=uidvalidity, shards=[])
+            entry.setdefault('shards', []).append(shard)
+            self.save()
+
+    def progress(self, folder, phase):
+        '''Return the highest UID completed by phase in folder, or 0.'''
+
+        with self.lock:
+            return self.folders[folder]['progress'].get(phase, 0)
+
+    def due(self):
+        '''Return whether the journal will be written on the next
+        update.'''
+
+        return time.time() - self.saved >= self.interval
+
+    def update(self, folder, phase, uid):
+        '''Record that phase has completed every message in folder up to
+        and including uid.'''
+
+        with self.lock:
+            self.folders[folder]['progress'][phase] = uid
+            if self.due():
+                self.save()
+
+    def finish(self, folder):
+        '''Record that folder is done.  A folder that was processed in
+        shards (each with its own entry) may not have been started.'''
+
+        with self.lock:
+            self.folders.setdefault(folder, {})['done'] = True
+            self.save()
+
+    def done(self, folder):
+        with self.lock:
+            return self.folders.get(folder, {}).get('done', False)
+
+    def flush(self):
+        with self.lock:
+            self.save()
+
+    def save(self):
+        with atomic_write(self.path) as fd:
+            yaml.safe_dump({'folders': self.folders}, fd,
+                           default_flow_style=False)
+        self.saved = time.time()
+        LOG.debug('wrote journal to %s', self.path)
+
+    def remove(self):
+        '''Delete the journal file once the job is complete.'''
+
+        try:
+            os.unlink(self.path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        else:
+            LOG.debug('removed journal %s', self.path)
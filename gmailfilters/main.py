@@ -1,18 +1,51 @@
 import cliff
 import cliff.app
 import cliff.commandmanager
+import importlib
 import os
 import sys
-import yaml
 
 from gmailfilters import default
+from gmailfilters.util import load_yaml
+
+# The commands that gmf provides.  These are also registered as gmf.cmd
+# entry points (see setup.cfg), but finding them here means that gmf
+# does not have to scan and resolve entry points each time it starts.
+commands = {
+    'convert-filters': 'gmailfilters.cmd.convertfilters:ConvertFilters',
+    'bulk-filter': 'gmailfilters.cmd.bulkfilter:BulkFilter',
+    'apply-filters': 'gmailfilters.cmd.applyfilters:ApplyFilters',
+    'watch-filters': 'gmailfilters.cmd.watchfilters:WatchFilters',
+    'dump-config': 'gmailfilters.cmd.dumpconfig:DumpConfig',
+}
+
+
+class LazyCommand(object):
+    '''Stands in for an entry point in the command manager, importing
+    the command's module only when the command is used.'''
+
+    def __init__(self, name, target):
+        self.name = name
+        self.target = target
+
+    def load(self, require=False):
+        module, _, attr = self.target.partition(':')
+        return getattr(importlib.import_module(module), attr)
+
+
+class CommandManager(cliff.commandmanager.CommandManager):
+    def __init__(self):
+        super(CommandManager, self).__init__(None)
+        for name, target in commands.items():
+            self.commands[name] = LazyCommand(name, target)
+
 
 class GmailFilterApp (cliff.app.App):
     def __init__(self):
         super(GmailFilterApp, self).__init__(
             description='Gmail filtering tool',
             version='0.1',
-            command_manager=cliff.commandmanager.CommandManager('gmf.cmd'),
+            command_manager=CommandManager(),
             deferred_help=True,
         )
 
@@ -20,7 +53,7 @@ class GmailFilterApp (cliff.app.App):
         p = super(GmailFilterApp, self).build_option_parser(*args, **kwargs)
 
         p.add_argument('--config', '-f',
-                     help='Path to configuration file')
+                       help='Path to configuration file')
 
         return p
 
@@ -34,12 +67,11 @@ class GmailFilterApp (cliff.app.App):
 
         if self.options.config:
             self.LOG.debug('reading configuration from %s',
-                               self.options.config)
+                           self.options.config)
             with open(self.options.config) as fd:
-                self.config = yaml.safe_load(fd)
+                self.config = load_yaml(fd)
 
 
 def main(argv=sys.argv[1:]):
     app = GmailFilterApp()
     return app.run(argv)
-
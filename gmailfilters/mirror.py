@@ -0,0 +1,318 @@
+import collections
+import email.header
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from gmailfilters.uidset import UIDSet
+
+LOG = logging.getLogger(__name__)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS folders (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    highestmodseq INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    folder INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    msgid INTEGER,
+    sender TEXT,
+    recipients TEXT,
+    subject TEXT,
+    labels TEXT,
+    flags TEXT,
+    PRIMARY KEY (folder, uid)
+);
+CREATE TABLE IF NOT EXISTS addresses (
+    folder INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    address TEXT NOT NULL,
+    rdomain TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS addresses_address
+    ON addresses (folder, field, address);
+CREATE INDEX IF NOT EXISTS addresses_rdomain
+    ON addresses (folder, field, rdomain);
+CREATE INDEX IF NOT EXISTS addresses_uid ON addresses (folder, uid);
+CREATE TABLE IF NOT EXISTS words (
+    folder INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    word TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS words_word ON words (folder, word);
+CREATE INDEX IF NOT EXISTS words_uid ON words (folder, uid);
+'''
+
+Folder = collections.namedtuple('Folder', ['id', 'uidvalidity',
+                                           'highestmodseq'])
+
+# Filter values that the mirror can evaluate: a single word for
+# subject, and an address ("user@example.com") or domain
+# ("@example.com" or "example.com", which also matches subdomains) for
+# from and to.  Anything else (operators, quoting, grouping, several
+# terms) is left to the server.
+subject_re = re.compile(r'^\w+$', re.UNICODE)
+address_re = re.compile(r'^(\w[\w.+\-]*)?@?\w[\w\-]*(\.[\w\-]+)+$',
+                        re.UNICODE)
+
+
+def local_conditions(filter):
+    '''Return the (field, value) conditions of a filter (all of which
+    must match), if the mirror can evaluate every part of it, or
+    None.'''
+
+    if 'hasTheWord' in filter:
+        return None
+
+    conditions = []
+    for field in ['from', 'to', 'subject']:
+        if field not in filter:
+            continue
+
+        value = filter[field].strip().lower()
+        pattern = subject_re if field == 'subject' else address_re
+        if not pattern.match(value):
+            return None
+
+        conditions.append((field, value))
+
+    return conditions or None
+
+
+def to_text(value):
+    if value is None:
+        return u''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def decode_subject(value):
+    '''Decode the RFC 2047 encoded words in a subject.'''
+
+    value = to_text(value)
+    if '=?' not in value:
+        return value
+
+    parts = []
+    for text, charset in email.header.decode_header(value):
+        if isinstance(text, bytes):
+            try:
+                text = text.decode(charset or 'ascii', 'replace')
+            except LookupError:
+                text = text.decode('utf-8', 'replace')
+        parts.append(text)
+
+    return u' '.join(parts)
+
+
+def envelope_addresses(addrs):
+    '''Return the lower-cased email addresses in an ENVELOPE address
+    list.'''
+
+    addresses = []
+    for addr in addrs or ():
+        if addr.mailbox and addr.host:
+            address = u'%s@%s' % (to_text(addr.mailbox), to_text(addr.host))
+            addresses.append(address.lower())
+
+    return addresses
+
+
+def reverse_domain(domain):
+    '''Reverse the labels of a domain ("mail.example.com" becomes
+    "com.example.mail"), so that a domain and its subdomains can be
+    found with a range scan of an index.'''
+
+    return u'.'.join(reversed(domain.split(u'.')))
+
+
+class Mirror(object):
+    '''A local SQLite copy of the UIDs, Gmail message ids, senders,
+    recipients, subjects, labels and flags of the messages in some
+    folders.
+
+    Senders and recipients (To and Cc) are indexed by address and
+    domain, and subjects by word, so that the simple from, to and
+    subject filters returned by local_conditions() can be evaluated
+    with indexed lookups.  Each thread uses its own connection.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        db = self.db
+        db.executescript(schema)
+        db.commit()
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+
+        return db
+
+    def folder(self, name):
+        '''Return the Folder record for the named folder, or None.'''
+
+        row = self.db.execute(
+            'SELECT id, uidvalidity, highestmodseq FROM folders '
+            'WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+
+        return Folder(*row)
+
+    def reset_folder(self, name, uidvalidity):
+        '''Forget everything about the named folder, and start mirroring
+        it again with the given UIDVALIDITY.'''
+
+        db = self.db
+        folder = self.folder(name)
+        if folder is not None:
+            for table in ['messages', 'addresses', 'words']:
+                db.execute('DELETE FROM %s WHERE folder = ?' % table,
+                           (folder.id,))
+            db.execute('DELETE FROM folders WHERE id = ?', (folder.id,))
+
+        db.execute('INSERT INTO folders (name, uidvalidity) VALUES (?, ?)',
+                   (name, uidvalidity))
+        return self.folder(name)
+
+    def set_highestmodseq(self, folder, highestmodseq):
+        self.db.execute('UPDATE folders SET highestmodseq = ? WHERE id = ?',
+                        (highestmodseq, folder.id))
+
+    def commit(self):
+        self.db.commit()
+
+    def uids(self, folder):
+        return UIDSet(row[0] for row in self.db.execute(
+            'SELECT uid FROM messages WHERE folder = ?', (folder.id,)))
+
+    def add_messages(self, folder, messages):
+        '''Add or replace messages, given as a dictionary mapping UIDs to
+        FETCH responses that include ENVELOPE, X-GM-MSGID, X-GM-LABELS
+        and FLAGS.'''
+
+        db = self.db
+        uids = list(messages)
+        self.remove_messages(folder, uids)
+
+        rows = []
+        addresses = []
+        words = []
+        for uid in uids:
+            msg = messages[uid]
+            envelope = msg[b'ENVELOPE']
+            senders = envelope_addresses(envelope.from_)
+            recipients = envelope_addresses(envelope.to)
+            recipients.extend(envelope_addresses(envelope.cc))
+            subject = decode_subject(envelope.subject)
+
+            rows.append((folder.id, uid, msg.get(b'X-GM-MSGID'),
+                         u', '.join(senders), u', '.join(recipients),
+                         subject) + self.labels_and_flags(msg))
+
+            for field, values in [('from', senders), ('to', recipients)]:
+                for address in set(values):
+                    domain = address.rpartition(u'@')[2]
+                    addresses.append((folder.id, uid, field, address,
+                                      reverse_domain(domain)))
+
+            for word in set(re.findall(r'\w+', subject.lower(), re.UNICODE)):
+                words.append((folder.id, uid, word))
+
+        db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       rows)
+        db.executemany('INSERT INTO addresses VALUES (?, ?, ?, ?, ?)',
+                       addresses)
+        db.executemany('INSERT INTO words VALUES (?, ?, ?)', words)
+
+    def update_messages(self, folder, messages):
+        '''Update the labels and flags of messages, given as a dictionary
+        mapping UIDs to FETCH responses that include X-GM-LABELS and
+        FLAGS.'''
+
+        self.db.executemany(
+            'UPDATE messages SET labels = ?, flags = ? '
+            'WHERE folder = ? AND uid = ?',
+            [self.labels_and_flags(msg) + (folder.id, uid)
+             for uid, msg in messages.items()])
+
+    def labels_and_flags(self, msg):
+        return (json.dumps([to_text(x) for x in msg.get(b'X-GM-LABELS', ())]),
+                json.dumps([to_text(x) for x in msg.get(b'FLAGS', ())]))
+
+    def labels_and_flags_of(self, folder, uids):
+        '''Yield (uid, labels, flags) for each of uids (a UIDSet) that is
+        in the mirror of folder.'''
+
+        for uid, labels, flags in self.db.execute(
+                'SELECT uid, labels, flags FROM messages WHERE folder = ?',
+                (folder.id,)):
+            if uid in uids:
+                yield uid, json.loads(labels), json.loads(flags)
+
+    def remove_messages(self, folder, uids):
+        db = self.db
+        for table in ['messages', 'addresses', 'words']:
+            db.executemany('DELETE FROM %s WHERE folder = ? AND uid = ?' %
+                           table, [(folder.id, uid) for uid in uids])
+
+    def evaluate(self, folder, conditions):
+        '''Return a UIDSet of the mirrored messages in folder that match
+        all of conditions (as returned by local_conditions()).'''
+
+        result = None
+        for field, value in conditions:
+            matches = UIDSet(row[0] for row in self.lookup(folder, field,
+                                                           value))
+            result = matches if result is None else result & matches
+            if not result:
+                break
+
+        return result if result is not None else UIDSet()
+
+    def lookup(self, folder, field, value):
+        if field == 'subject':
+            return self.db.execute(
+                'SELECT uid FROM words WHERE folder = ? AND word = ?',
+                (folder.id, value))
+
+        if not value.startswith('@') and '@' in value:
+            return self.db.execute(
+                'SELECT uid FROM addresses '
+                'WHERE folder = ? AND field = ? AND address = ?',
+                (folder.id, field, value))
+
+        if value.startswith('@'):
+            return self.db.execute(
+                'SELECT uid FROM addresses '
+                'WHERE folder = ? AND field = ? AND rdomain = ?',
+                (folder.id, field, reverse_domain(value[1:])))
+
+        # A bare domain also matches its subdomains: "com.example" and
+        # everything from "com.example." up to (but not including)
+        # "com.example/", the next character after ".".
+        rdomain = reverse_domain(value)
+        return self.db.execute(
+            'SELECT uid FROM addresses '
+            'WHERE folder = ? AND field = ? AND '
+            '(rdomain = ? OR (rdomain >= ? AND rdomain < ?))',
+            (folder.id, field, rdomain, rdomain + u'.', rdomain + u'/'))
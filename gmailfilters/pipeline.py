@@ -0,0 +1,125 @@
+import collections
+import imaplib
+import logging
+import time
+
+import imapclient.imapclient
+
+from gmailfilters import exceptions
+
+LOG = logging.getLogger(__name__)
+
+# STORE items for each of the store methods of IMAPClient that the
+# pipeline supports, and whether their values are Gmail labels (which
+# must be quoted) rather than flags.
+store_items = {
+    'add_flags': (b'+FLAGS', False),
+    'remove_flags': (b'-FLAGS', False),
+    'add_gmail_labels': (b'+X-GM-LABELS', True),
+    'remove_gmail_labels': (b'-X-GM-LABELS', True),
+    'delete_messages': (b'+FLAGS', False),
+}
+
+
+def store_args(server, method, chunk, values=None):
+    '''Return the arguments of the silent UID STORE command that the
+    IMAPClient method (such as add_gmail_labels) of server would send
+    for chunk (a UIDSet), with chunk as a compressed sequence set.'''
+
+    item, labels = store_items[method]
+    if method == 'delete_messages':
+        values = [imapclient.DELETED]
+    if labels:
+        values = server._normalise_labels(values)
+
+    return (imapclient.imapclient.join_message_ids(chunk.sequence_set()),
+            item + b'.SILENT',
+            imapclient.imapclient.seq_to_parenstr(values))
+
+
+class StorePipeline(object):
+    '''Keeps several UID STORE commands in flight on one connection.
+
+    imaplib matches tagged responses to commands by tag, so a command
+    can be sent before the responses to earlier commands have arrived.
+    store() sends a command without waiting for its response, first
+    completing the oldest outstanding command if window commands are
+    already in flight; wait() completes the rest.  Commands use the
+    .SILENT form of STORE, so that the server does not send back the
+    new flags or labels of every message.
+
+    A command that fails is logged and remembered along with its
+    chunk, and the remaining commands are still completed; wait() then
+    raises StoreFailed.  If sizer is given, it records the time between
+    the completion of each command and the completion (or sending) of
+    the one before it.'''
+
+    def __init__(self, server, window, sizer=None):
+        self.server = server
+        self.window = window
+        self.sizer = sizer
+        self.inflight = collections.deque()
+        self.errors = []
+        self.last = None
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def store(self, method, chunk, values=None):
+        '''Send the STORE command that the IMAPClient method (such as
+        add_gmail_labels) would send for chunk.'''
+
+        if not chunk:
+            return
+
+        while len(self.inflight) >= self.window:
+            self.complete()
+
+        tag = self.server._imap._command(
+            'UID', 'STORE', *store_args(self.server, method, chunk, values))
+
+        sent = time.time()
+        if not self.inflight:
+            self.last = sent
+        self.inflight.append((tag, method, chunk))
+
+    def complete(self):
+        '''Wait for the response to the oldest command in flight.'''
+
+        tag, method, chunk = self.inflight.popleft()
+        imap = self.server._imap
+        try:
+            typ, data = imap._command_complete('UID', tag)
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(
+                    imapclient.imapclient.to_unicode(data[0]))
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as exc:
+            LOG.error('%s on messages %d...%d failed: %s',
+                      method, chunk[0], chunk[-1], exc)
+            self.errors.append((method, chunk, exc))
+        finally:
+            # Silent stores can still produce untagged FETCH responses
+            # (for example, when another client changes the same
+            # messages); nobody will read them.
+            imap.untagged_responses.pop('FETCH', None)
+
+        now = time.time()
+        if self.sizer is not None:
+            self.sizer.record(len(chunk), now - self.last)
+        self.last = now
+
+    def wait(self):
+        '''Wait for every command in flight, then raise StoreFailed if
+        any command failed since the last call to wait().'''
+
+        while self.inflight:
+            self.complete()
+
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise exceptions.StoreFailed(
+                '%d STORE commands failed (first error: %s)' % (
+                    len(errors), errors[0][2]),
+                [exc for method, chunk, exc in errors])
@@ -0,0 +1,91 @@
+import contextlib
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    '''A bounded pool of logged-in IMAP connections.
+
+    Connections are created on demand by calling factory() until there
+    are size of them; after that, callers wait for a connection to be
+    returned to the pool.'''
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.created = 0
+        self.owned = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def add(self, conn):
+        '''Add an existing connection to the pool.  The pool will not
+        log out of connections that it did not create.'''
+
+        with self.lock:
+            self.created += 1
+        self.idle.put(conn)
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if not create:
+            return self.idle.get()
+
+        try:
+            conn = self.factory()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+        with self.lock:
+            self.owned.append(conn)
+        return conn
+
+    def put(self, conn):
+        self.idle.put(conn)
+
+    def replace(self, old, new):
+        '''Record that new (a connection created outside the pool) has
+        taken the place of old, which the caller has discarded.'''
+
+        with self.lock:
+            if old in self.owned:
+                self.owned.remove(old)
+            self.owned.append(new)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+    def close(self):
+        '''Log out of all the connections created by the pool.'''
+
+        with self.lock:
+            owned, self.owned = self.owned, []
+
+        for conn in owned:
+            try:
+                conn.logout()
+            except Exception as exc:
+                LOG.debug('failed to log out: %s', exc)
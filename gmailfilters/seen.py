@@ -0,0 +1,68 @@
+import array
+import bisect
+import threading
+
+# Gmail message ids are 64 bits.  Python 2's array module has no 'Q'
+# type code, but 'L' is 64 bits on the platforms where that matters.
+try:
+    array.array('Q')
+    typecode = 'Q'
+except ValueError:
+    typecode = 'L'
+
+
+class SeenSet(object):
+    '''A thread-safe set of Gmail message ids (X-GM-MSGID).
+
+    Ids are kept in a sorted array of 64-bit integers, which takes a
+    fraction of the memory of a set of Python ints.  Newly added ids
+    go into a small set first, which is merged into the array once it
+    grows to a fraction of the array's size, so that adding n ids costs
+    O(n log n) overall rather than O(n) per id.'''
+
+    def __init__(self, merge_ratio=8):
+        self.ids = array.array(typecode)
+        self.recent = set()
+        self.merge_ratio = merge_ratio
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ids) + len(self.recent)
+
+    def __contains__(self, msgid):
+        with self.lock:
+            return self._contains(msgid)
+
+    def _contains(self, msgid):
+        if msgid in self.recent:
+            return True
+
+        i = bisect.bisect_left(self.ids, msgid)
+        return i < len(self.ids) and self.ids[i] == msgid
+
+    def claim(self, msgids):
+        '''Add msgids to the set.  Return a list of booleans that are
+        true for the ids that were not already in the set (including
+        only the first of any repeated id).'''
+
+        with self.lock:
+            claimed = []
+            for msgid in msgids:
+                if self._contains(msgid):
+                    claimed.append(False)
+                else:
+                    self.recent.add(msgid)
+                    claimed.append(True)
+
+            if len(self.recent) * self.merge_ratio > len(self.ids):
+                self._merge()
+
+            return claimed
+
+    def _merge(self):
+        ids = list(self.ids)
+        ids.extend(self.recent)
+        ids.sort()
+        self.ids = array.array(typecode, ids)
+        self.recent = set()
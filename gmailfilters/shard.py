@@ -0,0 +1,179 @@
+import collections
+import datetime
+import threading
+
+
+class Shard(collections.namedtuple('Shard', ['kind', 'start', 'end'])):
+    '''Part of a folder: the messages with UIDs from start up to (but
+    not including) end, if kind is 'uid', or the messages dated from
+    start up to (but not including) end, if kind is 'date'.  A date
+    shard with a start or end of None is open at that end.'''
+
+    __slots__ = ()
+
+    def restrict(self, query, criteria=None):
+        '''Return the Gmail query and IMAP search criteria that select
+        the messages in this shard that match query and criteria.'''
+
+        criteria = list(criteria or [])
+        if self.kind == 'uid':
+            criteria.extend(['UID', '%d:%d' % (self.start, self.end - 1)])
+            return query, criteria
+
+        terms = []
+        if self.start is not None:
+            terms.append('after:%s' % self.start.strftime('%Y/%m/%d'))
+        if self.end is not None:
+            terms.append('before:%s' % self.end.strftime('%Y/%m/%d'))
+        if not terms:
+            return query, criteria
+        if query:
+            terms.insert(0, '(%s)' % query)
+        return ' '.join(terms), criteria
+
+    def encode(self):
+        '''Return the shard as a list of strings and integers, to store
+        in a journal.'''
+
+        if self.kind == 'uid':
+            return [self.kind, self.start, self.end]
+        return [self.kind] + [None if x is None else x.isoformat()
+                              for x in (self.start, self.end)]
+
+    @classmethod
+    def decode(cls, value):
+        '''Return the shard encoded as value by encode().'''
+
+        kind, start, end = value
+        if kind == 'uid':
+            return cls(kind, start, end)
+
+        def parse(date):
+            if date is None:
+                return None
+            return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+        return cls(kind, parse(start), parse(end))
+
+    def size(self):
+        '''Return the number of UIDs or days that the shard spans, or
+        None if it is open.'''
+
+        if self.start is None or self.end is None:
+            return None
+        if self.kind == 'uid':
+            return self.end - self.start
+        return (self.end - self.start).days
+
+    def __str__(self):
+        if self.kind == 'uid':
+            return 'UIDs %d:%d' % (self.start, self.end - 1)
+        return '%s to %s' % (self.start or 'the beginning',
+                             self.end or 'now')
+
+
+class Sharder(object):
+    '''Divides a range of UIDs or dates into shards that each hold
+    about target messages.
+
+    The size of each shard is chosen from the density of matching
+    messages (per UID or per day), which starts from an estimate and
+    is updated as record() reports how many messages each shard held.
+    Shards are handed out in order by next(), which (like record()) may
+    be called from several threads at once.  replay() makes it hand out
+    the shards of an earlier attempt again before continuing after
+    them.'''
+
+    def __init__(self, kind, start, end, density, target):
+        self.kind = kind
+        self.position = start
+        self.end = end
+        self.density = density
+        self.target = target
+        self.lock = threading.Lock()
+        self.first = kind == 'date'
+        self.done = False
+        self.planned = []
+
+    @classmethod
+    def by_uid(cls, uidnext, messages, target):
+        '''Shard UIDs 1 up to uidnext, in which there are messages
+        messages.'''
+
+        return cls('uid', 1, uidnext, float(messages) / max(uidnext - 1, 1),
+                   target)
+
+    @classmethod
+    def by_date(cls, oldest, messages, target, today=None):
+        '''Shard the days from oldest (the date of the oldest message)
+        to today, in which there are messages messages.  The first shard
+        includes any messages older than oldest, and the last any newer
+        than today.'''
+
+        if today is None:
+            today = datetime.date.today()
+        end = today + datetime.timedelta(days=1)
+        days = max((end - oldest).days, 1)
+        return cls('date', oldest, end, float(messages) / days, target)
+
+    def replay(self, shards):
+        '''Hand out shards (which must be the first shards that an
+        earlier Sharder of the same kind handed out, in any order)
+        before any new ones, so that their boundaries are the same.'''
+
+        shards = sorted(shards, key=lambda x: (x.start is not None,
+                                               x.start))
+        if not shards:
+            return
+
+        with self.lock:
+            self.planned = shards
+            self.first = False
+            last = shards[-1].end
+            if last is None or (self.kind == 'uid' and last >= self.end):
+                self.done = True
+            else:
+                self.position = last
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if self.planned:
+                return self.planned.pop(0)
+            if self.done:
+                raise StopIteration()
+
+            size = self.target / max(self.density, 1e-9)
+            if self.kind == 'uid':
+                step = max(1, int(size))
+                start = self.position
+                end = min(self.end, start + step)
+                self.done = end >= self.end
+            else:
+                step = datetime.timedelta(days=max(1, min(int(size), 36500)))
+                start = self.position
+                end = start + step
+                if end >= self.end:
+                    end = None
+                    self.done = True
+                if self.first:
+                    start = None
+                    self.first = False
+
+            self.position = end
+            return Shard(self.kind, start, end)
+
+    next = __next__
+
+    def record(self, shard, count):
+        '''Record that shard held count messages, and adjust the density
+        used to size later shards.'''
+
+        size = shard.size()
+        if not size:
+            return
+
+        with self.lock:
+            self.density = (self.density + float(count) / size) / 2
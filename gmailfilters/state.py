@@ -0,0 +1,52 @@
+import errno
+import logging
+import os
+import threading
+import yaml
+
+from gmailfilters import default
+from gmailfilters.util import atomic_write, load_yaml
+
+LOG = logging.getLogger(__name__)
+
+
+class StateFile(object):
+    '''Per-folder checkpoints for one account, stored as a YAML
+    document mapping folder names to checkpoints.  A checkpoint is a
+    dictionary with (at least) uidvalidity and uidnext keys, and
+    highestmodseq if the server supports CONDSTORE.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.folders = {}
+
+        try:
+            with open(path) as fd:
+                self.folders = load_yaml(fd) or {}
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    @classmethod
+    def for_account(cls, account, state_dir=None):
+        if state_dir is None:
+            state_dir = default.state_dir
+
+        return cls(os.path.join(state_dir, '%s.yml' % account))
+
+    def get(self, folder):
+        with self.lock:
+            return self.folders.get(folder)
+
+    def update(self, folder, checkpoint):
+        '''Record a new checkpoint for folder and write the state file.'''
+
+        with self.lock:
+            self.folders[folder] = checkpoint
+            self.save()
+
+    def save(self):
+        with atomic_write(self.path) as fd:
+            yaml.safe_dump(self.folders, fd, default_flow_style=False)
+        LOG.debug('wrote state to %s', self.path)
@@ -0,0 +1,160 @@
+import array
+import bisect
+
+
+class UIDSet(object):
+    '''An immutable, sorted set of message UIDs.
+
+    UIDs are kept in an array of unsigned 32-bit integers (IMAP UIDs are
+    32 bits), which takes a fraction of the memory of a list of Python
+    ints.  Slicing a UIDSet returns another UIDSet, so it can be passed
+    to chunker(), and sequence_set() renders it as an IMAP sequence set
+    in which runs of consecutive UIDs are written as ranges.'''
+
+    __slots__ = ('uids',)
+
+    def __init__(self, uids=()):
+        if isinstance(uids, UIDSet):
+            self.uids = uids.uids
+        else:
+            self.uids = array.array('I', sorted(set(uids)))
+
+    @classmethod
+    def _from_array(cls, uids):
+        '''Wrap an array that is already sorted and free of
+        duplicates.'''
+
+        uidset = cls.__new__(cls)
+        uidset.uids = uids
+        return uidset
+
+    @classmethod
+    def from_sequence_set(cls, spec):
+        '''Parse an IMAP sequence set (such as "1:5,7,10:12") that does
+        not contain "*".'''
+
+        uids = array.array('I')
+        for part in spec.split(','):
+            if not part:
+                continue
+            lo, _, hi = part.partition(':')
+            lo = int(lo)
+            hi = int(hi) if hi else lo
+            if lo > hi:
+                lo, hi = hi, lo
+            uids.extend(range(lo, hi + 1))
+
+        if any(uids[i] >= uids[i + 1] for i in range(len(uids) - 1)):
+            return cls(uids)
+
+        return cls._from_array(uids)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __nonzero__(self):
+        return len(self.uids) > 0
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        return iter(self.uids)
+
+    def __contains__(self, uid):
+        i = bisect.bisect_left(self.uids, uid)
+        return i < len(self.uids) and self.uids[i] == uid
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._from_array(self.uids[index])
+
+        return self.uids[index]
+
+    def __eq__(self, other):
+        if not isinstance(other, UIDSet):
+            return NotImplemented
+        return self.uids == other.uids
+
+    def __ne__(self, other):
+        if not isinstance(other, UIDSet):
+            return NotImplemented
+        return self.uids != other.uids
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'UIDSet(%r)' % self.sequence_set()
+
+    def _merge(self, other, keep_left, keep_right, keep_both):
+        '''Walk the two sorted sets in parallel, keeping UIDs according
+        to whether they are in only one of the sets or in both.'''
+
+        if not isinstance(other, UIDSet):
+            other = UIDSet(other)
+
+        a, b = self.uids, other.uids
+        i = j = 0
+        out = array.array('I')
+        while i < len(a) and j < len(b):
+            if a[i] < b[j]:
+                if keep_left:
+                    out.append(a[i])
+                i += 1
+            elif a[i] > b[j]:
+                if keep_right:
+                    out.append(b[j])
+                j += 1
+            else:
+                if keep_both:
+                    out.append(a[i])
+                i += 1
+                j += 1
+
+        if keep_left:
+            out.extend(a[i:])
+        if keep_right:
+            out.extend(b[j:])
+
+        return self._from_array(out)
+
+    def union(self, other):
+        return self._merge(other, True, True, True)
+
+    def intersection(self, other):
+        return self._merge(other, False, False, True)
+
+    def difference(self, other):
+        return self._merge(other, True, False, False)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def since(self, uid):
+        '''Return the UIDs that are greater than or equal to uid.'''
+
+        return self._from_array(
+            self.uids[bisect.bisect_left(self.uids, uid):])
+
+    def ranges(self):
+        '''Yield (first, last) for each run of consecutive UIDs.'''
+
+        uids = self.uids
+        if not uids:
+            return
+
+        first = last = uids[0]
+        for uid in uids[1:]:
+            if uid != last + 1:
+                yield first, last
+                first = uid
+            last = uid
+
+        yield first, last
+
+    def sequence_set(self):
+        '''Return the set as a compact IMAP sequence set.'''
+
+        return ','.join('%d' % first if first == last
+                        else '%d:%d' % (first, last)
+                        for first, last in self.ranges())
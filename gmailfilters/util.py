@@ -1,9 +1,177 @@
+import contextlib
+import errno
 import logging
+import os
+import sys
+import threading
+import time
+import yaml
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# libyaml's loader is many times faster than the pure-Python one, but
+# is only available if PyYAML was built with it.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 LOG = logging.getLogger(__name__)
 
+
+def load_yaml(fd):
+    '''Parse a YAML document (like yaml.safe_load), using libyaml if it
+    is available.'''
+
+    return yaml.load(fd, Loader=SafeLoader)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    '''Open a new temporary file next to path for writing, and rename it
+    into place once the block completes.  An interrupted write never
+    leaves a truncated file, and concurrent writers each have their own
+    temporary file.  If the block raises, the temporary file is
+    removed.  The directory is created if necessary.'''
+
+    import tempfile
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        try:
+            os.makedirs(dirname)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   suffix='.tmp', dir=dirname or '.')
+    try:
+        with os.fdopen(fd, mode) as fp:
+            yield fp
+        os.rename(tmppath, path)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+
 def chunker(items, chunksize):
-    '''Splits a list into lists of chunksize items.'''
+    '''Splits a list into lists of chunksize items.  chunksize may be an
+    integer or a ChunkSizer, in which case the size of each chunk is
+    read from it just before the chunk is produced.'''
+
+    i = 0
+    while i < len(items):
+        size = int(chunksize)
+        if size < 1:
+            raise ValueError('chunk size must be at least 1, not %d' % size)
+        yield items[i:i + size]
+        i += size
+
+
+def prefetch(items, func):
+    '''Yield (item, func(item)) for each of items, calling func in a
+    background thread so that the result for the next item is being
+    computed while the caller handles the current one.  Exceptions
+    raised by func are re-raised in the caller.  When the generator is
+    closed early, it waits for any call in progress to finish.'''
+
+    results = queue.Queue(1)
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                results.put((True, (item, func(item))))
+        except Exception:
+            results.put((False, sys.exc_info()))
+        else:
+            results.put((False, None))
+
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+
+    try:
+        while True:
+            ok, value = results.get()
+            if ok:
+                yield value
+            elif value is None:
+                return
+            else:
+                raise value[1]
+    finally:
+        stop.set()
+        while t.is_alive():
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                t.join(0.1)
+
+
+class ChunkSizer(object):
+    '''Decides how many messages to put in each chunk.
+
+    Without a target, a ChunkSizer always returns the same size.  With a
+    target (in seconds), it is adaptive: each time a command is timed
+    with measure(), the size moves toward the number of messages that
+    the command could have processed in target seconds, changing by at
+    most a factor of two at a time and staying between minimum and
+    maximum.'''
+
+    def __init__(self, size, minimum=1, maximum=None, target=None,
+                 name=None):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.name = name
+        self.lock = threading.Lock()
+
+    def __int__(self):
+        return self.size
+
+    def clamp(self, size):
+        size = max(self.minimum, size)
+        if self.maximum is not None:
+            size = min(self.maximum, size)
+        return max(1, int(size))
+
+    def record(self, count, elapsed):
+        '''Adjust the chunk size given that a command on count messages
+        took elapsed seconds.'''
+
+        if self.target is None or not count:
+            return
+
+        with self.lock:
+            if elapsed <= 0:
+                ideal = self.size * 2
+            else:
+                ideal = count * self.target / elapsed
+
+            size = self.clamp(min(self.size * 2,
+                                  max(self.size // 2, ideal)))
+            if size != self.size:
+                LOG.debug('%s chunk size %d -> %d (%d messages in %.3fs)',
+                          self.name or 'adaptive', self.size, size,
+                          count, elapsed)
+                self.size = size
+
+    @contextlib.contextmanager
+    def measure(self, count):
+        '''Time the enclosed command, which operates on count
+        messages.'''
 
-    for i in range(0, len(items), chunksize):
-        yield items[i:i+chunksize]
+        start = time.time()
+        yield
+        self.record(count, time.time() - start)